@@ -3,8 +3,12 @@ import math
 
 logger = logging.getLogger(__name__)
 import os
-from datetime import datetime as dt
-from os.path import join, exists
+import pickle
+import re
+import sqlite3
+import threading
+from os.path import join, exists, dirname, basename
+import numpy as np
 from pyworkflow.utils import getParentFolder, removeBaseExt
 from pathlib import PureWindowsPath
 
@@ -26,6 +30,17 @@ MIN_MAX_MEAN = 'MinMaxMean'
 COUNTS_PER_ELECTRON = 'CountsPerElectron'
 DIVIDED_BY_TWO = 'DividedBy2'
 
+# Tokenizer of the mdoc lines: Z value section headers, [T ...] sections and key = value pairs
+MDOC_LINE_REGEX = re.compile(r'^[ \t]*(?:\[ZValue[ \t]*=[ \t]*(?P<zValue>[^\]\n]*)\][^\n]*'
+                             r'|(?P<title>\[T[^\n]*)'
+                             r'|(?P<key>[^=\n\[]*[^=\s\[])[ \t]*=[ \t]*(?P<value>(?:[^\n]*[^\s])?))[ \t\r]*$', re.MULTILINE)
+# Tilt axis angle in a [T ...] section, once lowercased and without spaces or commas
+TILT_AXIS_ANGLE_REGEX = re.compile(r'tiltaxisangle=([-+]?\d+(?:\.\d*)?)')
+# DateTime values, e.g. 30-Nov-21  17:42:06 or 30-Nov-2021  17:42:06
+DATE_TIME_REGEX = re.compile(r'^[ \t]*(\d{1,2})-([A-Za-z]{3})-(\d{4}|\d{2})[ \t]+(\d{1,2}):(\d{2}):(\d{2})[ \t]*$',
+                            re.MULTILINE)
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
 
 class MDoc:
     """class to interact with the IMOD "autodoc" files used by serialEM.
@@ -72,10 +87,12 @@ class MDoc:
 
     def __init__(self, fileName, voltage=None, magnification=None,
                  samplingRate=None, doseProvidedByUser=None,
-                 tiltAngleProvidedByUser=None):
+                 tiltAngleProvidedByUser=None, cache=None):
 
         self._mdocFileName = fileName
         self._tsId = None
+        # Optional MDocCache with the previously parsed mdoc files
+        self._cache = cache
 
         # Dose related attributes
         self.doseProvidedByUser = doseProvidedByUser
@@ -158,54 +175,21 @@ class MDoc:
         """
         Parse the mdoc file and return a list with a dict key=value for each
         of the [Zvalue = X] sections and a dictionary for the first lines
-        global variables.
+        global variables. If a cache was provided, the file is only parsed
+        if it is not in the cache or it has been modified.
 
         :return: dictionary (header), list of dictionaries (Z slices)
         """
-
-        logger.info("Parsing %s" % self._mdocFileName)
-        headerDict = {}
-        headerParsed = False
-        zvalueList = []  # list of dictionaries with
-        with open(self._mdocFileName) as f:
-            for line in f:
-                if line.startswith('[ZValue'):  # each tilt movie
-                    # We have found a new z value
-                    headerParsed = True
-                    zvalue = int(line.split(']')[0].split('=')[1])
-                    if zvalue != len(zvalueList):
-                        raise Exception("Unexpected Z value = %d" % zvalue)
-                    zvalueDict = {}
-                    zvalueList.append(zvalueDict)
-                elif line.startswith('[T'):  # auxiliary global information
-                    if self.getTiltAxisAngle():
-                        # It's in the mdoc, but the user has specified
-                        # it manually
-                        continue
-                    else:
-                        strLine = line.strip().replace(' ', ''). \
-                            replace(',', '').lower()
-                        pattern = 'tiltaxisangle='
-                        if pattern in strLine:
-                            # Example of the most common syntax
-                            # [T =     Tilt axis angle = 90.1, binning = 1
-                            #                   spot = 9  camera = 0]
-                            # [T =     TiltAxisAngle = -91.81  Binning = 1
-                            #                                   SpotSize = 7]
-                            tiltAxisAngle = \
-                                strLine.split('=')[2].split('binning')[0]
-                            # Check if it's a string which
-                            # represents a float or not
-                            if tiltAxisAngle.lstrip('-+'). \
-                                    replace('.', '', 1).isdigit():
-                                self._tiltAxisAngle = float(tiltAxisAngle)
-                elif line.strip():  # global variables no in [T sections]
-                    key, value = line.split('=')
-                    if not headerParsed:
-                        headerDict[key.strip()] = value.strip()
-                    if zvalueList:
-                        zvalueDict[key.strip()] = value.strip()
-
+        parsed = self._cache.get(self._mdocFileName) if self._cache else None
+        if parsed is None:
+            logger.info("Parsing %s" % self._mdocFileName)
+            parsed = parseMdocFile(self._mdocFileName)
+            if self._cache:
+                self._cache.set(self._mdocFileName, parsed)
+        headerDict, zvalueList, tiltAxisAngle = parsed
+        # The value introduced by the user has a higher priority than the one in the mdoc
+        if not self.getTiltAxisAngle() and tiltAxisAngle is not None:
+            self._tiltAxisAngle = tiltAxisAngle
         return headerDict, zvalueList
 
     def _getAcquisitionInfoFromMdoc(self, headerDict, firstSlice):
@@ -268,16 +252,8 @@ class MDoc:
         dtValue = zSlices[0].get('DateTime', None)
         if dtValue is None:
             return zSlices
-        else:
-            if len(dtValue.split()[0]) == 9:  # year is two digits
-                fmt = '%d-%b-%y  %H:%M:%S'
-            else:
-                fmt = '%d-%b-%Y  %H:%M:%S'
-
-        zSlices_sorted = sorted(zSlices,
-                                key=lambda d: dt.strptime(d['DateTime'], fmt))
-
-        return zSlices_sorted
+        timeStamps = parseDateTimes([zSlice['DateTime'] for zSlice in zSlices])
+        return [zSlices[i] for i in np.argsort(timeStamps, kind='stable')]
 
     @staticmethod
     def _getAngleMovieFileName(parentFolder, zSlice, tsFile):
@@ -357,6 +333,7 @@ class MDoc:
         msg = [f'\n{self._mdocFileName} is missing:\n']
         missingFiles = []
         missingAnglesIndices = []
+        dirContents = {}  # Each directory is listed once instead of checking each file
         for i, tiltMetadata in enumerate(self._tiltsMetadata):
             # Check the angles
             if not tiltMetadata.getTiltAngle():
@@ -366,7 +343,7 @@ class MDoc:
                 # Ignore the files validation is sometimes used for
                 # test purposes
                 file = tiltMetadata.getAngleMovieFile()
-                if not exists(file):
+                if not self._isInDir(file, dirContents):
                     missingFiles.append(file)
 
         if not self._voltage:
@@ -391,6 +368,21 @@ class MDoc:
 
         return validateMdocContentsErrorMsgList
 
+    @staticmethod
+    def _isInDir(fileName, dirContents):
+        """ Checks if a file exists listing its directory only the first time it is required.
+        :param fileName: file to check.
+        :param dirContents: dictionary {directory: set of file names} with the directories already listed.
+        """
+        fileDir = dirname(fileName)
+        if fileDir not in dirContents:
+            try:
+                with os.scandir(fileDir or '.') as entries:
+                    dirContents[fileDir] = {entry.name for entry in entries}
+            except OSError:
+                dirContents[fileDir] = set()
+        return basename(fileName) in dirContents[fileDir]
+
     def getFileName(self):
         return self._mdocFileName
 
@@ -486,3 +478,108 @@ def deNormalizeTSId(rawTSId):
     """ Denormalizes the name of a TS"""
     deNormTSID = rawTSId.replace(TS_PREFIX, '')
     return deNormTSID
+
+
+def parseMdocFile(mdocFileName):
+    """ Parses an mdoc file with a single regular expression.
+
+    :param mdocFileName: path of the mdoc file.
+    :return: tuple (header dictionary, list of dictionaries with the Z slices, tilt axis angle or None if it is not
+     in the [T ...] sections)
+    """
+    headerDict = {}
+    zvalueList = []  # list of dictionaries with
+    zvalueDict = headerDict
+    tiltAxisAngle = None
+    with open(mdocFileName) as f:
+        content = f.read()
+    for zValue, title, key, value in MDOC_LINE_REGEX.findall(content):
+        if key:  # global variables no in [T sections]
+            zvalueDict[key] = value
+        elif title:  # auxiliary global information
+            if tiltAxisAngle:
+                continue
+            # Example of the most common syntax
+            # [T =     Tilt axis angle = 90.1, binning = 1
+            #                   spot = 9  camera = 0]
+            # [T =     TiltAxisAngle = -91.81  Binning = 1
+            #                                   SpotSize = 7]
+            strLine = title.replace(' ', '').replace(',', '').lower()
+            angleMatch = TILT_AXIS_ANGLE_REGEX.search(strLine)
+            if angleMatch:
+                tiltAxisAngle = float(angleMatch.group(1))
+        else:  # each tilt movie
+            # We have found a new z value
+            zvalue = int(zValue)
+            if zvalue != len(zvalueList):
+                raise Exception("Unexpected Z value = %d" % zvalue)
+            zvalueDict = {}
+            zvalueList.append(zvalueDict)
+
+    return headerDict, zvalueList, tiltAxisAngle
+
+
+def parseDateTimes(dateTimes):
+    """ Converts the DateTime values of an mdoc file (e.g. 30-Nov-21  17:42:06, with the year given with two or four
+    digits) into sortable integers (seconds, considering all the months of 31 days).
+
+    :param dateTimes: list of DateTime strings.
+    :return: numpy array of integers.
+    """
+    fields = DATE_TIME_REGEX.findall('\n'.join(dateTimes))
+    if len(fields) != len(dateTimes):
+        raise ValueError("Unexpected DateTime format in %s" % dateTimes)
+    fields = np.array(fields)
+    months = np.array([MONTHS.index(month.lower()) for month in fields[:, 1]])
+    years = fields[:, 2].astype(int)
+    # Two digits years as in strptime: 69-99 --> 1969-1999, 0-68 --> 2000-2068
+    twoDigits = np.char.str_len(fields[:, 2]) == 2
+    years[twoDigits] += np.where(years[twoDigits] < 69, 2000, 1900)
+    days, hours, minutes, seconds = [fields[:, i].astype(int) for i in (0, 3, 4, 5)]
+    return ((((years * 12 + months) * 31 + days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+class MDocCache:
+    """ Persistent cache of parsed mdoc files, stored in a sqlite file. The entries are keyed by the mdoc path, size
+    and modification time, so a modified mdoc file is parsed again. It can be shared among threads.
+    """
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _getConnection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._fileName, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS mdocs (path TEXT PRIMARY KEY, size INTEGER, '
+                                     'mtime INTEGER, data BLOB)')
+        return self._connection
+
+    @staticmethod
+    def _getKey(mdocFileName):
+        stat = os.stat(mdocFileName)
+        return os.path.abspath(mdocFileName), stat.st_size, stat.st_mtime_ns
+
+    def get(self, mdocFileName):
+        """ Returns the parsed data stored for the given mdoc file, or None if it is not stored or the file has
+        been modified since."""
+        path, size, mtime = self._getKey(mdocFileName)
+        with self._lock:
+            row = self._getConnection().execute('SELECT data FROM mdocs WHERE path=? AND size=? AND mtime=?',
+                                                (path, size, mtime)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, mdocFileName, parsed):
+        """ Stores the parsed data of the given mdoc file."""
+        path, size, mtime = self._getKey(mdocFileName)
+        data = pickle.dumps(parsed, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            connection = self._getConnection()
+            connection.execute('INSERT OR REPLACE INTO mdocs VALUES (?, ?, ?, ?)', (path, size, mtime, data))
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -27,23 +27,30 @@
 import logging
 import typing
 from os.path import exists, dirname, join
-from sqlite3 import OperationalError
 from typing import Optional
 import mrcfile
 
-from pwem.emlib.image.image_readers import ImageReadersRegistry, ImageStack
 from pwem import ALIGN_NONE
 import csv
+import ctypes
+import ctypes.util
+import itertools
+import json
 import math
+import multiprocessing
 import os
+import select
 import threading
+import time
 from collections import OrderedDict
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+from scipy import ndimage
 import pwem.objects.data as data
 import pyworkflow.utils.path as path
 import tomo.constants as const
 from pwem.convert.transformations import euler_matrix
+from pwem.emlib import lib
 from pwem.emlib.image import ImageHandler
 from pwem.objects import Transform
 from pyworkflow.object import Integer, Float, String, Pointer, Boolean, CsvList
@@ -133,12 +140,159 @@ def convertMatrix(M, convention=None, direction=None):
         return R @ R @ Mi
 
 
+def convertMatrices(stack, convention=None, direction=None):
+    """ Batched counterpart of convertMatrix: converts a stack of transformation matrices at once, inverting all of
+    them with a single call to np.linalg.inv and multiplying them as stacks. The products are done in the same order
+    as in convertMatrix, so the results are identical to converting the matrices one by one.
+    :param stack: (N, 4, 4) array of transformation matrices.
+    :param convention: one of the valid conventions to convert the matrices (see convertMatrix).
+    :param direction: 'get' or 'set' (see convertMatrix).
+    :return: (N, 4, 4) array with the converted matrices.
+    """
+    stack = np.asarray(stack, dtype=float).reshape(-1, 4, 4)
+    if convention is None or convention in [MATRIX_CONVERSION.EMAN, MATRIX_CONVERSION.DYNAMO]:
+        return stack
+    elif direction in [const.GET, const.SET] and convention in [MATRIX_CONVERSION.RELION, MATRIX_CONVERSION.XMIPP]:
+        # Rotation matrices. Remove translation from the Scipion matrices
+        R = np.zeros_like(stack)
+        R[:, :3, :3] = stack[:, :3, :3]
+        R[:, 3, 3] = 1
+        Mi = np.linalg.inv(stack)
+        return Mi @ R @ R if direction == const.GET else R @ R @ Mi
+    raise ValueError('Invalid matrix conversion: convention = %s, direction = %s' % (convention, direction))
+
+
+def _createSqlIndex(setObj, attrName):
+    """ Creates, if not present yet, a sqlite index on the column in which the given item attribute is stored in the
+    table of the set. Sets that are still empty (no table created yet) are skipped.
+    :param setObj: set (or nested set) whose table will be indexed.
+    :param attrName: item attribute to be indexed, e.g. _tsId.
+    """
+    db = setObj._getMapper().db
+    colName = db._getRealCol(attrName)
+    if colName is None:
+        return
+    tableName = '%sObjects' % db.tablePrefix
+    db.executeCommand('CREATE INDEX IF NOT EXISTS index_%s%s ON %s (%s);'
+                      % (db.tablePrefix, attrName.replace('.', '_'), tableName, colName))
+
+
+def _readColumnsAsArrays(db, fields, tablePrefix='', orderBy='id', matrixDim=3, where=None):
+    """ Reads the values of the given item attributes from all the rows of a set table with a single sql query,
+    without building any item object.
+    :param db: SqliteFlatDb of the set. Nested sets (e.g. the tilt-images of each tilt-series) are stored in the same
+    sqlite file, so the db of the parent set can be used for all of them, passing the corresponding tablePrefix.
+    :param fields: list of item attributes to read, e.g. ['_tiltAngle', '_acquisition._accumDose']. The columns 'id' and
+    'enabled' can be requested too.
+    :param tablePrefix: prefix of the Objects and Classes tables to read.
+    :param orderBy: item attribute used to sort the rows.
+    :param matrixDim: dimension of the identity matrix returned for the rows with no matrix stored.
+    :param where: optional dictionary {field: value} to read only the rows whose item attributes have the given values.
+    :return: dictionary {field: np.ndarray}. Matrix attributes (ending in ._matrix) are returned as a stack of shape
+    (N, matrixDim, matrixDim). Numeric attributes not stored in the table are returned filled with NaN.
+    """
+    db.executeCommand('SELECT label_property, column_name, class_name FROM "%sClasses"' % tablePrefix)
+    colMap = {'id': ('id', 'Integer'), 'enabled': ('enabled', 'Boolean')}
+    for row in db.cursor.fetchall():
+        colMap[row['label_property']] = (row['column_name'], row['class_name'])
+    columns = [colMap.get(field, ('NULL', None))[0] for field in fields]
+    where = where or {}
+    whereStr = ' AND '.join('%s=?' % colMap.get(field, (field,))[0] for field in where) or '1'
+    db.executeCommand('SELECT %s FROM "%sObjects" WHERE %s ORDER BY %s'
+                      % (', '.join(columns), tablePrefix, whereStr, colMap.get(orderBy, (orderBy,))[0]),
+                      tuple(where.values()))
+    rows = db.cursor.fetchall()
+    arrays = {}
+    for i, field in enumerate(fields):
+        values = [row[i] for row in rows]
+        className = colMap.get(field, (None, None))[1]
+        if field.endswith('._matrix'):
+            identity = np.eye(matrixDim).tolist()
+            arrays[field] = np.array([identity if v is None else json.loads(v) for v in values],
+                                     dtype=float).reshape(-1, matrixDim, matrixDim)
+        elif className == 'Boolean':
+            arrays[field] = np.array(values, dtype=bool)
+        elif className == 'Integer' and None not in values:
+            arrays[field] = np.array(values, dtype=int)
+        elif className in ('Integer', 'Float', None):
+            arrays[field] = np.array(values, dtype=float)
+        else:
+            arrays[field] = np.array(values, dtype=object)
+    return arrays
+
+
+_workerImage = None
+
+
+def _initTransformWorker():
+    """ Creates the xmipp image reused by a worker process to read all the tilt-images it has to transform. """
+    global _workerImage
+    _workerImage = lib.Image()
+
+
+def _applyTransformToSlices(inFileName, jobs, shape):
+    """ Applies the transformation matrices to a group of tilt-images of a stack. It is the task executed by the
+    worker processes, and it does the same as ImageHandler.applyTransform (the empty regions are filled with the mean
+    of each image), but the transformed images are returned instead of written.
+    :param inFileName: path of the tilt-series stack.
+    :param jobs: list of tuples (inImgIndex, outImgIndex, trMatrix), with the indices starting in 1.
+    :param shape: dimensions of the output images given as a tuple (yDim, xDim).
+    :return: list of tuples (outImgIndex, float32 numpy array).
+    """
+    if _workerImage is None:
+        _initTransformWorker()
+    results = []
+    for inImgIndex, outImgIndex, trMatrix in jobs:
+        _workerImage.read('%i:mrcs@%s' % (inImgIndex, inFileName))
+        mean, _, _, _ = _workerImage.computeStats()
+        resultImage = _workerImage.applyWarpAffine(list(np.array(trMatrix).flatten()), shape, False, mean)
+        results.append((outImgIndex, np.asarray(resultImage.getData(), dtype=np.float32)))
+    return results
+
+
+def appendItems(setObj, items):
+    """ Appends the given items to a set inserting them in its table with a single executemany, instead of one sql
+    statement per item. The values of each item are read as soon as it is yielded, so the same object can be yielded
+    repeatedly, modified and with its objId set to None.
+    Only the first item goes through setObj.append, so the side effects of the append of each kind of set (e.g. the
+    sampling rate and acquisition copied by SetOfImages, the tsId and the alignment and odd/even flags set by
+    TiltSeriesBase, or the dimensions of SetOfTomograms) are applied from the first item only. The rest of the items
+    must be fully populated by the caller.
+    :param setObj: set to which the items are appended.
+    :param items: iterable of items.
+    """
+    mapper = None
+    rows = []
+    for item in items:
+        if mapper is None:
+            # The first one is appended as usual, so the table is created
+            setObj.append(item)
+            mapper = setObj._getMapper()
+            continue
+        if not item.hasObjId():
+            setObj._idCount += 1
+            item.setObjId(setObj._idCount)
+        else:
+            setObj._idCount = max(setObj._idCount, item.getObjId())
+        rows.append((item.getObjId(), item.isEnabled(), item.getObjLabel(), item.getObjComment(),
+                     *mapper._getValuesFromObject(item).values()))
+    if rows:
+        mapper.db.cursor.executemany(mapper.db.INSERT_OBJECT, rows)
+        setObj._size.set(setObj._size.get() + len(rows))
+
+
 class TiltImageBase:
     """ Base class for TiltImageM and TiltImage. """
     TS_ID_FIELD = '_tsId'
     TILT_ANGLE_FIELD = '_tiltAngle'
     ACQ_ORDER_FIELD = '_acqOrder'
     INDEX_FIELD = '_index'
+    ACCUM_DOSE_FIELD = '_acquisition._accumDose'
+    TRANSFORM_MATRIX_FIELD = '_transform._matrix'
+    ENABLED_FIELD = 'enabled'
+    # Default fields read by the columnar accessors (see TiltSeriesBase.toArrays)
+    ARRAY_FIELDS = [INDEX_FIELD, ACQ_ORDER_FIELD, TILT_ANGLE_FIELD, ACCUM_DOSE_FIELD, ENABLED_FIELD,
+                    TRANSFORM_MATRIX_FIELD]
 
     def __init__(self, tsId=None, tiltAngle=None, acquisitionOrder=None, **kwargs):
         self._tiltAngle = Float(tiltAngle)
@@ -325,8 +479,19 @@ class TiltSeriesBase(data.SetOfImages):
 
         super().write(properties=False)
 
+    def getSize(self):
+        """ Return the number of tilt-images. The nested set may not be loaded yet (see
+        SetOfTiltSeriesBase._setItemMapperPath), so it is loaded first to get the current size. """
+        if not self._mapperPath.isEmpty():
+            self._getMapper()
+        return super().getSize()
+
+    def __len__(self):
+        return self.getSize()
+
     def append(self, tiltImage: TiltImageBase):
         tiltImage.setTsId(self.getTsId())
+        self._getMapper()  # Load the nested set, if not done yet, to get the right id count
         data.SetOfImages.append(self, tiltImage)
 
         # TODO: Do it only once? Size =1?
@@ -415,6 +580,20 @@ class TiltSeriesBase(data.SetOfImages):
                 return item
         raise Exception(f'tsId = {self.getTsId()} - No enabled items were found in the current tilt-series.')
 
+    def toArrays(self, fields=None, orderBy='id') -> typing.Dict[str, np.ndarray]:
+        """ Returns the values of the given tilt-image attributes as numpy arrays, read with a single sql query
+        instead of iterating the tilt-images.
+        :param fields: list of tilt-image attributes to read. By default, TiltImageBase.ARRAY_FIELDS (index,
+        acquisition order, tilt angle, accumulated dose, enabled and transformation matrix).
+        :param orderBy: tilt-image attribute used to sort the values.
+        :return: dictionary {field: np.ndarray}. The transformation matrices are returned as a (N, 3, 3) stack.
+        """
+        if self.isEmpty():
+            return {field: np.array([]) for field in fields or TiltImageBase.ARRAY_FIELDS}
+        db = self._getMapper().db
+        return _readColumnsAsArrays(db, fields or TiltImageBase.ARRAY_FIELDS,
+                                    tablePrefix=db.tablePrefix, orderBy=orderBy)
+
 def tiltSeriesToString(tiltSeries):
     s = []
 
@@ -471,42 +650,51 @@ class TiltSeries(TiltSeriesBase):
                 self.applyTransformPy(path, binning)
             return path
 
-    def applyTransformPy(self, outputFile, binning):
+    def applyTransformPy(self, outputFile, binning, batchSize=8):
         """ Apply the transformation matrix to the tilt series using python. Use for now for visualization purposes until
-        quality is verified to be enough for processing.
+        quality is verified to be enough for processing. The stack is streamed in batches of slices from a memory-mapped
+        input to a memory-mapped output, and the binning, rotation and shifts of each tilt-image are combined into a
+        single affine transformation.
 
         :param outputFile: output file for the interpolated image
-        :param binning: times smaller you want the output"""
+        :param binning: times smaller you want the output
+        :param batchSize: number of slices read from the input stack at once"""
 
         orig = self.__getTsFileName()
-
-        imgStk = ImageReadersRegistry.open(orig)
-
-        output = ImageStack()
-
-        for ti in self.iterItems():
-
-            transf = ti.getTransform()
-
-            _, _, rot = transf.getEulerAngles()
-            rot = np.rad2deg(-rot)
-
-            # Scale factor
-            factor = 1/binning
-
-            x,y,_ = transf.getShifts()
-            # scale shifts
-            x=x*factor
-            y=y*factor
-            npImage = imgStk.getImage(ti.getIndex()-1)
-
-            if binning != 0:
-                npImage = imgStk.scaleSlice(npImage, factor)
-
-            npImage = imgStk.transformSlice(npImage,(x,y), rot)
-            output.append(npImage)
-
-        output.write(outputFile)
+        # Scale factor
+        factor = 1 / binning
+        tiArrays = self.toArrays(fields=[TiltImage.INDEX_FIELD, TiltImage.TRANSFORM_MATRIX_FIELD])
+        indices = tiArrays[TiltImage.INDEX_FIELD].astype(int) - 1
+        matrices = tiArrays[TiltImage.TRANSFORM_MATRIX_FIELD]
+
+        with mrcfile.mmap(orig, mode='r', permissive=True) as inMrc:
+            inData = inMrc.data
+            inShape = np.array(inData.shape[-2:])
+            outShape = np.round(inShape * factor).astype(int)
+            scale = inShape / outShape
+            # Same anti-aliasing as skimage rescale
+            sigma = max(0, (binning - 1) / 2)
+            with mrcfile.new_mmap(outputFile, shape=(len(indices), *outShape), mrc_mode=2,
+                                  overwrite=True) as outMrc:
+                for start in range(0, len(indices), batchSize):
+                    batch = np.asarray(inData[indices[start:start + batchSize]], dtype=np.float32)
+                    for i, npImage in enumerate(batch):
+                        trMatrix = matrices[start + i]
+                        if sigma > 0:
+                            npImage = ndimage.gaussian_filter(npImage, sigma, mode='mirror')
+                        bg = npImage.mean()
+                        # Rotation (as scipy rotate, around the center) and shifts (scaled), given in (y, x)
+                        rot = -np.arctan2(trMatrix[1, 0], trMatrix[0, 0])
+                        c, s = np.cos(rot), np.sin(rot)
+                        rotMatrix = np.array([[c, s], [-s, c]])
+                        shifts = np.array([trMatrix[1, 2], trMatrix[0, 2]]) * factor
+                        center = (outShape - 1) / 2
+                        offset = center - rotMatrix @ center - rotMatrix @ shifts
+                        # From the binned coordinates to the input ones
+                        ndimage.affine_transform(npImage, scale[:, None] * rotMatrix, scale * (offset + 0.5) - 0.5,
+                                                 output_shape=tuple(outShape), output=outMrc.data[start + i],
+                                                 mode='constant', cval=bg)
+                outMrc.voxel_size = (self.getSamplingRate() or 1.) * binning
 
     def getInterpolatedFileName(self, setId, binning, tmpFolder):
         """ Returns the interpolated filename for the tilt series
@@ -536,7 +724,8 @@ class TiltSeries(TiltSeriesBase):
     def applyTransform(self,
                        outFileName: str,
                        even: typing.Union[bool, None] = None,
-                       ignoreExcludedViews: bool = False) -> None:
+                       ignoreExcludedViews: bool = False,
+                       workers: int = 1) -> None:
         """It applies the transformation matrices to the tilt-images. If they don't have it yet, it simply links the
         tilt-series or re-stacks it depending on the value jorgeof the parameter presentAcqOrders, used in the case of
         present excluded views at metadata level.
@@ -545,6 +734,8 @@ class TiltSeries(TiltSeriesBase):
         True to the even one and False to the odd one.
         :param ignoreExcludedViews: Boolean used to indicate if the excluded views (at metadata level) must be ignored
         (default) or not.
+        :param workers: number of processes used to apply the transformation matrices. If greater than 1, the
+        tilt-images are distributed among a pool of processes and written to a preallocated output stack.
         """
         inImgFileName = self.__getTsFileName(even=even)
         logger.info(cyanStr(f'inImgFileName = {inImgFileName}'))
@@ -555,7 +746,8 @@ class TiltSeries(TiltSeriesBase):
             logger.info(cyanStr(f'tsId = {self.getTsId()} -> Applying the transformation matrix with Scipion...'))
             self.__applyTransformAli(inImgFileName,
                                      outFileName,
-                                     ignoreExcludedViews=ignoreExcludedViews)
+                                     ignoreExcludedViews=ignoreExcludedViews,
+                                     workers=workers)
         else:
             self.__applyTransformNoAli(inImgFileName,
                                        outFileName,
@@ -583,12 +775,14 @@ class TiltSeries(TiltSeriesBase):
     def __applyTransformAli(self,
                             inFileName: str,
                             outFileName: str,
-                            ignoreExcludedViews: bool = False) -> None:
+                            ignoreExcludedViews: bool = False,
+                            workers: int = 1) -> None:
         """Apply transform to a tilt-series with alignment.
         :param inFileName: String containing the path of the image to which the transformation is going to be applied.
         :param outFileName: String containing the path of the output file that is created.
         :param ignoreExcludedViews: Boolean used to indicate if the excluded views (at metadata level) must be ignored
         (default) or not.
+        :param workers: number of processes used to apply the transformation matrices.
         """
         firstImg = self.getFirstEnabledItem()
         xDim, yDim, _ = firstImg.getDim()
@@ -603,23 +797,60 @@ class TiltSeries(TiltSeriesBase):
             presentAcqOrders = self.getTsPresentAcqOrders()
             tsExcludedIndices =self.getTsExcludedViewsIndices(presentAcqOrders)
             logger.info(cyanStr(f'\t--> Excluded views detected ==> {tsExcludedIndices}.'))
+            # Jobs are tuples (inImgIndex, outImgIndex, trMatrix)
+            jobs = []
             counter = 1
             for ti in self.iterItems(orderBy=self.INDEX):
                 acqOrder = ti.getAcquisitionOrder()
                 if acqOrder in presentAcqOrders:
-                    trMatrix = ti.getTransform().getMatrix()
-                    self._applyTransformToTi(inFileName, trMatrix, xDim, yDim, outFileName, ti.getIndex(), counter)
+                    jobs.append((ti.getIndex(), counter, ti.getTransform().getMatrix()))
                     counter += 1
         else:
-            for index, ti in enumerate(self.iterItems(orderBy=self.INDEX)):
-                trMatrix = ti.getTransform().getMatrix()
-                ind = index + 1
-                self._applyTransformToTi(inFileName, trMatrix, xDim, yDim, outFileName, ind, ind)
+            jobs = [(index + 1, index + 1, ti.getTransform().getMatrix())
+                    for index, ti in enumerate(self.iterItems(orderBy=self.INDEX))]
+        if workers > 1:
+            self._applyTransformParallel(inFileName, outFileName, jobs, xDim, yDim, workers)
+        else:
+            for inImgIndex, outImgIndex, trMatrix in jobs:
+                self._applyTransformToTi(inFileName, trMatrix, xDim, yDim, outFileName, inImgIndex, outImgIndex)
+
+    def _applyTransformParallel(self,
+                                inFileName: str,
+                                outFileName: str,
+                                jobs: typing.List[tuple],
+                                xDim: int,
+                                yDim: int,
+                                workers: int) -> None:
+        """Applies the transformation matrices distributing the tilt-images among a pool of processes. The output
+        stack is preallocated and memory-mapped, so each transformed image is written directly to its position.
+        :param inFileName: String containing the path of the image to which the transformation is going to be applied.
+        :param outFileName: String containing the path of the output file that is created.
+        :param jobs: list of tuples (inImgIndex, outImgIndex, trMatrix), with the indices starting in 1.
+        :param xDim: output image size in X.
+        :param yDim: output image size in Y.
+        :param workers: number of processes.
+        """
+        # Several groups of images per worker to balance the load
+        chunkSize = max(1, math.ceil(len(jobs) / (4 * workers)))
+        chunks = [jobs[i:i + chunkSize] for i in range(0, len(jobs), chunkSize)]
+        with mrcfile.new_mmap(outFileName, shape=(len(jobs), yDim, xDim), mrc_mode=2, overwrite=True) as outMrc:
+            # Spawned, not forked, as this may run in a threaded protocol step (e.g. holding sqlite or logging locks)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_initTransformWorker,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(_applyTransformToSlices, inFileName, chunk, (yDim, xDim))
+                           for chunk in chunks]
+                for future in as_completed(futures):
+                    for outImgIndex, imgData in future.result():
+                        outMrc.data[outImgIndex - 1] = imgData
+            outMrc.set_image_stack()
+            outMrc.update_header_stats()
+            outMrc.voxel_size = self.getSamplingRate()
 
     def applyTransformToAll(self,
                             outFileName: str,
                             outFileNamesEvenOdd: typing.List[str] = None,
-                            ignoreExcludedViews: bool = False) -> None:
+                            ignoreExcludedViews: bool = False,
+                            workers: int = 1) -> None:
         """Applies a transform to the main tilt-series, the even and the odd ones. Inputs:
         :param outFileName: String containing the path of the output file that is created.
         :param outFileNamesEvenOdd: List containing the file names of the output tilt-series even and
@@ -628,6 +859,7 @@ class TiltSeries(TiltSeriesBase):
         corresponding suffixes _even, _odd.
         :param ignoreExcludedViews: Boolean used to indicate if the excluded views (at metadata level) must be ignored
         (default) or not.
+        :param workers: number of processes used to apply the transformation matrices to each of the stacks.
         """
         fPath = dirname(outFileName)
         if outFileNamesEvenOdd:
@@ -641,15 +873,18 @@ class TiltSeries(TiltSeriesBase):
             oddFName = join(fPath, bName + '_odd' + ext)
         self.applyTransform(outFileName,
                             even=None,
-                            ignoreExcludedViews=ignoreExcludedViews)
+                            ignoreExcludedViews=ignoreExcludedViews,
+                            workers=workers)
         logger.info(cyanStr('Even'))
         self.applyTransform(evenFName,
                             even=True,
-                            ignoreExcludedViews=ignoreExcludedViews)
+                            ignoreExcludedViews=ignoreExcludedViews,
+                            workers=workers)
         logger.info(cyanStr('Odd'))
         self.applyTransform(oddFName,
                             even=False,
-                            ignoreExcludedViews=ignoreExcludedViews)
+                            ignoreExcludedViews=ignoreExcludedViews,
+                            workers=workers)
 
     @staticmethod
     def _applyTransformToTi(imgFileName: str,
@@ -701,48 +936,62 @@ class TiltSeries(TiltSeriesBase):
                 excludedViewsInds.append(ti.getIndex())
         return set(excludedViewsInds)
 
-    def reStack(self, inFileName: str, outFileName: str, presentAcqOrders: typing.Set[int]) -> None:
+    def reStack(self,
+                inFileName: str,
+                outFileName: str,
+                presentAcqOrders: typing.Set[int],
+                chunkSize: int = 8) -> None:
         """If there aren't any excluded views (presentAcqOrders is empty), it does nothing. In the opposite case,
         it se-stacks a tilt-series into a new one without the excluded views. If the re-stacked file already exists,
         o action is carried out (avoid creating the same file multiple times, even more necessary if calling this
-        method from the viewer).
+        method from the viewer). The input stack is memory-mapped read-only and the present images are copied in chunks
+        to an output stack preallocated with its final shape, so the whole stack is never loaded in memory. If all the
+        images are present, the output is a hard link to the input (a copy if the link cannot be created).
         :param inFileName: Filename of the input tilt-series that will be re-stacked.
         :param outFileName: Filename of the out re-stacked tilt-series.
         :param presentAcqOrders: set containing the present acq orders in both the given TS.
+        :param chunkSize: number of images copied at once.
         """
         logger.info(cyanStr(f'tsId = {self.getTsId()} -> re-stacking with Scipion...'))
         if exists(outFileName):
             logger.info(cyanStr(f'reStack: file {outFileName} was skipped. It already exists'))
-        logger.info(cyanStr(f'tsId = {self.getTsId()} -> re-stacking with Scipion...'))
-        if exists(outFileName):
-            logger.info(cyanStr(f'reStack: file {outFileName} was skipped. It already exists'))
-        if exists(inFileName):
-            if presentAcqOrders:
-                # Load the file
-                with mrcfile.mmap(inFileName, mode='r+') as tsMrc:
-                    tsData = tsMrc.data
-                # Create an empty array in which the re-stacked TS will be stored
-                nImgs, nx, ny = tsData.shape
-                finalNImgs = len(presentAcqOrders)
-                newTsShape = (finalNImgs, nx, ny)
-                newTsData = np.empty(newTsShape, dtype=tsData.dtype)
-                # Fill it with the non-excluded images
-                counter = 0
-                for index, ti in enumerate(self.iterItems(orderBy=self.INDEX)):
-                    acqOrder = ti.getAcquisitionOrder()
-                    if acqOrder in presentAcqOrders:
-                        newTsData[counter] = tsData[index]
-                        counter += 1
-                # Save the re-stacked TS
-                with mrcfile.mmap(outFileName, mode='w+') as reStackedTsMrc:
-                    reStackedTsMrc.set_data(newTsData)
-                    reStackedTsMrc.update_header_from_data()
-                    reStackedTsMrc.update_header_stats()
-                    reStackedTsMrc.voxel_size = self.getSamplingRate()
-            else:
-                logger.info(f'reStack: file {inFileName} was skipped as there are not any excluded views.')
-        else:
-            logger.warning(f'reStack: file {inFileName} was skipped. It does not exist.')
+            return
+        if not exists(inFileName):
+            return
+        if not presentAcqOrders:
+            logger.info(f'reStack: file {inFileName} was skipped as there are not any excluded views.')
+            return
+        # Positions in the stack (sorted by index) of the present images
+        tiArrays = self.toArrays(fields=[self.ACQ_ORDER_FIELD], orderBy=self.INDEX)
+        keptPositions = np.flatnonzero(np.isin(tiArrays[self.ACQ_ORDER_FIELD], list(presentAcqOrders)))
+        with mrcfile.mmap(inFileName, mode='r', permissive=True) as tsMrc:
+            tsData = tsMrc.data
+            if len(keptPositions) == len(tsData):
+                logger.info(cyanStr(f'reStack: all the images are present. Linking {inFileName}...'))
+                try:
+                    os.link(inFileName, outFileName)
+                except OSError:
+                    path.copyFile(inFileName, outFileName)
+                return
+            # Create the re-stacked TS with its final shape and fill it with the non-excluded images
+            newTsShape = (len(keptPositions), *tsData.shape[1:])
+            with mrcfile.new_mmap(outFileName, shape=newTsShape,
+                                  mrc_mode=mrcfile.utils.mode_from_dtype(tsData.dtype)) as reStackedTsMrc:
+                # Header statistics are accumulated per chunk too (update_header_stats works on the whole stack)
+                dMin, dMax, dSum, dSumSq = np.inf, -np.inf, 0., 0.
+                for start in range(0, len(keptPositions), chunkSize):
+                    chunkPositions = keptPositions[start:start + chunkSize]
+                    chunk = tsData[chunkPositions]
+                    reStackedTsMrc.data[start:start + len(chunkPositions)] = chunk
+                    dMin, dMax = min(dMin, chunk.min()), max(dMax, chunk.max())
+                    dSum += chunk.sum(dtype=np.float64)
+                    dSumSq += np.einsum('ijk,ijk->', chunk, chunk, dtype=np.float64)
+                nValues = reStackedTsMrc.data.size
+                dMean = dSum / nValues
+                header = reStackedTsMrc.header
+                header.dmin, header.dmax, header.dmean = dMin, dMax, dMean
+                header.rms = np.sqrt(max(dSumSq / nValues - dMean ** 2, 0))
+                reStackedTsMrc.voxel_size = self.getSamplingRate()
 
     def generateTltFile(self,
                         tltFilePath: str,
@@ -760,29 +1009,21 @@ class TiltSeries(TiltSeriesBase):
         :param includeDose: boolean used to indicate if the tlt file created must contain an additional column with
         the dose or not (default).
         """
-        angleList = []
-        doseList = []
+        tiArrays = self.toArrays(fields=[TiltImage.TILT_ANGLE_FIELD,
+                                         TiltImage.ACQ_ORDER_FIELD,
+                                         TiltImage.ACCUM_DOSE_FIELD],
+                                 orderBy=TiltImage.TILT_ANGLE_FIELD)
+        columns = [tiArrays[TiltImage.TILT_ANGLE_FIELD]]
+        if includeDose:
+            columns.append(tiArrays[TiltImage.ACCUM_DOSE_FIELD])
+        tltData = np.column_stack(columns)
         if presentAcqOrders:
-            for ti in self.iterItems(orderBy=TiltImage.TILT_ANGLE_FIELD):
-                if ti.getAcquisitionOrder() in presentAcqOrders:
-                    angleList.append(ti.getTiltAngle())
-                    if includeDose:
-                        doseList.append(ti.getAcquisition().getAccumDose())
-        else:
-            angleList = [ti.getTiltAngle() for ti in self.iterItems(orderBy=TiltImage.TILT_ANGLE_FIELD)]
-            if includeDose:
-                doseList = [ti.getAcquisition().getAccumDose() for ti
-                            in self.iterItems(orderBy=TiltImage.TILT_ANGLE_FIELD)]
+            tltData = tltData[np.isin(tiArrays[TiltImage.ACQ_ORDER_FIELD], list(presentAcqOrders))]
         if reverse:
-            angleList.reverse()
-            if includeDose:
-                doseList.reverse()
+            tltData = tltData[::-1]
 
         with open(tltFilePath, 'w') as f:
-            if includeDose:
-                f.writelines(f"{angle:0.3f} {dose:0.4f}\n" for angle, dose in zip(angleList, doseList))
-            else:
-                f.writelines(f"{angle:0.3f}\n" for angle in angleList)
+            np.savetxt(f, tltData, fmt=['%0.3f', '%0.4f'] if includeDose else '%0.3f')
             # For parallel processing, ensure that the file is completely written and persists on disk
             f.flush()  # Empty python buffer
             os.fsync(f.fileno())  # Empty system buffer
@@ -790,14 +1031,21 @@ class TiltSeries(TiltSeriesBase):
     def writeNewstcomFile(self, ts_folder, **kwargs):
         """Writes an artificial newst.com file"""
         newstcomPath = ts_folder + '/newst.com'
+        with open(newstcomPath, 'w') as f:
+            f.write(self._getNewstcomContent(**kwargs))
+            # For parallel processing, ensure that the file is completely written and persists on disk
+            f.flush()  # Empty python buffer
+            os.fsync(f.fileno())  # Empty system buffer
+        return newstcomPath
+
+    def _getNewstcomContent(self, **kwargs):
+        """Returns the content of an artificial newst.com file"""
         pathi = self.getTsId()
         taperAtFill = kwargs.get('taperAtFill', (1, 0))
         offsetsInXandY = kwargs.get('offsetsInXandY', (0.0, 0.0))
         imagesAreBinned = kwargs.get('imagesAreBinned', 1.0)
         binByFactor = kwargs.get('binByFactor', 1)
-
-        with open(newstcomPath, 'w') as f:
-            f.write('$newstack -StandardInput\n\
+        return ('$newstack -StandardInput\n\
 InputFile {}.st\n\
 OutputFile {}.ali\n\
 TransformFile {}.xf\n\
@@ -813,14 +1061,20 @@ $if (-e ./savework) ./savework'.format(pathi, pathi, pathi,
                                        taperAtFill[1], offsetsInXandY[0],
                                        offsetsInXandY[1], imagesAreBinned,
                                        binByFactor, pathi))
-            # For parallel processing, ensure that the file is completely written and persists on disk
-            f.flush()  # Empty python buffer
-            os.fsync(f.fileno())  # Empty system buffer
-        return newstcomPath
 
     def writeTiltcomFile(self, ts_folder, **kwargs):
         """Writes an artificial tilt.com file"""
         tiltcomPath = ts_folder + '/tilt.com'
+        with open(tiltcomPath, 'w') as f:
+            f.write(self._getTiltcomContent(self.getExcludedViewsIndex(caster=str), **kwargs))
+            # For parallel processing, ensure that the file is completely written and persists on disk
+            f.flush()  # Empty python buffer
+            os.fsync(f.fileno())  # Empty system buffer
+        return tiltcomPath
+
+    def _getTiltcomContent(self, excludedViewsList, **kwargs):
+        """Returns the content of an artificial tilt.com file
+        :param excludedViewsList: list with the indices (as strings) of the excluded views."""
         pathi = self.getTsId()
         thickness = kwargs.get('thickness', 500)
         binned = kwargs.get('binned', 1)
@@ -833,7 +1087,6 @@ $if (-e ./savework) ./savework'.format(pathi, pathi, pathi,
         mode = kwargs.get('mode', 2)
         subsetStart = kwargs.get('subsetStart', (0, 0))
         actionIfGPUFails = kwargs.get('actionIfGPUFails', (1, 2))
-        excludedViewsList = self.getExcludedViewsIndex(caster=str)
         excludedViewsIndexes = ''
         if excludedViewsList:
             excludedViewsIndexes = 'EXCLUDELIST %s \n' % ",".join(excludedViewsList)
@@ -850,8 +1103,7 @@ $if (-e ./savework) ./savework'.format(pathi, pathi, pathi,
         if kwargs.get('swapDims', False):
             dims = (dims[1], dims[0])
 
-        with open(tiltcomPath, 'w') as f:
-            f.write('$tilt -StandardInput\n\
+        return ('$tilt -StandardInput\n\
 InputProjections {}.ali\n\
 OutputFile {}.rec\n\
 IMAGEBINNED {} \n\
@@ -880,10 +1132,6 @@ $if (-e ./savework) ./savework'.format(pathi, pathi, binned, pathi, thickness,
                                        actionIfGPUFails[0], actionIfGPUFails[1],
                                        pathi, offset, shift[0], shift[1],
                                        excludedViewsIndexes))
-            # For parallel processing, ensure that the file is completely written and persists on disk
-            f.flush()  # Empty python buffer
-            os.fsync(f.fileno())  # Empty system buffer
-        return tiltcomPath
 
     def writeTltFile(self, ts_folder, excludeViews=False):
         """Writes a tlt file.
@@ -958,18 +1206,124 @@ $if (-e ./savework) ./savework'.format(pathi, pathi, binned, pathi, thickness,
         :param folderName: path of the directory in which the files will be generated.
         :keyword tltIgnoresExcluded: boolean used to indicate if the tlt file should contain only the data concerning
         the non-excluded views (True) or all of them (False).
+        :keyword fsync: boolean used to indicate if the files must be synced to disk (default) or not. See
+        ImodFileBundle to write the files of many tilt-series with a single sync.
+        """
+        with ImodFileBundle(fsync=kwargs.get('fsync', True)) as bundle:
+            bundle.add(self, folderName, **kwargs)
+
+
+class ImodFileBundle:
+    """ Writes the IMOD files (newst.com, tilt.com, tlt, xtilt and xf) of one or more tilt-series. The tilt-images
+    metadata of each tilt-series is read once, with a single query. Each file is written to a temporary file which is
+    renamed to its final name when the bundle is flushed, so other processes never find a partially written file. If
+    required, all the files are synced to disk at once, before being renamed. Usage:
+
+        with ImodFileBundle(fsync=False) as bundle:
+            for ts in setOfTiltSeries:
+                bundle.add(ts, folderNames[ts.getTsId()])
+    """
+    TMP_SUFFIX = '.tmp'
+
+    def __init__(self, fsync: bool = False):
+        """
+        :param fsync: boolean used to indicate if the files must be synced to disk when the bundle is flushed.
+        """
+        self._fsync = fsync
+        self._pending = []  # Tuples (tmpFileName, fileName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def add(self, ts: TiltSeries, folderName: str, **kwargs) -> typing.List[str]:
+        """Writes the IMOD files of a tilt-series to temporary files. They are moved to their final location when the
+        bundle is flushed.
+        :param ts: tilt-series whose files will be written.
+        :param folderName: path of the directory in which the files will be generated.
+        :param kwargs: the same keywords accepted by TiltSeries.writeImodFiles.
+        :return: list with the final paths of the files.
         """
-        # Create a newst.com file
-        self.writeNewstcomFile(folderName, **kwargs)
-        # Create a tilt.com file
-        self.writeTiltcomFile(folderName, **kwargs)
-        # Create a .tlt file
-        self.writeTltFile(folderName, excludeViews=kwargs.get('tltIgnoresExcluded', False))
-        # Create a .xtilt file
-        self.writeXtiltFile(folderName)
-        # Create a .xf file
-        transformFilePath = folderName + '/%s.xf' % self.getTsId()
-        self.writeXfFile(transformFilePath, delimiter=kwargs.get('delimiter', '\t'), factor=kwargs.get('factor', 1))
+        tsId = ts.getTsId()
+        tiArrays = ts.toArrays(fields=[TiltImage.INDEX_FIELD,
+                                       TiltImage.TILT_ANGLE_FIELD,
+                                       TiltImage.ENABLED_FIELD,
+                                       TiltImage.TRANSFORM_MATRIX_FIELD])
+        enabled = tiArrays[TiltImage.ENABLED_FIELD]
+        tiltAngles = tiArrays[TiltImage.TILT_ANGLE_FIELD]
+        matrices = tiArrays[TiltImage.TRANSFORM_MATRIX_FIELD]
+        excludedViewsList = [str(int(index)) for index in tiArrays[TiltImage.INDEX_FIELD][~enabled]]
+        if kwargs.get('tltIgnoresExcluded', False):
+            tiltAngles = tiltAngles[enabled]
+        if not ts.hasAlignment():
+            logger.info(yellowStr(f'WARNING: tsId = {tsId} - The Tilt series lacks of alignment information '
+                                  f'(transformation matrices). The identity transformation will be written in the '
+                                  f'.xf file'))
+        factor = kwargs.get('factor', 1)
+        xfData = np.column_stack([matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 1, 0], matrices[:, 1, 1],
+                                  matrices[:, 0, 2] / factor, matrices[:, 1, 2] / factor])
+
+        fileNames = [join(folderName, 'newst.com'),
+                     join(folderName, 'tilt.com'),
+                     join(folderName, '%s.tlt' % tsId),
+                     join(folderName, '%s.xtilt' % tsId),
+                     join(folderName, '%s.xf' % tsId)]
+        newstcomFile, tiltcomFile, tltFile, xtiltFile, xfFile = [self._getTmpFileName(fn) for fn in fileNames]
+        with open(newstcomFile, 'w') as f:
+            f.write(ts._getNewstcomContent(**kwargs))
+        with open(tiltcomFile, 'w') as f:
+            f.write(ts._getTiltcomContent(excludedViewsList, **kwargs))
+        np.savetxt(tltFile, tiltAngles, fmt='%s')
+        np.savetxt(xtiltFile, np.zeros(len(enabled)), fmt='%.2f')
+        # Same line terminator as the csv writer used by writeXfFile
+        np.savetxt(xfFile, xfData, fmt=['%.7f'] * 4 + ['%.3f'] * 2, delimiter=kwargs.get('delimiter', '\t'),
+                   newline='\r\n')
+        return fileNames
+
+    def flush(self) -> typing.List[str]:
+        """Syncs, if required, all the pending files and moves them to their final location.
+        :return: list with the final paths of the files.
+        """
+        if self._fsync:
+            for tmpFileName, _ in self._pending:
+                fd = os.open(tmpFileName, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        folders = set()
+        fileNames = []
+        for tmpFileName, fileName in self._pending:
+            os.replace(tmpFileName, fileName)
+            folders.add(dirname(os.path.abspath(fileName)))
+            fileNames.append(fileName)
+        if self._fsync:
+            # Persist the renames
+            for folder in folders:
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self._pending = []
+        return fileNames
+
+    def discard(self) -> None:
+        """Removes all the pending files."""
+        for tmpFileName, _ in self._pending:
+            if exists(tmpFileName):
+                os.remove(tmpFileName)
+        self._pending = []
+
+    def _getTmpFileName(self, fileName: str) -> str:
+        tmpFileName = '%s.%i%s' % (fileName, os.getpid(), self.TMP_SUFFIX)
+        self._pending.append((tmpFileName, fileName))
+        return tmpFileName
 
 
 class SetOfTiltSeriesBase(data.SetOfImages):
@@ -992,6 +1346,8 @@ class SetOfTiltSeriesBase(data.SetOfImages):
         self._interpolated = Boolean(False)
         # Used to check if a set is composed of elements with different dimensions, suche as the number of tilt-images
         self._isHeterogeneous = Boolean(False)
+        # In-memory tsId --> objId index, built lazily (see _getTsIdIndex)
+        self._tsIdIndex = None
 
     def getAcquisition(self):
         return self._acquisition
@@ -1043,20 +1399,36 @@ class SetOfTiltSeriesBase(data.SetOfImages):
                     if iterDisabled or img.isEnabled():
                         yield img
 
-    def _setItemMapperPath(self, item):
+    def _setItemMapperPath(self, item, lazy=True):
         """ Set the mapper path of this class according to the mapper
         path of the SetOfClasses and also the prefix according to class id
+        :param lazy: if True (default), the nested set of tilt-images is not loaded here but on the first access to
+        them (iterItems, getSize, __getitem__...), so reading only the tilt-series attributes does not open it.
         """
         item._mapperPath.set('%s,%s' % (self.getFileName(), item.getTsId()))
-        item.load()
+        if lazy:
+            # The mapper iterator may reuse the same item, so a mapper loaded for a previous tilt-series is discarded
+            item._mapper = None
+        else:
+            item.load()
 
     def _insertItem(self, item):
         """ Create the SetOfImages assigned to a class.
         If the file exists, it will load the Set.
         """
-        self._setItemMapperPath(item)
+        self._setItemMapperPath(item, lazy=False)
         data.EMSet._insertItem(self, item)
         item.write(properties=False)  # Set.write(self)
+        self._tsIdIndex = None
+
+    def close(self):
+        super().close()
+        # The set may be modified by other processes (e.g. streaming) before it is reopened
+        self._tsIdIndex = None
+
+    def loadAllProperties(self):
+        super().loadAllProperties()
+        self._tsIdIndex = None
 
     def __getitem__(self, itemId):
         """ Set the mapper of the TiltSerie (item) to point to the right table. The one with its own tilt images. """
@@ -1064,14 +1436,17 @@ class SetOfTiltSeriesBase(data.SetOfImages):
         self._setItemMapperPath(tiltSerie)
         return tiltSerie
 
-    def getFirstItem(self) -> TiltSeriesBase:
+    def getFirstItem(self, lazy=True) -> TiltSeriesBase:
         classItem = data.EMSet.getFirstItem(self)
-        self._setItemMapperPath(classItem)
+        self._setItemMapperPath(classItem, lazy=lazy)
         return classItem
 
-    def iterItems(self, **kwargs) -> TiltSeriesBase:
+    def iterItems(self, lazy=True, **kwargs) -> TiltSeriesBase:
+        """ Iterate over the tilt-series, setting the mapper path of each one to its own tilt-images table.
+        :param lazy: if True (default), the tilt-images table is opened on the first access to the tilt-images.
+        """
         for item in data.EMSet.iterItems(self, **kwargs):
-            self._setItemMapperPath(item)
+            self._setItemMapperPath(item, lazy=lazy)
             yield item
 
     def copyItems(self, inputTs,
@@ -1130,6 +1505,12 @@ class SetOfTiltSeriesBase(data.SetOfImages):
         self._hasOddEven.set(item.hasOddEven())
 
         super().update(item)
+        self._tsIdIndex = None
+
+    def write(self, properties=True):
+        """ Commit the changes, indexing the tsId column so the lookups by tsId do not scan the whole table. """
+        _createSqlIndex(self, TiltSeriesBase.TS_ID_FIELD)
+        super().write(properties=properties)
 
     def updateDim(self):
         """ Update dimensions of this set base on the first element. """
@@ -1143,13 +1524,98 @@ class SetOfTiltSeriesBase(data.SetOfImages):
         mag = self._acquisition.getMagnification()
         return self._samplingRate.get() * 1e-4 * mag
 
-    def getTiltSeriesFromTsId(self, tsId):
-        return self[{"_tsId": tsId}]
+    def _getTsIdIndex(self) -> typing.Dict[str, int]:
+        """ Returns a dictionary tsId --> objId of the tilt-series contained in the set. It is built with a single
+        sql projection the first time it is required and discarded when the set is modified (append or update),
+        closed or reloaded. """
+        if self._tsIdIndex is None:
+            if self.isEmpty():
+                return {}
+            rows = self.getUniqueValues(['id', TiltSeriesBase.TS_ID_FIELD])
+            self._tsIdIndex = dict(zip(rows[TiltSeriesBase.TS_ID_FIELD], rows['id']))
+        return self._tsIdIndex
+
+    def getTsIdIndex(self) -> typing.Dict[str, int]:
+        """ Returns a dictionary tsId --> objId of the tilt-series contained in the set, read from the in-memory
+        index (see _getTsIdIndex). """
+        return dict(self._getTsIdIndex())
+
+    def getTiltSeriesFromTsId(self, tsId) -> typing.Union[TiltSeriesBase, None]:
+        """ Returns the tilt-series with the given tsId or None if it is not present in the set. """
+        objId = self._getTsIdIndex().get(tsId, None)
+        return None if objId is None else self[objId]
 
     def getTSIds(self):
         """ Returns al the Tilt series ids involved in the set."""
         return self.getUniqueValues(TiltSeries.TS_ID_FIELD)
 
+    def toArrays(self, fields=None, orderBy='id') -> typing.Dict[str, typing.Dict[str, np.ndarray]]:
+        """ Returns the values of the given tilt-image attributes of all the tilt-series as numpy arrays. Each nested
+        table is read with a single sql query through the connection of this set, so neither the tilt-series nor the
+        tilt-images objects are built.
+        :param fields: list of tilt-image attributes to read. See TiltSeriesBase.toArrays.
+        :param orderBy: tilt-image attribute used to sort the values of each tilt-series.
+        :return: dictionary {tsId: {field: np.ndarray}}.
+        """
+        fields = fields or TiltImageBase.ARRAY_FIELDS
+        db = self._getMapper().db
+        return {tsId: _readColumnsAsArrays(db, fields, tablePrefix=self._getNestedTablePrefix(tsId), orderBy=orderBy)
+                for tsId in self._getTsIdIndex()}
+
+    @staticmethod
+    def _getNestedTablePrefix(tsId: str) -> str:
+        """ Returns the prefix of the tables in which the tilt-images of the tilt-series with the given tsId are
+        stored, following the mapper naming (see _setItemMapperPath). """
+        prefix = tsId.strip()
+        return prefix if prefix.endswith('_') else prefix + '_'
+
+    def fromArrays(self, arrays: typing.Dict[str, typing.Dict[str, np.ndarray]],
+                   tsTemplate: TiltSeriesBase = None, tiTemplate: TiltImageBase = None) -> None:
+        """ Bulk counterpart of toArrays. For each tsId, a tilt-series is appended to the set and its tilt-images are
+        inserted in its table with a single executemany (see appendItems).
+        :param arrays: dictionary {tsId: {field: np.ndarray}}, as returned by toArrays.
+        :param tsTemplate: optional tilt-series whose info is copied to all the tilt-series created.
+        :param tiTemplate: optional tilt-image whose info is copied to all the tilt-images created, before setting
+        the values of the given fields.
+        """
+        for tsId, tsArrays in arrays.items():
+            ts = self.ITEM_TYPE()
+            if tsTemplate is not None:
+                ts.copyInfo(tsTemplate)
+            ts.setTsId(tsId)
+            ts.setObjId(None)
+            self.append(ts)
+            appendItems(ts, self._iterTiFromArrays(ts, tsArrays, tiTemplate))
+            self.update(ts)
+
+    def _iterTiFromArrays(self, ts: TiltSeriesBase, tsArrays, tiTemplate=None):
+        """ Yields the tilt-images of a tilt-series with the values of the given arrays (see fromArrays). The same
+        tilt-image object is reused. """
+        ti = ts.ITEM_TYPE()
+        if tiTemplate is not None:
+            ti.copyInfo(tiTemplate, copyId=False)
+        ti.setTsId(ts.getTsId())
+        for i in range(len(next(iter(tsArrays.values()), []))):
+            ti.setObjId(None)
+            for field, values in tsArrays.items():
+                self._setTiArrayValue(ti, field, values[i])
+            yield ti
+
+    @staticmethod
+    def _setTiArrayValue(ti: TiltImageBase, field: str, value):
+        if field == 'id':
+            ti.setObjId(int(value))
+        elif field == TiltImageBase.ENABLED_FIELD:
+            ti.setEnabled(bool(value))
+        elif field == TiltImageBase.TRANSFORM_MATRIX_FIELD:
+            if ti.getTransform() is None:
+                ti.setTransform(Transform())
+            ti.getTransform().setMatrix(np.array(value, dtype=float))
+        elif not (isinstance(value, float) and math.isnan(value)):
+            if field.startswith('_acquisition.') and ti.getAcquisition() is None:
+                ti.setAcquisition(TomoAcquisition())
+            ti.setAttributeValue(field, value.item() if isinstance(value, np.generic) else value)
+
 
 class SetOfTiltSeries(SetOfTiltSeriesBase):
     ITEM_TYPE = TiltSeries
@@ -1222,6 +1688,176 @@ class SetOfTiltSeriesM(SetOfTiltSeriesBase):
         return '%s x %s' % (self._anglesCount, self._firstDim)
 
 
+class FileWatcher:
+    """ Detects the modifications of a file, e.g. the sqlite of a set that is being filled in streaming. The
+    inotify events of the file are used when available (Linux), so checking for changes does not require stating the
+    file and waiting for them does not require polling. Otherwise, the modification time and size of the file are
+    compared between checks.
+    """
+    # Only writes are watched: sqlite opens the file for writing even to read it, so the close events of the
+    # readers would be reported too
+    IN_MODIFY = 0x2
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    WATCH_MASK = IN_MODIFY | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, fileName, useInotify=True, pollInterval=1):
+        """
+        :param fileName: file to watch.
+        :param useInotify: if False, the polling fallback is used even if inotify is available.
+        :param pollInterval: seconds between checks while waiting for changes with the polling fallback.
+        """
+        self._fileName = fileName
+        self._pollInterval = pollInterval
+        self._lastStat = None
+        self._pending = True  # The first check always reports a change
+        self._libc = None
+        self._fd = None
+        if useInotify:
+            self._initInotify()
+        if not self.usesInotify():
+            self._statChanged()
+
+    def _initInotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            return
+        if fd < 0:
+            return
+        self._libc, self._fd = libc, fd
+        if not self._addWatch():
+            self.close()
+
+    def _addWatch(self):
+        """ Adds (or refreshes, if the file was replaced) the watch of the file. """
+        return self._libc.inotify_add_watch(self._fd, os.fsencode(self._fileName), self.WATCH_MASK) >= 0
+
+    def usesInotify(self):
+        return self._fd is not None
+
+    def _checkChanges(self):
+        return self._drainEvents() if self.usesInotify() else self._statChanged()
+
+    def hasChanged(self):
+        """ Returns True if the file has been modified since the previous call (always True the first time). """
+        changed = self._checkChanges() or self._pending
+        self._pending = False
+        return changed
+
+    def wait(self, timeout):
+        """ Blocks until the file is modified or the timeout (in seconds) expires. The modification is still
+        reported by the next call to hasChanged.
+        :return: True if the file was modified.
+        """
+        if not self._pending:
+            if self.usesInotify():
+                select.select([self._fd], [], [], timeout)
+                self._pending = self._drainEvents()
+            else:
+                end = time.time() + timeout
+                while not self._statChanged():
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    time.sleep(min(self._pollInterval, remaining))
+                self._pending = True
+        return self._pending
+
+    def _drainEvents(self):
+        changed = False
+        while True:
+            try:
+                if not os.read(self._fd, 4096):
+                    break
+                changed = True
+            except BlockingIOError:
+                break
+        if changed and not self._addWatch():
+            # The file has been removed, so its modification time will be checked until it exists again
+            self.close()
+        return changed
+
+    def _statChanged(self):
+        try:
+            stat = os.stat(self._fileName)
+            currentStat = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            currentStat = None
+        changed = currentStat != self._lastStat
+        self._lastStat = currentStat
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SetOfTiltSeriesReader:
+    """ Incremental reader of a set of tilt-series that is being filled in streaming. It remembers the highest objId
+    read from the tilt-series table and from the table of the tilt-images of each tilt-series, so each read only
+    queries the rows added since the previous one.
+    """
+
+    def __init__(self, fileName, setClass=None):
+        """
+        :param fileName: sqlite file of the set.
+        :param setClass: class of the set (SetOfTiltSeries by default).
+        """
+        self._fileName = fileName
+        self._setClass = setClass or SetOfTiltSeries
+        self._lastTsId = 0
+        self._tsObjIds = OrderedDict()  # tsId --> objId of the tilt-series read
+        self._lastTiIds = {}  # tsId --> highest objId of the tilt-images read
+        self._streamClosed = False
+        self.readCount = 0  # Number of rows read by the last call to read
+
+    def isStreamClosed(self):
+        return self._streamClosed
+
+    def read(self, ignoreTsIds=()):
+        """ Reads the tilt-series and tilt-images added to the set since the previous call.
+        :param ignoreTsIds: tsIds whose new tilt-images are not required. Their tilt-series rows are consumed anyway.
+        :return: tuple (newTsList, newTiDict), with the list of tilt-series added (only their info is copied, not
+        their tilt-images) and an ordered dictionary {tsId: list of tilt-images clones} with the tilt-images added
+        to both the new and the previously read tilt-series.
+        """
+        self.readCount = 0
+        inputSet = self._setClass(filename=self._fileName)
+        try:
+            inputSet.loadAllProperties()
+            newTsList = []
+            for ts in inputSet.iterItems(where='id > %d' % self._lastTsId):
+                self.readCount += 1
+                self._lastTsId = ts.getObjId()
+                self._tsObjIds[ts.getTsId()] = ts.getObjId()
+                if ts.getTsId() not in ignoreTsIds:
+                    newTs = TiltSeries()
+                    newTs.copyInfo(ts)
+                    newTsList.append(newTs)
+
+            newTiDict = OrderedDict()
+            for tsId, tsObjId in self._tsObjIds.items():
+                if tsId in ignoreTsIds:
+                    continue
+                # Only the mapper path is required to query the nested table, so the tilt-series row is not read
+                ts = inputSet.ITEM_TYPE(tsId=tsId)
+                ts.setObjId(tsObjId)
+                inputSet._setItemMapperPath(ts)
+                lastTiId = self._lastTiIds.get(tsId, 0)
+                tiList = [ti.clone() for ti in ts.iterItems(where='id > %d' % lastTiId)]
+                if tiList:
+                    self.readCount += len(tiList)
+                    self._lastTiIds[tsId] = tiList[-1].getObjId()
+                    newTiDict[tsId] = tiList
+            self._streamClosed = inputSet.isStreamClosed()
+        finally:
+            inputSet.close()
+        return newTsList, newTiDict
+
+
 class TiltSeriesDict:
     """ Helper class that to store TiltSeries and TiltImage but
     using dictionaries for quick access.
@@ -1246,7 +1882,8 @@ class TiltSeriesDict:
         self.__inputSet = inputSet
         if inputSet is not None:
             self.__inputClosed = inputSet.isStreamClosed()
-        self.__lastCheck = None
+        self.__inputWatcher = None
+        self.__inputReader = None
         self.__finalCheck = False
         self.__newItemsCallback = newItemsCallback
         self.__doneItemsCallback = doneItemsCallback
@@ -1294,33 +1931,47 @@ class TiltSeriesDict:
             yield ts
 
     # ---- Streaming related methods -------------
-    def update(self):
+    def update(self, timeout=0):
+        """ Checks for new input items and for items done.
+        :param timeout: if greater than 0, seconds to wait for modifications of the input set before checking it.
+        """
+        if timeout > 0:
+            self.waitForInput(timeout)
         self._checkNewInput()
         self._checkNewOutput()
 
+    def _getInputWatcher(self):
+        if self.__inputWatcher is None:
+            inputSetFn = self.__inputSet.getFileName()
+            self.__inputWatcher = FileWatcher(inputSetFn)
+            self.__inputReader = SetOfTiltSeriesReader(inputSetFn, self.__inputSet.getClass())
+        return self.__inputWatcher
+
+    def waitForInput(self, timeout):
+        """ Blocks until the input set is modified (woken by inotify if available) or the timeout expires.
+        The modification is still reported to the next input check. """
+        self._getInputWatcher().wait(timeout)
+
     def _checkNewInput(self):
         logging.debug("TiltSeriesDict._checkNewInput called.")
 
-        inputSetFn = self.__inputSet.getFileName()
-        mTime = datetime.fromtimestamp(os.path.getmtime(inputSetFn))
-        # if self.__lastCheck:
-        # print('Last check: %s, modification: %s'
-        #       % (pwutils.prettyTime(self.__lastCheck),
-        #          pwutils.prettyTime(mTime)))
-
-        if self.__lastCheck is None or self.__lastCheck <= mTime:
-            updatedSet = self.__inputSet.getClass()(filename=inputSetFn)
-            updatedSet.loadAllProperties()
+        if self._getInputWatcher().hasChanged():
+            # Only the tilt-series and tilt-images added since the previous check are read
+            newTsList, newTiDict = self.__inputReader.read(ignoreTsIds=self.__done)
             newItems = []
-            for ts in updatedSet:
-                if not self.hasTs(ts.getTsId()):
-                    self.addTs(ts, includeTi=True)
-                    newItems.append(ts.getTsId())
-            self.__inputClosed = updatedSet.isStreamClosed()
-            updatedSet.close()
+            for ts in newTsList:
+                tsId = ts.getTsId()
+                if not self.hasTs(tsId):
+                    self.__dict[tsId] = (ts, OrderedDict())
+                    newItems.append(tsId)
+            for tsId, tiList in newTiDict.items():
+                if self.hasTs(tsId):
+                    tiDict = self.getTiDict(tsId)
+                    for ti in tiList:
+                        tiDict[ti.getObjId()] = ti
+            self.__inputClosed = self.__inputReader.isStreamClosed()
             if newItems:
                 self.__newItemsCallback(newItems)
-        self.__lastCheck = datetime.now()
 
     def _checkNewOutput(self):
         logger.debug("TiltSeriesDict._checkNewOutput")
@@ -1832,6 +2483,8 @@ class SetOfCoordinates3D(data.EMSet):
     The SetOfCoordinates3D can also have information about TiltPairs.
     """
     ITEM_TYPE = Coordinate3D
+    # Maximum number of tsIds per query when loading the precedents
+    PRECEDENTS_CHUNK = 500
 
     def __init__(self, **kwargs):
         data.EMSet.__init__(self, **kwargs)
@@ -1839,6 +2492,8 @@ class SetOfCoordinates3D(data.EMSet):
         self._samplingRate = Float()
         self._precedentsPointer = Pointer()
         self._tomos = None
+        # tsIds of the tomograms involved, memoised until the set is modified (see getTSIds)
+        self._tsIds = None
 
     def getBoxSize(self):
         """ Return the box size of the particles.
@@ -1911,16 +2566,63 @@ class SetOfCoordinates3D(data.EMSet):
             self._associateVolume(coord)
             yield coord
 
+    def iterCoordinatesByTomogram(self, orderBy='id'):
+        """ Iterates over the tomograms involved in the set, ordered by tsId, together with their coordinates. The
+        coordinates are read with a single query sorted by tomoId, instead of one query per tomogram.
+
+        Example:
+
+            >>> for tomo, coords in coordSet.iterCoordinatesByTomogram():
+            >>>     positions = [coord.getPosition(BOTTOM_LEFT_CORNER) for coord in coords]
+
+        :param orderBy: attribute used to sort the coordinates of each tomogram.
+        :return: generator of (tomogram, coordinates iterator) pairs. As in iterCoordinates, the same coordinate
+        object is reused, and the coordinates of a tomogram are no longer available once the next pair is requested.
+        """
+        tomoIdAttr = Coordinate3D.TOMO_ID_ATTR
+        coords = self.iterItems(orderBy=[tomoIdAttr, orderBy])
+        for tsId, tomoCoords in itertools.groupby(coords, key=lambda coord: coord.getTomoId()):
+            tomo = self._getTomogram(tsId)
+            yield tomo, self._iterAssociated(tomoCoords, tomo)
+
+    @staticmethod
+    def _iterAssociated(coords, tomo):
+        for coord in coords:
+            coord.setVolume(tomo)
+            yield coord
+
     def _getTomogram(self, tsId):
-        """ Returns  the tomogram from a tsId"""
+        """ Returns  the tomogram from a tsId. The first time a tomogram is missing, all the tomograms involved in
+        the set are loaded at once (see _loadTomograms)."""
         tomos = self._getTomograms()
 
-        if tsId not in tomos.keys():
-            tomo = self.getPrecedents()[{Tomogram.TS_ID_FIELD: tsId}]
-            self._tomos[tsId] = tomo
-            return tomo
-        else:
-            return self._tomos[tsId]
+        if tsId not in tomos:
+            self._loadTomograms(self.getTSIds())
+            if tsId not in tomos:
+                self._loadTomograms([tsId])
+        return tomos.get(tsId, None)
+
+    def _loadTomograms(self, tsIds):
+        """ Reads the precedents with the given tsIds that are not loaded yet, in chunks of at most PRECEDENTS_CHUNK
+        tsIds, and registers them in the internal _tomos. The tsIds of each chunk are bound to a WHERE _tsId IN (?, ...)
+        query that gives the ids of their precedents, which are then read with a single iterItems. """
+        tomos = self._getTomograms()
+        tsIds = [tsId for tsId in tsIds if tsId not in tomos]
+        if not tsIds:
+            return
+        precedents = self.getPrecedents()
+        db = precedents._getMapper().db
+        tsIdCol = db._getRealCol(Tomogram.TS_ID_FIELD)
+        if tsIdCol is None:
+            return
+        for start in range(0, len(tsIds), self.PRECEDENTS_CHUNK):
+            chunk = tsIds[start:start + self.PRECEDENTS_CHUNK]
+            rows = db.connection.execute('SELECT id FROM "%sObjects" WHERE %s IN (%s)'
+                                         % (db.tablePrefix, tsIdCol, ', '.join('?' * len(chunk))), chunk)
+            objIds = [row[0] for row in rows]
+            if objIds:
+                for tomo in precedents.iterItems(where='id IN (%s)' % ', '.join(map(str, objIds))):
+                    tomos[tomo.getTsId()] = tomo.clone()
 
     def _getTomograms(self):
         if self._tomos is None:
@@ -1934,7 +2636,10 @@ class SetOfCoordinates3D(data.EMSet):
         return self._precedentsPointer.get()
 
     def getPrecedent(self, tomoId):
-        return self.getPrecedentsInvolved()[tomoId]
+        tomo = self._getTomogram(tomoId)
+        if tomo is None:
+            raise KeyError(tomoId)
+        return tomo
 
     def setPrecedents(self, precedents):
         """ Set the tomograms  or Tilt Series associated with this set of coordinates.
@@ -1945,6 +2650,7 @@ class SetOfCoordinates3D(data.EMSet):
             self._precedentsPointer.copy(precedents)
         else:
             self._precedentsPointer.set(precedents)
+        self._tomos = None
 
     def getFiles(self):
         filePaths = set()
@@ -1998,28 +2704,94 @@ class SetOfCoordinates3D(data.EMSet):
             self._tomos = dict()
 
     def getPrecedentsInvolved(self):
-        """ Returns a list  with only the tomograms involved in the subtomograms. May differ when
-        subsets are done."""
-
-        tomoId_attr = Coordinate3D.TOMO_ID_ATTR
-
-        uniqueTomos = self.aggregate(['count'], tomoId_attr, [tomoId_attr])
-
-        for row in uniqueTomos:
-            tsId = row[tomoId_attr]
-            # This should register the tomogram in the internal _tomos
-            self._getTomogram(tsId)
-
-        return self._tomos
+        """ Returns a dictionary tsId --> tomogram with only the tomograms involved in the coordinates. May differ
+        when subsets are done."""
+        tsIds = self.getTSIds()
+        self._loadTomograms(tsIds)
+        return {tsId: self._tomos[tsId] for tsId in tsIds if tsId in self._tomos}
 
     def append(self, item: Coordinate3D):
         if self.getBoxSize() is None and item._boxSize:
             self.setBoxSize(item._boxSize)
         super().append(item)
+        self._tsIds = None
+
+    def update(self, item: Coordinate3D):
+        super().update(item)
+        self._tsIds = None
+
+    def close(self):
+        super().close()
+        # The set may be modified by other processes (e.g. streaming) before it is reopened
+        self._tsIds = None
+
+    def loadAllProperties(self):
+        super().loadAllProperties()
+        self._tsIds = None
 
     def getTSIds(self):
-        """ Returns all the TS ID (tomoId) present in this set"""
-        return self.getUniqueValues(Coordinate3D.TOMO_ID_ATTR)
+        """ Returns all the TS ID (tomoId) present in this set. They are read with a single query the first time
+        they are required and memoised until the set is modified (append or update), closed or reloaded. The query
+        runs in its own cursor, so the tomograms can be loaded while the coordinates are being iterated."""
+        if self._tsIds is None:
+            db = self._getMapper().db
+            tomoIdCol = db._getRealCol(Coordinate3D.TOMO_ID_ATTR)
+            if tomoIdCol is None:
+                return []
+            rows = db.connection.execute('SELECT DISTINCT %s FROM "%sObjects"' % (tomoIdCol, db.tablePrefix))
+            self._tsIds = [row[0] for row in rows]
+        return list(self._tsIds)
+
+    def getPositions(self, originFunction, tsId=None) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """ Bulk counterpart of Coordinate3D.getPosition. The positions are read with a single query and the origin
+        of each tomogram is resolved only once, instead of three times per coordinate.
+        :param originFunction: function to refer the positions to a given origin (see Coordinate3D.getPosition).
+        :param tsId: if provided, only the coordinates of this tomogram are returned.
+        :return: (N, 3) array of (x, y, z) positions and array of the objIds of the coordinates, sorted by objId.
+        """
+        where = None if tsId is None else {Coordinate3D.TOMO_ID_ATTR: tsId}
+        arrays = _readColumnsAsArrays(self._getMapper().db, ['id', Coordinate3D.TOMO_ID_ATTR, '_x', '_y', '_z'],
+                                      where=where)
+        positions = np.column_stack([arrays[field] for field in ['_x', '_y', '_z']])
+        positions -= self._getOriginOffsets(arrays[Coordinate3D.TOMO_ID_ATTR], originFunction)
+        return positions, arrays['id']
+
+    def setPositions(self, objIds, positions, originFunction) -> None:
+        """ Bulk counterpart of Coordinate3D.setPosition: updates the positions of the given coordinates with a single
+        executemany. As with update, call write to persist the changes.
+        :param objIds: objIds of the coordinates to update.
+        :param positions: (N, 3) array of their new (x, y, z) positions.
+        :param originFunction: function that gives the origin to which the positions are referred.
+        """
+        objIds = np.asarray(objIds, dtype=int)
+        db = self._getMapper().db
+        arrays = _readColumnsAsArrays(db, ['id', Coordinate3D.TOMO_ID_ATTR])
+        if not np.all(np.isin(objIds, arrays['id'])):
+            raise Exception('Some of the objIds to update are not in the set of coordinates.')
+        rows = np.searchsorted(arrays['id'], objIds)
+        positions = np.asarray(positions, dtype=float) + \
+            self._getOriginOffsets(arrays[Coordinate3D.TOMO_ID_ATTR][rows], originFunction)
+        db.cursor.executemany('UPDATE "%sObjects" SET %s WHERE id=?'
+                              % (db.tablePrefix, ', '.join('%s=?' % db._getRealCol(field)
+                                                           for field in ['_x', '_y', '_z'])),
+                              zip(*positions.T.tolist(), objIds.tolist()))
+
+    def _getOriginOffsets(self, tomoIds: np.ndarray, originFunction) -> np.ndarray:
+        """ Returns the (N, 3) offsets subtracted from the stored positions of coordinates of the given tomoIds to
+        refer them to the origin given by originFunction (see Coordinate3D._getOffset), resolving the origin of each
+        tomogram only once. """
+        if originFunction == const.SCIPION:
+            return np.zeros((len(tomoIds), 3))
+        tomoIndices = {}
+        codes = np.array([tomoIndices.setdefault(tomoId, len(tomoIndices)) for tomoId in tomoIds.tolist()], dtype=int)
+        tomoOffsets = np.zeros((len(tomoIndices), 3))
+        for tomoId, i in tomoIndices.items():
+            tomo = self._getTomogram(tomoId)
+            originScipion = np.array(tomo.getShiftsFromOrigin()) / tomo.getSamplingRate()
+            origin = originFunction(tomo.getDim())
+            origin = -originScipion if origin is None else np.array(origin, dtype=float)
+            tomoOffsets[i] = origin + originScipion
+        return tomoOffsets[codes].reshape(-1, 3)
 
 
 class SubTomogram(data.Volume):
@@ -2030,6 +2802,7 @@ class SubTomogram(data.Volume):
 
     VOL_NAME_FIELD = "_volName"
     COORD_VOL_NAME_FIELD = "_coordinate.%s" % Coordinate3D.TOMO_ID_ATTR
+    TRANSFORM_MATRIX_FIELD = '_transform._matrix'
 
     def __init__(self, **kwargs):
         data.Volume.__init__(self, **kwargs)
@@ -2263,6 +3036,36 @@ class SetOfSubTomogramsBase(data.SetOfVolumes):
         if self._tomos is None:
             self._tomos = dict()
 
+    def getTransformStack(self, convention=None) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """ Bulk counterpart of SubTomogram.getTransform: reads the transformation matrices of all the subtomograms
+        with a single query and converts them at once (see convertMatrices).
+        :param convention: convention of the returned matrices (see convertMatrix).
+        :return: (N, 4, 4) array with the matrices and array with the objIds of the subtomograms, sorted by objId.
+        """
+        arrays = _readColumnsAsArrays(self._getMapper().db, ['id', SubTomogram.TRANSFORM_MATRIX_FIELD], matrixDim=4)
+        return (convertMatrices(arrays[SubTomogram.TRANSFORM_MATRIX_FIELD], direction=const.GET,
+                                convention=convention), arrays['id'])
+
+    def setTransformStack(self, objIds, matrices, convention=None) -> None:
+        """ Bulk counterpart of SubTomogram.setTransform: converts the given matrices at once and updates the
+        transformations of the given subtomograms with a single executemany. As with update, call write to persist
+        the changes.
+        :param objIds: objIds of the subtomograms to update.
+        :param matrices: (N, 4, 4) array with their new transformation matrices.
+        :param convention: convention of the given matrices (see convertMatrix).
+        """
+        objIds = np.asarray(objIds, dtype=int)
+        db = self._getMapper().db
+        matrixCol = db._getRealCol(SubTomogram.TRANSFORM_MATRIX_FIELD)
+        if matrixCol is None:
+            raise Exception('The subtomograms of this set have no transformation.')
+        if not np.all(np.isin(objIds, _readColumnsAsArrays(db, ['id'])['id'])):
+            raise Exception('Some of the objIds to update are not in the set of subtomograms.')
+        matrices = convertMatrices(matrices, direction=const.SET, convention=convention)
+        # Stored as Matrix.getObjValue does
+        db.cursor.executemany('UPDATE "%sObjects" SET %s=? WHERE id=?' % (db.tablePrefix, matrixCol),
+                              zip(map(json.dumps, matrices.tolist()), objIds.tolist()))
+
     def getTomograms(self):
         """ Returns a list  with only the tomograms involved in the subtomograms. May differ when
         subsets are done."""
@@ -2460,6 +3263,27 @@ class LandmarkModel(data.EMObject):
 
             self._registerChain(chainId)
 
+    def addLandmarks(self, xCoors, yCoors, tiltIms, chainIds, xResids, yResids):
+        """ Bulk counterpart of addLandmark: writes all the given landmarks (one per element of the input arrays, or
+        scalars shared by all of them) opening the file only once. The file content is the same as if they were added
+        one by one with addLandmark."""
+        columns = np.broadcast_arrays(*[np.asarray(col, dtype=object if col is None else None)
+                                        for col in (xCoors, yCoors, tiltIms, chainIds, xResids, yResids)])
+        if columns[0].size == 0:
+            return
+
+        mode = "a" if os.path.exists(self.getFileName()) else "w"
+
+        with open(self.getFileName(), mode) as f:
+            writer = csv.writer(f, delimiter='\t')
+            if mode == "w":
+                writer.writerow(['xCoor', 'yCoor', 'tiltIm', 'chainId', 'xResid', 'yResid'])
+            # Converted to python scalars, so they are formatted as in addLandmark
+            writer.writerows(zip(*[col.ravel().tolist() for col in columns]))
+
+        for chainId in dict.fromkeys(columns[3].ravel().tolist()):
+            self._registerChain(chainId)
+
     def _registerChain(self, chainId):
         """ registers new chainId in a dictionary to later on store the chain count"""
 
@@ -2962,6 +3786,8 @@ class CTFTomoSeries(data.EMSet):
         # CtfModels will always be used inside a SetOfTiltSeries
         # so, let's do not store the mapper path by default
         self._mapperPath.setStore(False)
+        # In-memory acqOrder (or index) --> CTFTomo index, built lazily (see _getCtfTomoIndex)
+        self._ctfTomoIndex = None
 
     def clone(self, ignoreAttrs=('_mapperPath', '_size')):
         clone = self.getClass()()
@@ -3088,6 +3914,38 @@ class CTFTomoSeries(data.EMSet):
     def calculateDefocusVDeviation(self, defocusVTolerance=20):
         pass
 
+    def append(self, item):
+        super().append(item)
+        self._ctfTomoIndex = None
+
+    def update(self, item):
+        super().update(item)
+        self._ctfTomoIndex = None
+
+    def _getCtfTomoIndex(self) -> typing.Tuple[str, typing.Dict[int, CTFTomo]]:
+        """ Returns the field used to match the tilt-images (acquisition order or, in old CTF series without it, index)
+        and a dictionary value --> CTFTomo of the CTF models of the series. It is built with a single iteration the first
+        time it is required and discarded when the series is modified (append or update) or its items are read from a
+        different table (the items of a SetOfCTFTomoSeries may be reused). """
+        mapperPath = self._mapperPath.get()
+        if self._ctfTomoIndex is None or self._ctfTomoIndex[0] != mapperPath:
+            acqOrderDict, indexDict = {}, {}
+            for ctfTomo in self.iterItems():
+                ctfTomo = ctfTomo.clone()
+                # The first CTF by id is kept in case of repeated values, as getItem does
+                acqOrderDict.setdefault(ctfTomo.getAcquisitionOrder(), ctfTomo)
+                indexDict.setdefault(ctfTomo.getIndex(), ctfTomo)
+            acqOrderDict.pop(None, None)
+            if acqOrderDict or not indexDict:
+                field, ctfTomoDict = CTFTomo.ACQ_ORDER_FIELD, acqOrderDict
+            else:
+                logger.warning('WARNING! The current CTF series does not have the attribute "acquisition order" '
+                               '(_acqOrder). The matching between the CTF and the tilt-image is carried out '
+                               'using the index --> LESS RELIABLE. CHECK THE RESULTS CAREFULLY')
+                field, ctfTomoDict = CTFTomo.INDEX_FIELD, indexDict
+            self._ctfTomoIndex = (mapperPath, field, ctfTomoDict)
+        return self._ctfTomoIndex[1:]
+
     def getCtfTomoFromTi(self, ti: TiltImage, onlyEnabled: bool = True) -> Optional[CTFTomo]:
         """Get the corresponding CTFModel from a given tilt-image. If there's no match, it returns None.
         :param ti: Tilt-image.
@@ -3095,33 +3953,36 @@ class CTFTomoSeries(data.EMSet):
         _objEnabled from both ti and the matching CTFModel attribute:
             - If True (default), the CTFModel found is returned only if both the ti and the CTFModel are enabled.
             - If False, the CTFModel found is returned no matter the value of _objEnabled.
+        The CTF models are read from an in-memory index of the series and a copy of them is returned, so they can be
+        modified without altering the index.
         """
         if onlyEnabled and not ti.isEnabled():
             logger.debug('The introduced tilt-image is not enabled and working with onlyEnabled = True')
             return None
-        try:
-            # The method getItem raises an exception of type:
-            #   - sqlite3.OperationalError if the key is not found
-            #   - UnboundLocalError if the value is not found
-            ctfTomo = self.getItem(CTFTomo.ACQ_ORDER_FIELD, ti.getAcquisitionOrder())
-        except UnboundLocalError:
-            return None
-        except OperationalError:
-            try:
-                ctfTomo = self.getItem(CTFTomo.INDEX_FIELD, ti.getIndex())
-                logger.warning('WARNING! The current CTF series does not have the attribute "acquisition order" '
-                               '(_acqOrder). The matching between the CTF and the tilt-image is carried out '
-                               'using the index --> LESS RELIABLE. CHECK THE RESULTS CAREFULLY')
-            except (OperationalError, UnboundLocalError):
+        field, ctfTomoDict = self._getCtfTomoIndex()
+        if field == CTFTomo.ACQ_ORDER_FIELD:
+            ctfTomo = ctfTomoDict.get(ti.getAcquisitionOrder())
+        else:
+            ctfTomo = ctfTomoDict.get(ti.getIndex())
+            if ctfTomo is None:
                 logger.warning(f'No CTF found in the current CTF series {self.getTsId()} that matches the '
                                f'given tilt-image of tsId = {ti.getTsId()}.')
                 return None
 
-        if ctfTomo.isEnabled() or not onlyEnabled:
-            return ctfTomo
+        if ctfTomo is not None and (ctfTomo.isEnabled() or not onlyEnabled):
+            return ctfTomo.clone()
         else:
             return None
 
+    def getCtfTomosForTs(self, ts: TiltSeries, onlyEnabled: bool = True) -> typing.List[Optional[CTFTomo]]:
+        """Get the corresponding CTFModels of all the tilt-images of a given tilt-series, in the same order as they
+        are iterated. The CTF series is read only once, so it is preferred to calling getCtfTomoFromTi for each
+        tilt-image.
+        :param ts: Tilt-series.
+        :param onlyEnabled: same behavior as in getCtfTomoFromTi. The non-matching positions of the list are None.
+        """
+        return [self.getCtfTomoFromTi(ti, onlyEnabled=onlyEnabled) for ti in ts.iterItems()]
+
     def getFirstEnabledItem(self) -> typing.Union[CTFTomo, None]:
         for item in self.iterItems():
             ti = item.clone()
@@ -3138,7 +3999,6 @@ class SetOfCTFTomoSeries(data.EMSet):
     def __init__(self, **kwargs):
         data.EMSet.__init__(self, **kwargs)
         self._setOfTiltSeriesPointer = Pointer(kwargs.get('tiltSeriesPointer', None))
-        self._idDict = {}
 
     def copyInfo(self, other):
         data.EMSet.copyInfo(self, other)
@@ -3205,15 +4065,11 @@ class SetOfCTFTomoSeries(data.EMSet):
         """ Setup the mapper classes before returning the item. """
         classItem = data.EMSet.__getitem__(self, itemId)
 
-        objId = None
-        for tiltSeries in self.getSetOfTiltSeries().iterItems(iterate=False):
-            if tiltSeries.getTsId() == classItem.getTsId():
-                objId = tiltSeries.getObjId()
-
-        if objId is None:
-            raise ("Could not find tilt-series with tsId = %s" % classItem.getTsId())
+        ts = self._getTiltSeriesFromTsId(classItem.getTsId())
+        if ts is None:
+            raise Exception("Could not find tilt-series with tsId = %s" % classItem.getTsId())
 
-        classItem.setTiltSeries(self.getSetOfTiltSeries()[objId])
+        classItem.setTiltSeries(ts)
 
         self._setItemMapperPath(classItem)
         return classItem
@@ -3238,11 +4094,15 @@ class SetOfCTFTomoSeries(data.EMSet):
             yield item
 
     def _getTiltSeriesFromTsId(self, tsId):
-        ts = self._idDict.get(tsId, None)
-        if ts is None:
-            self._idDict = {ts.getTsId(): ts.clone() for ts in self.getSetOfTiltSeries()}
-            ts = self._idDict.get(tsId, None)
-        return ts
+        """ Returns a copy of the tilt-series with the given tsId or None if it is not present. Only its row is read,
+        through the tsId --> objId index of the set of tilt-series, so the whole set is not loaded (nor cloned). """
+        ts = self.getSetOfTiltSeries().getTiltSeriesFromTsId(tsId)
+        return None if ts is None else ts.clone()
+
+    def write(self, properties=True):
+        """ Commit the changes, indexing the tsId column so the lookups by tsId do not scan the whole table. """
+        _createSqlIndex(self, CTFTomoSeries.TS_ID_FIELD)
+        super().write(properties=properties)
 
     def getTSIds(self):
         """ Returns al the Tilt series ids involved in the set."""
@@ -23,10 +23,14 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import fnmatch
 import logging
+import math
+import os
 import re
-from glob import glob
-from os.path import join, getmtime
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob, has_magic
+from os.path import join
 
 import pyworkflow as pw
 from pyworkflow.protocol.params import (PointerParam, EnumParam, PathParam,
@@ -311,12 +315,8 @@ class ProtTomoImportFiles(ProtImportFiles, ProtTomoBase):
         return allowedFiles
 
     def getMatchingFilesFromRegEx(self):
-        filePaths = glob(self.globPattern)
-        filePaths = self._excludeByWords(filePaths)
-        filePaths.sort(key=lambda fn: getmtime(fn))
         matchingFilesDict = dict()
-        for f in filePaths:
-            matchRes = self.regEx.match(f)
+        for f, matchRes in self._scanFiles(self.globPattern, self.regEx):
             if matchRes is not None:
                 tsId = matchRes.group('TS')  # Return the complete matched subgroup
                 logger.info("Raw tilt series id is %s." % tsId)
@@ -325,6 +325,48 @@ class ProtTomoImportFiles(ProtImportFiles, ProtTomoBase):
                 matchingFilesDict[tsId] = f
         return matchingFilesDict
 
+    def _scanFiles(self, globPattern, regEx=None, workers=1):
+        """ Returns the files matching the glob pattern, not containing any of the exclusion words and sorted by
+        modification time, as a list of tuples (fileName, regEx match or None). It is equivalent to globbing and
+        stating each file, but each directory is listed once with os.scandir, the regEx is matched in the same
+        pass and the files are stated in a pool of the given number of threads. """
+        dirPattern, namePattern = os.path.split(globPattern)
+        if not namePattern:
+            fileNames = self._excludeByWords(glob(globPattern))
+            fileNames.sort(key=os.path.getmtime)
+            return [(f, regEx.match(f) if regEx else None) for f in fileNames]
+
+        dirNames = (glob(dirPattern) if has_magic(dirPattern) else [dirPattern]) if dirPattern else ['']
+        nameRegEx = re.compile(fnmatch.translate(namePattern))
+        hidden = namePattern.startswith('.')  # As glob, only list hidden files if explicitly requested
+        entries = []
+        for dirName in dirNames:
+            try:
+                with os.scandir(dirName or os.curdir) as it:
+                    for entry in it:
+                        if (hidden or not entry.name.startswith('.')) and nameRegEx.match(entry.name):
+                            fileName = join(dirName, entry.name) if dirName else entry.name
+                            entries.append((fileName, entry, regEx.match(fileName) if regEx else None))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+        allowedFiles = set(self._excludeByWords([entry[0] for entry in entries]))
+        entries = [entry for entry in entries if entry[0] in allowedFiles]
+
+        def _getMTimes(chunk):
+            return [entry.stat().st_mtime for _, entry, _ in chunk]
+
+        if workers > 1 and len(entries) > 1:
+            chunkSize = math.ceil(len(entries) / (4 * workers))
+            chunks = [entries[i:i + chunkSize] for i in range(0, len(entries), chunkSize)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                mTimes = [mTime for chunkMTimes in executor.map(_getMTimes, chunks) for mTime in chunkMTimes]
+        else:
+            mTimes = _getMTimes(entries)
+
+        # The sort is stable, so files with the same modification time keep the listing order, as with glob
+        order = sorted(range(len(entries)), key=mTimes.__getitem__)
+        return [(entries[i][0], entries[i][2]) for i in order]
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
@@ -25,12 +25,16 @@
 
 import time
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dbm.dumb import error
 from glob import glob
 from logging import exception
 from statistics import mean
 
-from pwem.emlib.image.image_readers import ImageStack, ImageReadersRegistry
+import mrcfile
+import numpy as np
+from pwem.emlib.image.image_readers import ImageReadersRegistry
 from pwem.protocols.protocol_import.base import ProtImport
 import pyworkflow as pw
 from pyworkflow.protocol import params, ProtStreamingBase
@@ -62,7 +66,10 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
         self.TiltSeries = None
         self.time4NextTS_current = time.time()
         self.timeNextLoop = 30
-        self.listTSComposed = []
+        self.composedMdocs = set()
+        self.bannedMdocs = set()
+        self.micsDict = {}  # Normalised base name --> micrograph
+        self.lastMicId = 0
         self.ih = None
         self.inMicsAcq = None
 
@@ -145,20 +152,7 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
 
         while streamOpen:
             streamOpen = inputSet.isStreamOpen()
-            list_current = self.findMdocs()
-            self._loadInputList()
-            list_current = [f for f in list_current if f not in self.listTSComposed]
-            self.info(f'\n{self.separator2}\nList of mdocs available to compose: {list_current}')
-            for mdocFile in list_current:
-                # Exclusion
-                if self.isMdocBanned(mdocFile):
-                    self.info(f'Mdoc banned: {mdocFile}')
-                    continue
-                try:
-                    self.readMdoc(mdocFile, streamOpen)
-                except Exception as e:
-                    print(f'mdocFile = {mdocFile} reading failed! Error message {e} Skipping...')
-                    continue
+            self.composeAvailableTS(streamOpen)
             if streamOpen:
                 time.sleep(self.timeNextLoop)
                 inputSet.loadAllProperties()
@@ -170,12 +164,37 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
 
 
     # -------------------------- MAIN FUNCTIONS -----------------------
+    def composeAvailableTS(self, streamOpen):
+        """
+        Streaming poll: loads the new micrographs and tries to compose the tilt series
+        of the mdoc files not composed yet
+
+        :param streamOpen: Bool for the setOfMics status (open or closed)
+        """
+        list_current = self.findMdocs()
+        self._loadInputList()
+        self.info(f'\n{self.separator2}\nList of mdocs available to compose: {list_current}')
+        for mdocFile in list_current:
+            # Exclusion
+            if self.isMdocBanned(mdocFile):
+                self.info(f'Mdoc banned: {mdocFile}')
+                self.bannedMdocs.add(mdocFile)
+                continue
+            try:
+                self.readMdoc(mdocFile, streamOpen)
+            except Exception as e:
+                print(f'mdocFile = {mdocFile} reading failed! Error message {e} Skipping...')
+                continue
+
     def findMdocs(self):
         """
-        :return: return a sorted by date list of all mdoc files in the path
+        :return: return a sorted by date list of the mdoc files in the path
+        that have been neither composed nor banned yet
         """
         fpath = self.filesPath.get()
-        self.MDOC_DATA_SOURCE = glob(os.path.join(fpath, self.mdocPattern.get()))
+        # Only the modification time of the new mdoc files is read
+        self.MDOC_DATA_SOURCE = [f for f in glob(os.path.join(fpath, self.mdocPattern.get()))
+                                 if f not in self.composedMdocs and f not in self.bannedMdocs]
         self.MDOC_DATA_SOURCE.sort(key=os.path.getmtime)
         return self.MDOC_DATA_SOURCE
 
@@ -256,13 +275,10 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
         """
         self.info(f'Matching {file2read}...')
         self.info(f'Tilts on the mdoc file: {len(mdoc_order_angle_list)}\n'
-                  f'Micrographs available: {len(self.listOfMics)}')
+                  f'Micrographs available: {len(self.micsDict)}')
 
-        list_mdoc_files = [os.path.splitext(os.path.basename(fp[0]))[0] for fp in mdoc_order_angle_list]
-        list_mics_matched = []
-        for x, mic in enumerate(self.listOfMics):
-            if os.path.splitext(mic.getMicName())[0] in list_mdoc_files:
-                list_mics_matched.append(mic)
+        list_mdoc_files = dict.fromkeys(self._getMicKey(fp[0]) for fp in mdoc_order_angle_list)
+        list_mics_matched = [self.micsDict[micKey] for micKey in list_mdoc_files if micKey in self.micsDict]
 
         if streamOpen:
             if len(list_mics_matched) < len(mdoc_order_angle_list):
@@ -283,13 +299,28 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
 
 
     def _loadInputList(self):
-        """ Load the input set of mics and create a list. """
+        """ Load the mics added to the input set since the previous call into
+        the dict of mics, indexed by their normalised base name.
+        :return: the number of new mics
+        """
         mic_file = self.inputMicrographs.get().getFileName()
         self.debug("Loading input db: %s" % mic_file)
         mic_set = emobj.SetOfMicrographs(filename=mic_file)
         mic_set.loadAllProperties()
-        self.listOfMics = [m.clone() for m in mic_set]
+        nNewMics = 0
+        for mic in mic_set.iterItems(where='id > %d' % self.lastMicId):
+            self.lastMicId = mic.getObjId()
+            # As when the list of mics was scanned, the last mic with a repeated name is the one used
+            self.micsDict[self._getMicKey(mic.getMicName())] = mic.clone()
+            nNewMics += 1
         mic_set.close()
+        self.debug("%d new micrographs loaded" % nNewMics)
+        return nNewMics
+
+    @staticmethod
+    def _getMicKey(fileName):
+        """ Normalised base name used to match the mdoc sub-frames and the mics. """
+        return os.path.splitext(os.path.basename(fileName))[0]
 
 
     def createTS(self, mdoc_obj, mdoc_order_angle_list, file2read):
@@ -382,7 +413,7 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
             summaryF = self._getExtraPath("summary.txt")
             summaryF = open(summaryF, "w")
             summaryF.write(f'{self.TiltSeries.getSize()} TiltSeries added')
-            self.listTSComposed.append(file2read)
+            self.composedMdocs.add(file2read)
 
 
     def settingTS(self, SOTS, ts_obj, file_ordered_angle_list, incoming_dose_list):
@@ -405,9 +436,12 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
             for n in file_ordered_angle_list:
                 TSAngleFile.write('{}\n'.format(str(n[2])))
             TSAngleFile.close()
-            sr = self.listOfMics[0].getSamplingRate()
-            properties = {"sr": sr}
-            newStack = ImageStack(properties=properties)
+            sr = next(iter(self.micsDict.values())).getSamplingRate()
+            if ts_obj.getSamplingRate() is None:
+                ts_obj.setSamplingRate(sr)
+            if SOTS.getSamplingRate() is None:
+                SOTS.setSamplingRate(sr)
+            micFiles = []
             ti = None
             tsAcq = ts_obj.getAcquisition()
             tsAccumDose = -999
@@ -416,40 +450,36 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
             for f, to, ta in file_ordered_angle_list:
                 try:
                     to = int(to)
-                    for mic in self.listOfMics:
-                        if ts_obj.getSamplingRate() is None:
-                            ts_obj.setSamplingRate(sr)
-                        if SOTS.getSamplingRate() is None:
-                            SOTS.setSamplingRate(sr)
-                        if os.path.basename(f) in mic.getMicName():
-                            ti = tomoObj.TiltImage()
-                            ti.setTsId(ts_obj.getTsId())
-                            new_location = (counter_ti + 1, ts_fn)
-                            ti.setLocation(new_location)
-                            # ti.setObjId(counter_ti + 1)
-                            ti.setAcquisition(ts_obj.getAcquisition())
-                            ti.setAcquisitionOrder(to)
-                            ti.setTiltAngle(ta)
-                            ti.setSamplingRate(sr)
-                            ti.setAcquisition(ts_obj.getAcquisition().clone())
-                            dosePerFrame = incoming_dose_list[to - 1]  # To begins in 1 because of MDoc class
-                            accumDose = to * dosePerFrame
-                            initialDose = (to - 1) * dosePerFrame
-                            ti.getAcquisition().setDosePerFrame(dosePerFrame)
-                            ti.getAcquisition().setAccumDose(accumDose)
-                            ti.getAcquisition().setDoseInitial(initialDose)
-                            newStack.append(ImageReadersRegistry.open(mic.getFileName()))
-                            ts_obj.append(ti)
-
-                            tsInitialDose = min(tsInitialDose, initialDose)
-                            tsAccumDose = max(tsAccumDose, accumDose)
-                            angleList.append(float(ta))
-
-                            counter_ti += 1
+                    mic = self.micsDict.get(self._getMicKey(f))
+                    if mic is not None:
+                        ti = tomoObj.TiltImage()
+                        ti.setTsId(ts_obj.getTsId())
+                        new_location = (counter_ti + 1, ts_fn)
+                        ti.setLocation(new_location)
+                        # ti.setObjId(counter_ti + 1)
+                        ti.setAcquisition(ts_obj.getAcquisition())
+                        ti.setAcquisitionOrder(to)
+                        ti.setTiltAngle(ta)
+                        ti.setSamplingRate(sr)
+                        ti.setAcquisition(ts_obj.getAcquisition().clone())
+                        dosePerFrame = incoming_dose_list[to - 1]  # To begins in 1 because of MDoc class
+                        accumDose = to * dosePerFrame
+                        initialDose = (to - 1) * dosePerFrame
+                        ti.getAcquisition().setDosePerFrame(dosePerFrame)
+                        ti.getAcquisition().setAccumDose(accumDose)
+                        ti.getAcquisition().setDoseInitial(initialDose)
+                        micFiles.append(mic.getFileName())
+                        ts_obj.append(ti)
+
+                        tsInitialDose = min(tsInitialDose, initialDose)
+                        tsAccumDose = max(tsAccumDose, accumDose)
+                        angleList.append(float(ta))
+
+                        counter_ti += 1
                 except Exception as e:
                     self.error(e)
                     return
-            ImageReadersRegistry.write(newStack, ts_fn, isStack=True)
+            self.writeTsStack(ts_fn, micFiles, sr)
 
             tsAcq.setAccumDose(tsAccumDose)
             tsAcq.setDoseInitial(tsInitialDose)
@@ -461,6 +491,64 @@ class ProtComposeTS(ProtImport, ProtTomoBase, ProtStreamingBase):
         except Exception as e:
             self.error(e)
 
+    @staticmethod
+    def writeTsStack(ts_fn, micFiles, sr, readThreads=1):
+        """
+        Write the mics in a new stack, one slice at a time, so the memory used
+        does not depend on the number of tilts
+
+        :param ts_fn: output stack file.
+        :param micFiles: list of mic files, in the order of the stack.
+        :param sr: sampling rate.
+        :param readThreads: number of threads reading the next mics while the
+        current one is written (0 to read them serially). Each one holds one
+        more slice in memory.
+        """
+        def readMic(micFile):
+            # The reader is used directly because ImageReadersRegistry.open caches the images read
+            micData = ImageReadersRegistry.getReader(micFile).open(micFile)
+            # Memory maps are copied, so the mic is actually read by the calling thread
+            if isinstance(micData, np.memmap):
+                micData = np.array(micData, dtype=np.float32)
+            else:
+                micData = micData.astype(np.float32, copy=False)
+            return micData.reshape(micData.shape[-2:])
+
+        executor = ThreadPoolExecutor(max_workers=readThreads) if readThreads > 0 else None
+        nextMics = deque(executor.submit(readMic, micFile) for micFile in micFiles[:readThreads]) if executor else None
+        tsMrc = None
+        try:
+            # Header statistics are accumulated per slice (update_header_stats works on the whole stack)
+            dMin, dMax, dSum, dSumSq = np.inf, -np.inf, 0., 0.
+            for index, micFile in enumerate(micFiles):
+                if executor:
+                    micData = nextMics.popleft().result()
+                    if index + readThreads < len(micFiles):
+                        nextMics.append(executor.submit(readMic, micFiles[index + readThreads]))
+                else:
+                    micData = readMic(micFile)
+                if tsMrc is None:
+                    tsMrc = mrcfile.new_mmap(ts_fn, shape=(len(micFiles), *micData.shape), mrc_mode=2,
+                                             overwrite=True)  # Mode 2 is float32 (see new_mmap)
+                    tsMrc.set_image_stack()
+                tsMrc.data[index] = micData
+                dMin, dMax = min(dMin, micData.min()), max(dMax, micData.max())
+                dSum += micData.sum(dtype=np.float64)
+                dSumSq += np.einsum('ij,ij->', micData, micData, dtype=np.float64)
+                del micData
+            if tsMrc is not None:
+                nValues = tsMrc.data.size
+                dMean = dSum / nValues
+                header = tsMrc.header
+                header.dmin, header.dmax, header.dmean = dMin, dMax, dMean
+                header.rms = np.sqrt(max(dSumSq / nValues - dMean ** 2, 0))
+                tsMrc.voxel_size = sr
+        finally:
+            if tsMrc is not None:
+                tsMrc.close()
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
     # -------------------------- AUXILIARY FUNCTIONS -----------------------
     def _getOutputTiltSeriesPath(self, ts, suffix=''):
         return self._getExtraPath('%s%s.mrcs' % (ts.getTsId(), suffix))
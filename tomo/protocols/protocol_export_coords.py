@@ -31,7 +31,7 @@ import pyworkflow.utils as pwutils
 from pyworkflow.constants import NEW
 from pwem.protocols import EMProtocol
 
-from tomo.constants import BOTTOM_LEFT_CORNER, TR_DYNAMO
+from tomo.constants import BOTTOM_LEFT_CORNER
 from tomo.utils import existsPlugin
 
 EXPORT_TO_TXT = 'txt'
@@ -91,11 +91,7 @@ class ProtExportCoordinates3D(EMProtocol):
         pwutils.makePath(self._getExportPath())
 
         if format == EXPORT_TO_TXT:
-            def _writeFunc(coord, f):
-                x, y, z = map(int, coord.getPosition(BOTTOM_LEFT_CORNER))
-                f.write(f"{x} {y} {z}\n")
-
-            self._writeTxt(inputCoords, "txt", _writeFunc)
+            self._writeTxt(inputCoords, "txt", self._writeTxtCoords)
 
         elif format == EXPORT_TO_STAR:
             from reliontomo.convert import writeSetOfCoordinates
@@ -113,18 +109,7 @@ class ProtExportCoordinates3D(EMProtocol):
         elif format == EXPORT_TO_DYNAMO:
             from dynamo.convert import matrix2eulerAngles
 
-            def _writeFunc(coord, f):
-                x, y, z = coord.getPosition(BOTTOM_LEFT_CORNER)
-                # Get alignment information
-                #if coord.hasTransform():  # FIXME
-                #    tdrot, tilt, narot, shiftx, shifty, shiftz = matrix2eulerAngles(coord.getMatrix())
-                #else:
-                tdrot, tilt, narot, shiftx, shifty, shiftz = 0, 0, 0, 0, 0, 0
-                f.write(f"{coord.getObjId()} 1 1 {shiftx} {shifty} {shiftz} "
-                        f"{tdrot} {tilt} {narot} 0 0 0 1 0 0 0 0 0 0 0 0 1 0 "
-                        f"{x} {y} {z} 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
-
-            self._writeTxt(inputCoords, "tbl", _writeFunc)
+            self._writeTxt(inputCoords, "tbl", self._writeDynamoCoords)
 
         elif format == EXPORT_TO_CBOX:
             from sphire.convert import writeSetOfCoordinates3D
@@ -148,17 +133,31 @@ class ProtExportCoordinates3D(EMProtocol):
     def _getExportPath(self, *paths):
         return os.path.join(self._getPath('Export'), *paths)
 
-    def _writeTxt(self, inputCoords, ext="txt", writeCoord=None):
-        """ Iterate over coords by tomoId and write output. """
-        f = None
-        lastTomoId = None
-        for coord in inputCoords.iterCoordinates(orderBy="_tomoId"):
-            tomoId = coord.getTomoId()
-            if tomoId != lastTomoId:
-                if f:  # we need to close previous opened file
-                    f.close()
-                f = open(self._getExportPath(f"{tomoId}.{ext}"), "w")
-                lastTomoId = tomoId
-            writeCoord(coord, f)
-        if f:
-            f.close()
+    def _writeTxt(self, inputCoords, ext="txt", writeCoords=None):
+        """ Read the coords of each tomoId in bulk and write one file per tomoId.
+        :param writeCoords: function called as writeCoords(objIds, positions, f) for each tomoId, where objIds is the
+        array of the objIds of its coords, sorted, and positions is a (N, 3) array of their (x, y, z) positions
+        referred to the BOTTOM_LEFT_CORNER.
+        """
+        for tomoId in sorted(inputCoords.getTSIds()):
+            positions, objIds = inputCoords.getPositions(BOTTOM_LEFT_CORNER, tomoId)
+            with open(self._getExportPath(f"{tomoId}.{ext}"), "w") as f:
+                writeCoords(objIds, positions, f)
+
+    @staticmethod
+    def _writeTxtCoords(objIds, positions, f):
+        # Truncated, as int() does
+        f.write(''.join('%d %d %d\n' % tuple(position) for position in positions.astype(int).tolist()))
+
+    @staticmethod
+    def _writeDynamoCoords(objIds, positions, f):
+        # Get alignment information
+        #if coord.hasTransform():  # FIXME
+        #    tdrot, tilt, narot, shiftx, shifty, shiftz = matrix2eulerAngles(coord.getMatrix())
+        #else:
+        tdrot, tilt, narot, shiftx, shifty, shiftz = 0, 0, 0, 0, 0, 0
+        # Converted to python scalars, so they are formatted as when written one by one
+        f.write(''.join(f"{objId} 1 1 {shiftx} {shifty} {shiftz} "
+                        f"{tdrot} {tilt} {narot} 0 0 0 1 0 0 0 0 0 0 0 0 1 0 "
+                        f"{x} {y} {z} 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n"
+                        for objId, (x, y, z) in zip(objIds.tolist(), positions.tolist())))
@@ -23,16 +23,16 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import mrcfile
 import numpy as np
 
 from pyworkflow import BETA
 from pyworkflow.protocol.params import PointerParam, IntParam, BooleanParam
 
 from pwem.protocols import EMProtocol
-from pwem.emlib.image import ImageHandler
 from pwem.objects import Set
 
-from tomo.objects import (SetOfCoordinates3D, Coordinate3D, SetOfTomograms,
+from tomo.objects import (SetOfCoordinates3D, SetOfTomograms,
                           SetOfTomoMasks, TomoMask, Tomogram)
 from tomo.protocols import ProtTomoBase
 import tomo.constants as const
@@ -46,6 +46,10 @@ class ProtMaskCoordinates(EMProtocol, ProtTomoBase):
     _devStatus = BETA
     _possibleOutputs = {COORDINATES: SetOfCoordinates3D}
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.segmentationsDict = None
+
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam('inputCoordinates', 
@@ -97,10 +101,12 @@ class ProtMaskCoordinates(EMProtocol, ProtTomoBase):
         segmentation = self._getInputSegmentation(tsId)
         
         if segmentation is not None:
-            mask = self._calculateMask(segmentation)
+            positions, ids = inputCoordinates3d.getPositions(const.BOTTOM_LEFT_CORNER, tsId)
+            # Rounded to the closest voxel
+            keptIds = set(ids[self._checkCoordinates(np.rint(positions).astype(int), segmentation)].tolist())
             
             for item in inputCoordinates3d.iterCoordinates(tomogram):
-                if self._checkCoordinate(item, mask):
+                if item.getObjId() in keptIds:
                     outputCoordinates.append(item)
         
         elif not self.excludeUnsegmented:
@@ -115,33 +121,23 @@ class ProtMaskCoordinates(EMProtocol, ProtTomoBase):
         return self.inputCoordinates.get()
     
     def _getInputSegmentation(self, tsId: str) -> TomoMask:
-        segmentations: SetOfTomoMasks = self.inputSegmentations.get()
-        for item in segmentations.iterItems():
-            if item.getTsId() == tsId:
-                return item
-        return None
+        if self.segmentationsDict is None:
+            segmentations: SetOfTomoMasks = self.inputSegmentations.get()
+            self.segmentationsDict = {item.getTsId(): item.clone() for item in segmentations.iterItems()}
+        return self.segmentationsDict.get(tsId, None)
     
-    def _loadSegmentation(self, segmentation: TomoMask) -> np.ndarray:
-        ih = ImageHandler()
-        image = ih.read(segmentation)
-        return image.getData()
-    
-    def _calculateMask(self, segmentation: TomoMask) -> np.ndarray:
-        segmentationData = self._loadSegmentation(segmentation)
+    def _checkCoordinates(self, positions: np.ndarray, segmentation: TomoMask) -> np.ndarray:
+        """ Returns a boolean array stating which of the given (x, y, z) positions lie in the mask. Only the voxels
+        of the segmentation at those positions are read. """
         label: int = self.segmentationLabel.get()
-        
+        x, y, z = positions.T
+        with mrcfile.mmap(segmentation.getFileName(), mode='r', permissive=True) as mrc:
+            values = mrc.data[z, y, x]
+
         if label < 0:
-            mask = (segmentationData > 0)
+            return values > 0
         else:
-            mask = (segmentationData == label)
-            
-        return mask
-        
-    def _checkCoordinate(self, coordinate: Coordinate3D, mask: np.ndarray) -> bool:
-        position = coordinate.getPosition(const.BOTTOM_LEFT_CORNER)
-        position = tuple(map(round, position))
-        x, y, z = position
-        return bool(mask[z, y, x] == True)
+            return values == label
     
     # --------------------------- INFO functions -------------------------------
     def _validate(self):
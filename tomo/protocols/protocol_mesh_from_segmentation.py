@@ -25,27 +25,49 @@
 # *
 # **************************************************************************
 
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from itertools import repeat
 import math
+import multiprocessing
+from typing import List, Tuple
 import numpy as np
 import skimage.morphology
+from scipy.ndimage import find_objects
 
 from pwem.protocols import EMProtocol
 from pwem.objects import Set, Integer
 from pwem.emlib.image import ImageHandler
 
 from pyworkflow import BETA
+from pyworkflow.protocol import STEPS_PARALLEL
 from pyworkflow.protocol.params import (PointerParam, FloatParam, 
                                         BooleanParam, IntParam)
 
 from tomo.objects import (SetOfMeshes, MeshPoint, SetOfTomoMasks, TomoMask,
-                          SetOfTomograms, Tomogram)
+                          SetOfTomograms, Tomogram, appendItems)
 from tomo.protocols import ProtTomoBase
 import tomo.constants as const
 
 class OutputMeshesFromSegmentation(Enum):
     Meshes = SetOfMeshes
 
+
+def _getBinaryMaskCoordinates(mask: np.ndarray, origin: Tuple[int, int, int],
+                              dilation: int, skeletonize: bool) -> np.ndarray:
+    """ Dilates and skeletonizes, if required, a binary mask cropped from a bigger volume and returns the (z, y, x)
+    coordinates of its non-zero voxels, referred to the bigger volume. The crop must include a margin of dilation + 1
+    voxels around the mask, so the results are the same as if the bigger volume were processed. """
+    if dilation > 0:
+        footprint = skimage.morphology.ball(dilation)
+        mask = skimage.morphology.binary_dilation(mask, footprint)
+        
+    if skeletonize:
+        mask = skimage.morphology.skeletonize_3d(mask)
+        
+    return np.argwhere(mask) + np.array(origin)
+
+
 class ProtMeshFromSegmentation(EMProtocol, ProtTomoBase):
     """
     Creates meshes based on segmentations or voxels values (TomoMasks).
@@ -53,6 +75,9 @@ class ProtMeshFromSegmentation(EMProtocol, ProtTomoBase):
     _label = 'meshes from tomo mask'
     _devStatus = BETA
     _possibleOutputs = OutputMeshesFromSegmentation
+    # Tomograms are processed as independent steps running in parallel; the
+    # default of one thread keeps the former serial scheduling
+    stepsExecutionMode = STEPS_PARALLEL
 
     # --------------------------- DEFINE param functions -----------------------
     def _defineParams(self, form):
@@ -98,14 +123,17 @@ class ProtMeshFromSegmentation(EMProtocol, ProtTomoBase):
                       help='This parameter goes from 0 - 100 and defines the '
                            'percentage of voxel of the tomoMask that '
                            'will be considered as points of the mesh.')
+        form.addParallelSection(threads=1, mpi=0)
 
     # --------------------------- INSERT steps functions -----------------------
     def _insertAllSteps(self):
         self._initialize()
         
+        processStepIds = []
         for tsId in self.masks.keys():
-            self._insertFunctionStep(self.processTomogramStep, tsId)
-        self._insertFunctionStep(self._closeOutputSet)
+            processStepIds.append(self._insertFunctionStep(self.processTomogramStep, tsId,
+                                                           prerequisites=[]))
+        self._insertFunctionStep(self._closeOutputSet, prerequisites=processStepIds)
 
     # --------------------------- STEPS functions ------------------------------
     def processTomogramStep(self, tsId):
@@ -113,23 +141,16 @@ class ProtMeshFromSegmentation(EMProtocol, ProtTomoBase):
         tomogram = self._getInputTomogram(tsId)
         
         if mask is not None and tomogram is not None:
+            maskData = self._loadMask(mask)
+            meshesCoordinates = self._getMeshesCoordinates(maskData, workers=self._getLabelWorkers())
+            
             with self._lock:
                 outputMeshes = self._getOutputMeshes()
-                maskData = self._loadMask(mask)
-        
-                if self.smoothMask:
-                    self._processSmoothMask(
-                        mesh=outputMeshes,
-                        tomogram=tomogram,
-                        mask=maskData
-                    )
-                else:
-                    self._processSegmentation(
-                        mesh=outputMeshes,
-                        tomogram=tomogram,
-                        segmentation=maskData
-                    )
-
+                self._appendMeshes(
+                    mesh=outputMeshes,
+                    tomogram=tomogram,
+                    meshesCoordinates=meshesCoordinates
+                )
             
                 outputMeshes.write()
                 self._store()
@@ -164,6 +185,12 @@ class ProtMeshFromSegmentation(EMProtocol, ProtTomoBase):
         ih = ImageHandler()
         image = ih.read(mask)
         return image.getData()
+    
+    def _getLabelWorkers(self) -> int:
+        """ Number of processes among which the labels of a tomogram are distributed, so the tomograms processed at
+        the same time do not use more than numberOfThreads CPUs in total. """
+        nThreads = max(self.numberOfThreads.get() or 1, 1)
+        return max(nThreads // min(nThreads, len(self.masks)), 1)
 
     # --------------------------- INFO functions -------------------------------
     def _validate(self):
@@ -176,54 +203,75 @@ class ProtMeshFromSegmentation(EMProtocol, ProtTomoBase):
             
         return errors
 
-    def _processSegmentation(self, 
-                             mesh: SetOfMeshes, 
-                             tomogram: Tomogram, 
-                             segmentation: np.ndarray ) -> None:
-        labels = np.unique(segmentation)
-        for label in labels:
-            if label != self.backgroundLabel.get():
-                mask = (segmentation == label)
-                self._processBinaryMask(
-                    mesh=mesh, 
-                    tomogram=tomogram,
-                    mask=mask
-                )
-    
-    def _processSmoothMask(self,
-                           mesh: SetOfMeshes,
-                           tomogram: Tomogram,
-                           mask: np.ndarray ) -> None:
-        mask = (self.lowLimit.get() <= mask) & (mask <= self.highLimit.get())
-        self._processBinaryMask(
-            mesh=mesh,
-            tomogram=tomogram,
-            mask=mask
-        )
-                
-    def _processBinaryMask(self,
-                           mesh: SetOfMeshes,
-                           tomogram: Tomogram,
-                           mask: np.ndarray ):
-        if self.applyDilation.get() > 0:
-            footprint =skimage.morphology.ball(self.applyDilation.get()) 
-            mask = skimage.morphology.binary_dilation(mask, footprint)
-            
-        if self.applySkeletonization.get():
-            mask = skimage.morphology.skeletonize_3d(mask)
+    def _getMeshesCoordinates(self, maskData: np.ndarray, workers: int = 1) -> List[np.ndarray]:
+        """ Returns the (z, y, x) coordinates of the points of each mesh, in the order of the labels of the
+        segmentation (a single mesh for smooth masks). """
+        if self.smoothMask:
+            labelMap = (self.lowLimit.get() <= maskData) & (maskData <= self.highLimit.get())
+            labelIds = [1]
+        else:
+            labelMap, labelIds = self._getLabelMap(maskData)
         
+        # Each mesh is processed in the bounding box of its label, plus a margin to keep the results of the
+        # morphological operations the same as with the whole tomogram
+        margin = self.applyDilation.get() + 1
+        boundingBoxes = find_objects(labelMap.view(np.uint8) if labelMap.dtype == bool else labelMap)
+        coordinates = [np.empty((0, 3), dtype=int) for _ in labelIds]  # For the empty masks
+        jobs, masks, origins = [], [], []
+        for job, labelId in enumerate(labelIds):
+            if labelId > len(boundingBoxes) or boundingBoxes[labelId - 1] is None:
+                continue
+            box = tuple(slice(max(sl.start - margin, 0), min(sl.stop + margin, dim))
+                        for sl, dim in zip(boundingBoxes[labelId - 1], labelMap.shape))
+            jobs.append(job)
+            masks.append(labelMap[box] == labelId)
+            origins.append(tuple(sl.start for sl in box))
+        del labelMap
         
+        args = (masks, origins, repeat(self.applyDilation.get()), repeat(bool(self.applySkeletonization.get())))
+        if workers > 1 and len(masks) > 1:
+            # Spawned, not forked, as the steps of this protocol run in threads (STEPS_PARALLEL)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results = list(executor.map(_getBinaryMaskCoordinates, *args))
+        else:
+            results = list(map(_getBinaryMaskCoordinates, *args))
+        for job, labelCoordinates in zip(jobs, results):
+            coordinates[job] = labelCoordinates
+        
+        return [self._selectPoints(labelCoordinates) for labelCoordinates in coordinates]
+    
+    def _getLabelMap(self, segmentation: np.ndarray) -> Tuple[np.ndarray, List[int]]:
+        """ Maps each value of the segmentation to its position + 1 in the sorted list of values, so they can be
+        located with find_objects. Returns the map and the ids of the non-background labels, sorted by value. """
+        # Slice by slice, it is faster and does not flatten the whole segmentation
+        labels = np.unique(np.concatenate([np.unique(segmentationSlice) for segmentationSlice in segmentation]))
+        labelMap = np.empty(segmentation.shape, dtype=np.uint16 if len(labels) < 2 ** 16 else np.int32)
+        for z, segmentationSlice in enumerate(segmentation):
+            labelMap[z] = np.searchsorted(labels, segmentationSlice) + 1
+        labelIds = [i + 1 for i, label in enumerate(labels) if label != self.backgroundLabel.get()]
+        return labelMap, labelIds
+    
+    def _selectPoints(self, coordinates: np.ndarray) -> np.ndarray:
         probability = self.density.get() / 100.0
-        coordinates = np.argwhere(mask)
         indices = np.arange(0, len(coordinates))
         nPoints = math.floor(probability*len(indices))
         selection = np.random.choice(indices, size=nPoints, replace=False)
-        
-        for z, y, x in coordinates[selection,:]:
+        return coordinates[selection,:]
+    
+    def _appendMeshes(self,
+                      mesh: SetOfMeshes,
+                      tomogram: Tomogram,
+                      meshesCoordinates: List[np.ndarray]) -> None:
+        """ Appends the points of the given meshes, one group per mesh, with a single bulk insert. """
+        def iterPoints():
             point = MeshPoint()
             point.setVolume(tomogram)
-            point.setGroupId(self.baseGroupId)
-            point.setPosition(x, y, z, const.BOTTOM_LEFT_CORNER)
-            mesh.append(point)
+            for coordinates in meshesCoordinates:
+                point.setGroupId(self.baseGroupId.get())
+                for z, y, x in coordinates:
+                    point.setObjId(None)
+                    point.setPosition(x, y, z, const.BOTTOM_LEFT_CORNER)
+                    yield point
+                self.baseGroupId.increment()
         
-        self.baseGroupId.increment()
+        appendItems(mesh, iterPoints())
@@ -28,9 +28,9 @@ from pyworkflow import BETA
 import pyworkflow.protocol.params as params
 from pwem.protocols import EMProtocol
 
-from tomo.objects import (SetOfTiltSeries, TiltImage,
-                          SetOfCoordinates3D, Coordinate3D,
-                          SetOfLandmarkModels, LandmarkModel )
+from tomo.objects import (SetOfTiltSeries, TiltSeries, TiltImage,
+                          SetOfCoordinates3D,
+                          SetOfLandmarkModels, LandmarkModel)
 from tomo.protocols import ProtTomoBase
 import tomo.constants as constants
 from tomo.utils import getObjFromRelation
@@ -87,7 +87,6 @@ class ProtProjectCoordinates(EMProtocol, ProtTomoBase):
         
         for tiltSeries in inputTiltSeries:
             tsId = tiltSeries.getTsId()
-            where = '%s="%s"' % (Coordinate3D.TOMO_ID_ATTR, tsId)
             landmarkModel = LandmarkModel(
                 tsId=tsId,
                 fileName=self._getExtraPath(tsId + '.sfid'),
@@ -95,25 +94,7 @@ class ProtProjectCoordinates(EMProtocol, ProtTomoBase):
                 applyTSTransformation=False
             )
             landmarkModel.setTiltSeries(tiltSeries)
-            
-            for coordinate3d in inputCoodinates.iterItems(where=where):
-                position3d = np.array(coordinate3d.getPosition(constants.SCIPION) + (1, ))
-                position3d[:3] *= scale # Scale to match the binning of the TS
-                chainId = coordinate3d.getObjId()
-                
-                for tiltImage in tiltSeries:
-                    position2d = self._projectCoordinate(tiltImage, position3d)
-                    position2d = position2d[:2]
-                    position2d += offset
-                    
-                    landmarkModel.addLandmark(
-                        xCoor=position2d[0],
-                        yCoor=position2d[1],
-                        tiltIm=tiltImage.getIndex(),
-                        chainId=chainId,
-                        xResid=0,
-                        yResid=0
-                    )
+            self._projectTsCoordinates(landmarkModel, tiltSeries, inputCoodinates, scale, offset)
 
             outputSetOfLandmarkModels.append(landmarkModel)
                     
@@ -134,26 +115,47 @@ class ProtProjectCoordinates(EMProtocol, ProtTomoBase):
             
         return result
 
-    def _projectCoordinate(self,
-                           tiltImage: TiltImage,
-                           position3d: np.ndarray ) -> np.ndarray:
-        projection = self._getProjectionMatrix(tiltImage)
-        projected = projection @ position3d
+    def _projectTsCoordinates(self,
+                              landmarkModel: LandmarkModel,
+                              tiltSeries: TiltSeries,
+                              coordinates: SetOfCoordinates3D,
+                              scale: float,
+                              offset: np.ndarray):
+        """ Projects all the coordinates of a tilt-series onto all its tilt-images at once and writes the resulting
+        landmarks, one chain per coordinate, into the landmark model. """
+        positions3d, chainIds = coordinates.getPositions(constants.SCIPION, tiltSeries.getTsId())
+        if len(chainIds) == 0 or tiltSeries.isEmpty():
+            return
         
-        if tiltImage.hasTransform():
-            transform = tiltImage.getTransform().getMatrix()
-            projected = np.linalg.inv(transform) @ projected
-
-        return projected    
+        # Homogeneous positions, scaled to match the binning of the TS
+        positions3d = np.column_stack([positions3d * scale, np.ones(len(chainIds))])
+        tiArrays = tiltSeries.toArrays([TiltImage.INDEX_FIELD,
+                                        TiltImage.TILT_ANGLE_FIELD,
+                                        TiltImage.TRANSFORM_MATRIX_FIELD])
+        # (Nti, 3, 4) matrices that project and undo the alignment of each tilt-image. The tilt-images without
+        # transform are read as the identity
+        projections = np.linalg.inv(tiArrays[TiltImage.TRANSFORM_MATRIX_FIELD]) @ \
+            self._getProjectionMatrices(tiArrays[TiltImage.TILT_ANGLE_FIELD])
+        positions2d = np.einsum('tij,cj->cti', projections[:, :2, :], positions3d) + offset
+        
+        nTi = len(projections)
+        landmarkModel.addLandmarks(
+            xCoors=positions2d[..., 0],
+            yCoors=positions2d[..., 1],
+            tiltIms=np.tile(tiArrays[TiltImage.INDEX_FIELD], (len(chainIds), 1)),
+            chainIds=np.repeat(chainIds, nTi).reshape(-1, nTi),
+            xResids=0,
+            yResids=0
+        )
     
-    def _getProjectionMatrix(self, tiltImage: TiltImage) -> np.ndarray:
-        tiltAngle = tiltImage.getTiltAngle()
-        tiltAngle = np.deg2rad(tiltAngle)
-        return np.array([
-            [np.cos(tiltAngle), 0, np.sin(tiltAngle), 0],
-            [0,                 1, 0,                 0],
-            [0,                 0, 0,                 1]
-        ])
+    def _getProjectionMatrices(self, tiltAngles: np.ndarray) -> np.ndarray:
+        tiltAngles = np.deg2rad(tiltAngles)
+        projections = np.zeros((len(tiltAngles), 3, 4))
+        projections[:, 0, 0] = np.cos(tiltAngles)
+        projections[:, 0, 2] = np.sin(tiltAngles)
+        projections[:, 1, 1] = 1
+        projections[:, 2, 3] = 1
+        return projections
         
     # --------------------------- INFO functions ----------------------------
     def _validate(self):
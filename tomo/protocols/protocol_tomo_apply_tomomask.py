@@ -25,13 +25,16 @@
 # *
 # **************************************************************************
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from itertools import repeat
 from os import remove
-from typing import Union
+from typing import Union, Callable, Tuple
 import mrcfile
 import numpy as np
 from scipy.ndimage import gaussian_filter, binary_dilation
-from pwem.emlib.image.image_readers import MRCImageReader, ImageReadersRegistry, ImageStack
+from pwem.emlib.image.image_readers import MRCImageReader
 from pwem.protocols import EMProtocol
 from pyworkflow import BETA
 from pyworkflow.object import Pointer, String, Set
@@ -41,6 +44,93 @@ from tomo.objects import SetOfTomograms, SetOfTomoMasks, Tomogram
 
 logger = logging.getLogger(__name__)
 
+SLAB_VOXELS = 2 ** 25  # Approximate number of voxels of the Z slabs of the volumes processed at once
+
+
+def _getMaskHalo(dilationPixels: int, sigma: float) -> int:
+    """ Number of slices required at each side of a slab so that its dilated and smoothed slices are the same as if
+    the whole volume were processed: the dilation iterations plus the radius of the gaussian kernel (see
+    scipy.ndimage.gaussian_filter, truncate = 4). """
+    return dilationPixels + (int(4.0 * sigma + 0.5) if sigma > 0 else 0)
+
+
+def _writeSlab(outFileName: str, z0: int, slices) -> Tuple[float, float, float, float]:
+    """ Writes the slices, one by one, into the float32 output volume, starting at slice z0, and returns their
+    partial statistics (min, max, sum and sum of squares). """
+    vMin, vMax, vSum, vSumSq = np.inf, -np.inf, 0., 0.
+    with mrcfile.mmap(outFileName, mode='r+') as mrc:
+        for z, sliceData in enumerate(slices, start=z0):
+            sliceData = np.asarray(sliceData, dtype=np.float32)
+            mrc.data[z] = sliceData
+            vMin = min(vMin, float(sliceData.min()))
+            vMax = max(vMax, float(sliceData.max()))
+            vSum += float(sliceData.sum(dtype=np.float64))
+            vSumSq += float(np.square(sliceData, dtype=np.float64).sum())
+    return vMin, vMax, vSum, vSumSq
+
+
+def _processMaskSlab(outFileName: str, z0: int, z1: int, maskFileName: str, dilationPixels: int, sigma: float,
+                     invert: bool) -> Tuple[float, float, float, float]:
+    """ Dilates, smooths and, if required, inverts the slices [z0, z1) of the mask, reading only them and the halo
+    slices they depend on. The filter accumulates in float64, as when the whole volume is processed at once, so the
+    results are the same. """
+    with mrcfile.mmap(maskFileName, mode='r', permissive=True) as mrc:
+        halo = _getMaskHalo(dilationPixels, sigma)
+        h0, h1 = max(z0 - halo, 0), min(z1 + halo, mrc.data.shape[0])
+        data = mrc.data[h0:h1]
+        if dilationPixels > 0:
+            data = binary_dilation(np.array(data, dtype=bool), iterations=dilationPixels)
+        data = np.array(data, dtype=np.float32)  # Exact for the mask values, it halves the memory of float64
+    smoothData = gaussian_filter(data, sigma=sigma, output=np.float64)[z0 - h0:z1 - h0]
+    del data
+    if invert:
+        np.subtract(1, smoothData, out=smoothData)
+    return _writeSlab(outFileName, z0, smoothData)
+
+
+def _applyMaskSlab(outFileName: str, z0: int, z1: int, maskFileName: str,
+                   tomoFileName: str) -> Tuple[float, float, float, float]:
+    """ Multiplies the slices [z0, z1) of the mask and the tomogram. """
+    with mrcfile.mmap(maskFileName, mode='r', permissive=True) as maskMrc, \
+            mrcfile.mmap(tomoFileName, mode='r', permissive=True) as tomoMrc:
+        return _writeSlab(outFileName, z0, (np.multiply(maskSlice, tomoSlice) for maskSlice, tomoSlice in
+                                            zip(maskMrc.data[z0:z1], tomoMrc.data[z0:z1])))
+
+
+def writeVolumeBySlabs(outFileName: str, shape: Tuple[int, int, int], samplingRate: float, slabFunc: Callable,
+                       slabArgs: tuple = (), workers: int = 1, minSlabSlices: int = 1) -> None:
+    """ Creates a float32 volume whose Z slabs are computed and written one by one (in a pool of processes if
+    workers > 1), so the peak memory depends on the slab size, not on the volume size.
+    :param outFileName: output volume, memory-mapped.
+    :param shape: dimensions of the output volume (z, y, x).
+    :param samplingRate: voxel size of the output volume.
+    :param slabFunc: module-level function called as slabFunc(outFileName, z0, z1, *slabArgs), which writes the slices
+    [z0, z1) of the output volume and returns their partial statistics (see _writeSlab).
+    :param slabArgs: extra arguments of slabFunc.
+    :param workers: number of processes.
+    :param minSlabSlices: minimum number of slices of each slab. Otherwise, it is given by SLAB_VOXELS.
+    """
+    slabSlices = max(SLAB_VOXELS // (shape[1] * shape[2]), minSlabSlices, 1)
+    with mrcfile.new_mmap(outFileName, shape=shape, mrc_mode=2, overwrite=True) as mrc:  # Mode 2 is float32
+        mrc.voxel_size = samplingRate
+    z0s = list(range(0, shape[0], slabSlices))
+    z1s = [min(z0 + slabSlices, shape[0]) for z0 in z0s]
+    if workers > 1:
+        # Spawned, not forked, as the protocol steps may run in threads (e.g. holding sqlite or logging locks)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            stats = list(executor.map(slabFunc, repeat(outFileName), z0s, z1s, *[repeat(arg) for arg in slabArgs]))
+    else:
+        stats = [slabFunc(outFileName, z0, z1, *slabArgs) for z0, z1 in zip(z0s, z1s)]
+    # Header statistics of the whole volume from those of the slabs
+    mins, maxs, sums, sumSqs = zip(*stats)
+    nVoxels = float(np.prod(shape))
+    mean = sum(sums) / nVoxels
+    with mrcfile.mmap(outFileName, mode='r+') as mrc:
+        mrc.header.dmin = min(mins)
+        mrc.header.dmax = max(maxs)
+        mrc.header.dmean = mean
+        mrc.header.rms = np.sqrt(max(sum(sumSqs) / nVoxels - mean ** 2, 0))
+
 
 class ApplyTomoMaskOutputs(Enum):
     maskedTomograms = SetOfTomograms
@@ -159,30 +249,13 @@ class ProtTomoApplyTomoMask(EMProtocol):
         if self.doSmooth:
             logger.info(cyanStr(f'tsId = {tsId}: processing the mask...'))
             mask = self.tomoMaskDict[tsId]
-            maskFileName = mask.getFileName()
-            # Read the mask
-            with mrcfile.mmap(maskFileName, mode='r', permissive=True) as mrc:
-                data = mrc.data
-            # Dilate the mask
-            dilationPixels = self._getFormAttrib(ApplyTomoMaskFormParams.DILATION_PX.value)
-            if dilationPixels > 0:
-                data = np.array(data, dtype=bool)  # Required for the binary dilation
-                data = binary_dilation(data, iterations=dilationPixels)
-            # Smooth the mask
-            data = np.array(data, dtype=float)  # Required to be cast from uint8 to float for the gaussian filtering
-            sigma = self._getFormAttrib(ApplyTomoMaskFormParams.SIGMA_GAUSSIAN.value)
-            smoothData = gaussian_filter(data, sigma=sigma)
-            # Invert if required
-            invertMask = self._getFormAttrib(ApplyTomoMaskFormParams.INVERT_MASK.value)
-            smoothData = 1 - smoothData if invertMask else smoothData
-            # Write the result
-            smoothMaskFn = self._getSmoothedMaskFn(tsId)
-            with mrcfile.new_mmap(smoothMaskFn, overwrite=True, shape=smoothData.shape,
-                                  mrc_mode=2) as mrc:  # Mode 2 is float32 (see new_mmap)
-                for i in range(len(smoothData)):
-                    mrc.data[i, :, :] = smoothData[i, :, :]
-                mrc.update_header_from_data()
-                mrc.voxel_size = mask.getSamplingRate()
+            self.processMask(mask.getFileName(),
+                             self._getSmoothedMaskFn(tsId),
+                             mask.getSamplingRate(),
+                             dilationPixels=self._getFormAttrib(ApplyTomoMaskFormParams.DILATION_PX.value),
+                             sigma=self._getFormAttrib(ApplyTomoMaskFormParams.SIGMA_GAUSSIAN.value),
+                             invert=self._getFormAttrib(ApplyTomoMaskFormParams.INVERT_MASK.value),
+                             workers=self._getSlabWorkers())
 
     def applyMaskStep(self, tsId: str):
         logger.info(cyanStr(f'tsId = {tsId}: applying the mask...'))
@@ -204,12 +277,8 @@ class ProtTomoApplyTomoMask(EMProtocol):
             if not np.allclose(np.array(maskDims), np.array(tomoDims)):
                 self.failedDimsTsIds.append(tsId)
             else:
-                maskStack = ImageReadersRegistry.open(maskFileName)
-                tomoStack = ImageReadersRegistry.open(tomoFileName)
-                resultingImgList = [np.multiply(maskSlice, tomoSlice) for
-                                    maskSlice, tomoSlice in zip(maskStack, tomoStack)]
-                resultingStack = ImageStack(resultingImgList)
-                MRCImageReader.write(resultingStack, self._getResultFn(tsId), samplingRate=tomoSRate)
+                self.applyMask(maskFileName, tomoFileName, self._getResultFn(tsId), tomoSRate,
+                               workers=self._getSlabWorkers())
                 # Remove the smoothed mask from the protocol tmp directory to avoid the storage of multiple
                 # big temporal files in execution time at once
                 if self.doSmooth:
@@ -239,6 +308,46 @@ class ProtTomoApplyTomoMask(EMProtocol):
             self._store(failedDimsTsIdList)
 
     # --------------------------- UTILS functions -----------------------------
+    @staticmethod
+    def processMask(maskFileName: str, outFileName: str, samplingRate: float, dilationPixels: int = 0,
+                    sigma: float = 3, invert: bool = False, workers: int = 1) -> None:
+        """ Dilates, smooths with a gaussian filter and, if required, inverts a mask, processing it by Z slabs.
+        :param maskFileName: input mask.
+        :param outFileName: resulting float32 mask.
+        :param samplingRate: voxel size of the resulting mask.
+        :param dilationPixels: number of iterations of the binary dilation (0 for no dilation).
+        :param sigma: standard deviation of the gaussian filter.
+        :param invert: if True, the resulting mask is 1 - smoothed mask.
+        :param workers: number of processes among which the slabs are distributed.
+        """
+        with mrcfile.mmap(maskFileName, mode='r', permissive=True) as mrc:
+            shape = mrc.data.shape
+        # The halo slices are filtered twice, so they are kept below half of each slab
+        writeVolumeBySlabs(outFileName, shape, samplingRate, _processMaskSlab,
+                           slabArgs=(maskFileName, dilationPixels, sigma, invert), workers=workers,
+                           minSlabSlices=4 * _getMaskHalo(dilationPixels, sigma))
+
+    @staticmethod
+    def applyMask(maskFileName: str, tomoFileName: str, outFileName: str, samplingRate: float,
+                  workers: int = 1) -> None:
+        """ Multiplies a tomogram by a mask of the same dimensions, processing them by Z slabs.
+        :param maskFileName: mask.
+        :param tomoFileName: tomogram.
+        :param outFileName: resulting float32 tomogram.
+        :param samplingRate: voxel size of the resulting tomogram.
+        :param workers: number of processes among which the slabs are distributed.
+        """
+        with mrcfile.mmap(tomoFileName, mode='r', permissive=True) as mrc:
+            shape = mrc.data.shape
+        writeVolumeBySlabs(outFileName, shape, samplingRate, _applyMaskSlab,
+                           slabArgs=(maskFileName, tomoFileName), workers=workers)
+
+    def _getSlabWorkers(self) -> int:
+        """ The threads are shared among the tomograms processed in parallel, and those assigned to each one are used
+        as processes to distribute its slabs. """
+        nThreads = max(self.numberOfThreads.get() or 1, 1)
+        return max(nThreads // min(nThreads, len(self.tomosDict)), 1)
+
     def _getFormAttrib(self, attribName: str):
         return getattr(self, attribName).get()
 
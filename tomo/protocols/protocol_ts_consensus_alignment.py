@@ -26,7 +26,6 @@
 import logging
 logger = logging.getLogger(__name__)
 
-import math
 import numpy as np
 
 from pwem.objects import Transform
@@ -100,15 +99,11 @@ class ProtConsensusAlignmentTS(EMProtocol, ProtTomoBase):
 
             for sots in self.inputMultiSoTS:
                 ts = sots.get().getTiltSeriesFromTsId(tsId)
-
-                M = []
-
-                for ti in ts:
-                    M.append(ti.getTransform().getMatrix())
-
-                Mset.append(M)
+                Mset.append(ts.toArrays([TiltImage.TRANSFORM_MATRIX_FIELD])[TiltImage.TRANSFORM_MATRIX_FIELD])
                 SRset.append(ts.getSamplingRate())
 
+            Mset = np.stack(Mset)
+
             self.info("\nAnalyzing tilt series " + tsId + "...")
 
             shiftTolPx = round(self.shiftTolerance.get() / SRset[0])
@@ -141,14 +136,15 @@ class ProtConsensusAlignmentTS(EMProtocol, ProtTomoBase):
                     newTi.setLocation(ti.getLocation())
 
                     transform = Transform()
-                    if averageAlignmentV[i] is None:
-                        newTi.setEnabled(False)
-                    else:
+                    tiConsensus = not np.isnan(angleSDV[i])
+                    if tiConsensus:
                         transform.setMatrix(averageAlignmentV[i])
+                    else:
+                        newTi.setEnabled(False)
                     newTi.setTransform(transform)
 
-                    newTi._angleStd = Float(angleSDV[i])
-                    newTi._shiftStd = Float(shiftSDV[i])
+                    newTi._angleStd = Float(angleSDV[i] if tiConsensus else None)
+                    newTi._shiftStd = Float(shiftSDV[i] if tiConsensus else None)
 
                     newTs.append(newTi)
 
@@ -198,301 +194,159 @@ class ProtConsensusAlignmentTS(EMProtocol, ProtTomoBase):
     # --------------------------- UTILS functions ----------------------------
     @staticmethod
     def compareTransformationMatricesGlobal(Mset, shiftTol, angleTol, SRset):
-
+        """ Global consensus of the alignments of a tilt-series: a pair of alignments agrees if the angle and shift
+        errors of all the tilt-images are within the tolerances. While there are disagreements, the alignment that
+        disagrees with more of the previous ones is discarded, together with its sampling rate.
+        :param Mset: transformation matrices of the tilt-series in each set, as an array of shape (Nsets, Nti, 3, 3).
+        :param shiftTol: shift tolerance (pixels).
+        :param angleTol: angle tolerance (degrees).
+        :param SRset: sampling rate of the tilt-series in each set.
+        :return: average alignment matrices (Nti, 3, 3) and standard deviations of their angles and shifts (Nti), or
+        None, None, None if there is no consensus.
+        :raise ValueError: if the rotation of an alignment matrix of the consensus is not valid.
+        """
         logger.info("Running global consensus alignment...")
 
-        Nts = len(Mset)
-
-        # If there is only one matrix in Mset then there has been no consensus in the recursion.
-        if Nts < 2:
-            logger.info("No consensus achieved for this tilt-series.")
-            return None, None, None
-
-        Nti = len(Mset[0])
-
-        logger.info("Number of tilt-series analyzed: " + str(Nts))
-        logger.info("Number of tilt-images per tilt-series analyzed: " + str(Nti))
-
-        # Matrix reporting consensus between each pair of tilt series
-        consensusAlignmentMatrix = np.zeros((Nts, Nts))
-
-        # Compare each pair of matrices
-        for j in range(Nts):
-            for k in range(j + 1, Nts):
-                # Calculate the sampling factor between the two matrices (for comparing shifts)
-                samplingFactor = SRset[k] / SRset[j]
-
-                # Calculate p matrix for the pair of tilt-series
-                p = np.zeros((3, 3))
-
-                for i in range(Nti):  # Iterate each tilt-image
-                    sampledMatrix = Mset[k][i].copy()
-                    sampledMatrix[0, 2] *= samplingFactor
-                    sampledMatrix[1, 2] *= samplingFactor
-
-                    p += np.matmul(Mset[j][i], np.linalg.inv(sampledMatrix))
-
-                # Calculate error matrix given a calculated p matrix (for a pair of matrices)
-                p /= Nti  # Normalized by the number of comparisons performed
-
-                detectedMisali = False
-
-                # Calculate error matrix for the pair of tilt-series.
-                for i in range(Nti):  # Iterate each tilt-image
-                    # Only use p matrix to correct for shiftY in case there exist an Y offset in the whole series
-                    matrixShiftYCorrected = Mset[k][i].copy()
-                    matrixShiftYCorrected[0, 2] *= samplingFactor
-                    matrixShiftYCorrected[1, 2] *= samplingFactor
-                    matrixShiftYCorrected[1, 2] += p[1][2]
-
-                    pError = Mset[j][i] - matrixShiftYCorrected
-
-                    # Angle from pTotalError matrix
-                    cosRotationAngle = pError[0][0]
-                    sinRotationAngle = pError[1][0]
-
-                    if math.isnan(sinRotationAngle / cosRotationAngle):
-                        angleError = 0
-                    else:
-                        angleError = math.degrees(math.asin(sinRotationAngle))
-
-                    # Shifts from pError matrix
-                    shiftX = pError[0][2]
-                    shiftY = pError[1][2]
-
-                    if abs(shiftX) > shiftTol or abs(shiftY) > shiftTol or abs(angleError) > angleTol:
-                        detectedMisali = True
-
-                if detectedMisali:
-                    logger.info(
-                        "No consensus achieved between tilt-series " + str(j) + " and tilt-series " + str(k))
-                    consensusAlignmentMatrix[j][k] = 1
-
-        colOnes = []
-        rowOnes = []  # This should be a star wars Easter Egg
-
-        indexFailed = np.sum(consensusAlignmentMatrix, axis=0)
-
-        for i in range(Nts):
-            for j in range(Nts):
-                if consensusAlignmentMatrix[i][j] == 1:
-                    rowOnes.append(i)
-                    colOnes.append(j)
-
-        if indexFailed[np.argmax(indexFailed)] != 0:
-            discardedIndexes = [np.argmax(indexFailed)]
-        else:
-            discardedIndexes = []
-
-        discardedIndexes.sort(reverse=True)
-
-        if len(discardedIndexes) != 0:
-            for n in discardedIndexes:
-                del Mset[n]
-            return ProtConsensusAlignmentTS.compareTransformationMatricesGlobal(Mset, shiftTol, angleTol, SRset)
-        else:
-            logger.info("\nConsensus achieved for this tilt-series.")
-            averageAlignmentV = []
-            angleSDV = []
-            shiftSDV = []
-
-            for i in range(Nti):
-                averageMatrix = np.zeros((3, 3))
-                angleV = []
-                shiftV = []
-
-                for j in range(Nts):
-                    # Calculate the sampling factor between the two matrices (for comparing shifts)
-                    samplingFactor = SRset[j] / SRset[0]
-
-                    sampledMatrix = Mset[j][i].copy()
-                    sampledMatrix[0, 2] *= samplingFactor
-                    sampledMatrix[1, 2] *= samplingFactor
-
-                    m = sampledMatrix.copy()
-
-                    # Calculate average alignment
-                    averageMatrix += m
-
-                    # Angle from average alignment matrix
-                    sinRotationAngle = m[1][0]
-                    angle = math.degrees(math.asin(sinRotationAngle))
-
-                    # Shifts from average alignment matrix
-                    shiftX = m[0][2]
-                    shiftY = m[1][2]
-
-                    angleV.append(angle)
-                    shiftV.append((shiftX + shiftY) / 2)
-
-                angleSDV.append(np.std(angleV))
-                shiftSDV.append(np.std(shiftV))
-
-                averageMatrix /= Nts
-                averageAlignmentV.append(averageMatrix)
-
-            return averageAlignmentV, angleSDV, shiftSDV
+        Mset = np.asarray(Mset, dtype=float)
+        SR = np.asarray(SRset, dtype=float)
+        while len(Mset) > 1:
+            Nts, Nti = Mset.shape[:2]
+
+            logger.info("Number of tilt-series analyzed: " + str(Nts))
+            logger.info("Number of tilt-images per tilt-series analyzed: " + str(Nti))
+
+            J, K, _, angleErrors, shiftXErrors, shiftYErrors = \
+                ProtConsensusAlignmentTS._compareTransformationMatrices(Mset, SR)
+            # The errors that are not a number (e.g. an angle whose sine is out of [-1, 1]) are misalignments too
+            misaligned = (~(np.abs(shiftXErrors) <= shiftTol) |
+                          ~(np.abs(shiftYErrors) <= shiftTol) |
+                          ~(np.abs(angleErrors) <= angleTol)).any(axis=1)
+
+            if not misaligned.any():
+                logger.info("\nConsensus achieved for this tilt-series.")
+                sampledMatrices = ProtConsensusAlignmentTS._scaleShifts(Mset, (SR / SR[0])[:, None])
+                angles = ProtConsensusAlignmentTS._getRotationAngles(sampledMatrices)
+                if np.isnan(angles).any():
+                    raise ValueError("The rotation of some alignment matrices is not valid: the sine of their angle "
+                                     "is out of [-1, 1].")
+                shifts = (sampledMatrices[..., 0, 2] + sampledMatrices[..., 1, 2]) / 2
+                return sampledMatrices.mean(axis=0), angles.std(axis=0), shifts.std(axis=0)
+
+            for j, k in zip(J[misaligned], K[misaligned]):
+                logger.info("No consensus achieved between tilt-series " + str(j) + " and tilt-series " + str(k))
+
+            # Discard the alignment that disagrees with more of the previous ones
+            indexFailed = np.bincount(K[misaligned], minlength=Nts)
+            Mset = np.delete(Mset, np.argmax(indexFailed), axis=0)
+            SR = np.delete(SR, np.argmax(indexFailed))
+
+        logger.info("No consensus achieved for this tilt-series.")
+        return None, None, None
 
     @staticmethod
     def compareTransformationMatricesLocal(Mset, shiftTol, angleTol, SRset):
-
+        """ Local consensus of the alignments of a tilt-series: the alignments agreeing with any other one are averaged
+        for each tilt-image, correcting their y shift offset with respect to the first of them.
+        :param Mset: transformation matrices of the tilt-series in each set, as an array of shape (Nsets, Nti, 3, 3).
+        :param shiftTol: shift tolerance (pixels).
+        :param angleTol: angle tolerance (degrees).
+        :param SRset: sampling rate of the tilt-series in each set.
+        :return: average alignment matrices (Nti, 3, 3) and standard deviations of their angles and shifts (Nti), set
+        to NaN for the tilt-images with no consensus, or None, None, None if there is no consensus for any tilt-image.
+        """
         logger.info("Running local consensus alignment...")
 
-        Nts = len(Mset)
-        Nti = len(Mset[0])
+        Mset = np.asarray(Mset, dtype=float)
+        Nts, Nti = Mset.shape[:2]
 
         logger.info("Number of tilt-series analyzed: " + str(Nts))
         logger.info("Number of tilt-images per tilt-series analyzed: " + str(Nti))
 
-        # 2D-array saving all p matrices for each pair of comparisons. Keys follow #tsX_#tsY being p the matrix that
-        # spams X set onto Y set
-        P_dict = {}
-
-        # Array saving the final consensus alignment
-        averageAlignmentV = []
-        angleSDV = []
-        shiftSDV = []
-
-        # Calculate p matrix for each
-        for j in range(Nts):
-            for k in range(j + 1, Nts):
-                # Calculate the sampling factor between the two matrices (for comparing shifts)
-                samplingFactor = SRset[k] / SRset[j]
-
-                # Calculate p matrix for the pair of tilt-series
-                p = np.zeros((3, 3))
-
-                for i in range(Nti):  # Iterate each tilt-image
-                    sampledMatrix = Mset[k][i].copy()
-                    sampledMatrix[0, 2] *= samplingFactor
-                    sampledMatrix[1, 2] *= samplingFactor
-
-                    p += np.matmul(Mset[j][i], np.linalg.inv(sampledMatrix))
-
-                # Calculate error matrix given a calculated p matrix (for a pair of matrices)
-                p /= Nti  # Normalized by the number of comparisons performed
-
-                key = "%d_%d" % (j, k)
-                P_dict.update({key: p})
-
-        # Apply consensus over each tilt-image
-        for i in range(Nti):  # Iterate each tilt-image
-            logger.info("Analyzing image " + str(i))
-
-            tiConsensusAlignment = np.zeros((3, 3))
-
-            angleV = []
-            shiftV = []
-
-            # Save all indexes that consensus for this tilt-image
-            consensusIndexes = []
-
-            for j in range(Nts):
-                for k in range(j + 1, Nts):
-                    logger.info("Comparing matrices from series " + str(j) + " and " + str(k))
-                    # Matrix p for each pair of sets
-                    key = "%d_%d" % (j, k)
-                    p = P_dict[key]
-
-                    # Calculate the sampling factor between the two matrices (for comparing shifts)
-                    samplingFactor = SRset[k] / SRset[j]
-
-                    # Only use p matrix to correct for shiftY in case there exist an Y offset in the whole series
-                    matrixShiftYCorrected = Mset[k][i].copy()
-                    matrixShiftYCorrected[0, 2] *= samplingFactor
-                    matrixShiftYCorrected[1, 2] *= samplingFactor
-                    matrixShiftYCorrected[1, 2] += p[1][2]
-
-                    pError = Mset[j][i] - matrixShiftYCorrected
+        J, K, p, angleErrors, shiftXErrors, shiftYErrors = \
+            ProtConsensusAlignmentTS._compareTransformationMatrices(Mset, SRset)
+        agreements = ((np.abs(shiftXErrors) < shiftTol) &
+                      (np.abs(shiftYErrors) < shiftTol) &
+                      (np.abs(angleErrors) < angleTol))
 
-                    # Angle from pTotalError matrix
-                    cosRotationAngle = pError[0][0]
-                    sinRotationAngle = pError[1][0]
+        # Alignments that agree with any other one for each tilt-image
+        consensus = np.zeros((Nts, Nti), dtype=bool)
+        np.logical_or.at(consensus, J, agreements)
+        np.logical_or.at(consensus, K, agreements)
+        tiConsensus = consensus.any(axis=0)
 
-                    if math.isnan(sinRotationAngle / cosRotationAngle):
-                        angleError = 0
-                    else:
-                        angleError = math.degrees(math.asin(sinRotationAngle))
-
-                    # Shifts from pError matrix
-                    shiftX = pError[0][2]
-                    shiftY = pError[1][2]
-
-                    if abs(shiftX) < shiftTol and abs(shiftY) < shiftTol and abs(angleError) < angleTol:
-                        logger.info("Consensus achieved for " + str(j) + " and " + str(k))
-                        consensusIndexes.append(j)
-                        consensusIndexes.append(k)
-
-            # Remove repeated indexes
-            consensusIndexes = list(dict.fromkeys(consensusIndexes))
-
-            if not consensusIndexes:
-                logger.info("No consensus achieved for tilt-image " + str(i))
-                averageAlignmentV.append(None)
-                angleSDV.append(None)
-                shiftSDV.append(None)
-
-            else:
-                logger.info("Consensus achieved for tilt-image " + str(i))
-
-                tiConsensusAlignment += Mset[0][i]
-                numberOfConsensusAlignment = len(consensusIndexes)
-
-                # Angle from alignment matrix
-                if math.isnan(Mset[0][i][1][0] / Mset[0][i][0][0]):
-                    angleV.append(0)
-                else:
-                    angleV.append(math.degrees(math.asin(Mset[0][i][1][0])))
-
-                # Shifts from average alignment matrix
-                shiftX = Mset[0][i][0][2]
-                shiftY = Mset[0][i][1][2]
-
-                shiftV.append((shiftX + shiftY) / 2)
-
-                for m in range(1, numberOfConsensusAlignment):
-                    # p matrix for this pair of matrices
-                    key = "%d_%d" % (consensusIndexes[0], consensusIndexes[m])
-                    p = P_dict[key]
-
-                    # Calculate the sampling factor between the two matrices (for comparing shifts)
-                    samplingFactor = SRset[consensusIndexes[0]] / SRset[consensusIndexes[m]]
-
-                    # Only use p matrix to correct for shiftY in case there exist an Y offset in the whole series
-                    matrixShiftYCorrected = Mset[consensusIndexes[m]][i].copy()
-                    matrixShiftYCorrected[0, 2] *= samplingFactor
-                    matrixShiftYCorrected[1, 2] *= samplingFactor
-                    matrixShiftYCorrected[1, 2] += p[1][2]
+        if not tiConsensus.any():
+            return None, None, None
 
-                    tiConsensusAlignment += matrixShiftYCorrected
+        for i in np.flatnonzero(~tiConsensus):
+            logger.info("No consensus achieved for tilt-image " + str(i))
 
-                    # Angle from alignment matrix
-                    if math.isnan(matrixShiftYCorrected[1][0] / matrixShiftYCorrected[0][0]):
-                        angleV.append(0)
-                    else:
-                        angleV.append(math.degrees(math.asin(matrixShiftYCorrected[1][0])))
+        # The matrices of the first set and those of the rest of agreeing alignments, brought to the sampling rate of
+        # the first of them and corrected by the y shift offset of their p matrix, are averaged
+        SR = np.asarray(SRset, dtype=float)
+        correctedMatrices = ProtConsensusAlignmentTS._scaleShifts(Mset[K], (SR[J] / SR[K])[:, None])
+        correctedMatrices[..., 1, 2] += p[:, None, 1, 2]
+        matrices = np.concatenate([Mset[:1], correctedMatrices])
+        weights = np.concatenate([np.ones((1, Nti), dtype=bool),
+                                  (J[:, None] == np.argmax(consensus, axis=0)) & consensus[K]])
+        nAlignments = weights.sum(axis=0)
 
-                    # Shifts from average alignment matrix
-                    shiftX = matrixShiftYCorrected[0][2]
-                    shiftY = matrixShiftYCorrected[1][2]
+        averageAlignments = np.einsum('pi,pijk->ijk', weights.astype(float), matrices) / nAlignments[:, None, None]
+        angleSDs = ProtConsensusAlignmentTS._weightedStd(
+            ProtConsensusAlignmentTS._getRotationAngles(matrices), weights)
+        shiftSDs = ProtConsensusAlignmentTS._weightedStd((matrices[..., 0, 2] + matrices[..., 1, 2]) / 2, weights)
 
-                    shiftV.append((shiftX + shiftY) / 2)
+        averageAlignments[~tiConsensus] = np.nan
+        angleSDs[~tiConsensus] = np.nan
+        shiftSDs[~tiConsensus] = np.nan
 
-                # Calculate STD angles
-                angleSDV.append(np.std(angleV))
+        return averageAlignments, angleSDs, shiftSDs
 
-                # Calculate STD shifts
-                shiftSDV.append(np.std(shiftV))
+    @staticmethod
+    def _compareTransformationMatrices(Mset, SRset):
+        """ Compares the alignments of each pair of sets j < k. The matrices of k are brought to the sampling rate of
+        j, its p matrix is the mean of the relative transforms from k to j and the errors are calculated after
+        correcting the y shift offset between both given by p.
+        :param Mset: array of shape (Nsets, Nti, 3, 3).
+        :param SRset: sampling rate of each set.
+        :return: indices j and k of the pairs, their p matrices (Npairs, 3, 3) and the angle, x shift and y shift
+        errors (Npairs, Nti).
+        """
+        J, K = np.triu_indices(len(Mset), 1)
+        SR = np.asarray(SRset, dtype=float)
+        sampledMatrices = ProtConsensusAlignmentTS._scaleShifts(Mset[K], (SR[K] / SR[J])[:, None])
+        p = np.einsum('pnij,pnjk->pik', Mset[J], np.linalg.inv(sampledMatrices)) / Mset.shape[1]
+
+        # Only use p matrix to correct for shiftY in case there exist an Y offset in the whole series
+        sampledMatrices[..., 1, 2] += p[:, None, 1, 2]
+        pErrors = Mset[J] - sampledMatrices
+
+        angleErrors = ProtConsensusAlignmentTS._getRotationAngles(pErrors)
+        return J, K, p, angleErrors, pErrors[..., 0, 2], pErrors[..., 1, 2]
 
-                tiConsensusAlignment /= numberOfConsensusAlignment
-                averageAlignmentV.append(tiConsensusAlignment)
+    @staticmethod
+    def _scaleShifts(matrices, samplingFactors):
+        """ Returns a copy of the matrices with their shifts multiplied by the sampling factors, broadcast over all
+        the dimensions but the last two ones. """
+        scaledMatrices = np.array(matrices, dtype=float)
+        scaledMatrices[..., :2, 2] *= np.asarray(samplingFactors)[..., None]
+        return scaledMatrices
 
-        # Check if all images are misaligned
-        for a in averageAlignmentV:
-            if a is not None:
-                return averageAlignmentV, angleSDV, shiftSDV
+    @staticmethod
+    def _getRotationAngles(matrices):
+        """ Returns the rotation angles (degrees) of the matrices. The angle is 0 for the matrices whose sin / cos is
+        not a number, and NaN for those whose sin is out of [-1, 1]. """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angles = np.degrees(np.arcsin(matrices[..., 1, 0]))
+            angles[np.isnan(matrices[..., 1, 0] / matrices[..., 0, 0])] = 0
+        return angles
 
-        return None, None, None
+    @staticmethod
+    def _weightedStd(values, weights):
+        """ Standard deviation along the first axis of the values whose weight is True. """
+        values = np.where(weights, values, 0)
+        n = weights.sum(axis=0)
+        mean = values.sum(axis=0) / n
+        return np.sqrt((weights * (values - mean) ** 2).sum(axis=0) / n)
 
     def generateTsIdList(self):
         resultSet = set(self.inputMultiSoTS[0].get().getUniqueValues('_tsId'))
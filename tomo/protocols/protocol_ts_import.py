@@ -26,6 +26,7 @@
 import logging
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from datetime import datetime
 from collections import OrderedDict
@@ -45,8 +46,8 @@ from pyworkflow.utils.properties import Message
 from pwem.emlib.image import ImageHandler
 from pwem.protocols import ProtImport
 from tomo.convert import getAnglesFromHeader, getAnglesFromMdoc, getAnglesAndDosesFromTlt
-from tomo.convert.mdoc import normalizeTSId, MDoc
-from tomo.objects import TomoAcquisition, SetOfTiltSeries, SetOfTiltSeriesM
+from tomo.convert.mdoc import normalizeTSId, MDoc, MDocCache
+from tomo.objects import TomoAcquisition, SetOfTiltSeries, SetOfTiltSeriesM, appendItems
 from .protocol_base import ProtTomoBase, ProtTomoImportFiles
 
 logger = logging.getLogger(__name__)
@@ -68,6 +69,8 @@ class ProtImportTsBase(ProtTomoImportFiles):
     ANGLES_FROM_TLT = 'Tlt file'
     ANGLES_FROM_RANGE = 'Range'
 
+    MDOC_CACHE_FILE = 'mdocs_cache.sqlite'
+
     NOT_MDOC_GUI_COND = ('filesPattern is None or ' +
                          '(filesPattern is not None and ".mdoc" ' +
                          'not in filesPattern)')
@@ -183,6 +186,9 @@ class ProtImportTsBase(ProtTomoImportFiles):
 
         self._defineBlacklistParams(form)
 
+        # The threads are used to read the mdoc files and to list the input files
+        form.addParallelSection(threads=1, mpi=0)
+
     def _defineAngleParam(self, form):
         """ Used in subclasses to define the option to fetch tilt angles. """
         pass
@@ -279,12 +285,19 @@ class ProtImportTsBase(ProtTomoImportFiles):
         # Get files that matches the pattern via mdoc or not
         matchingFiles = self.getMatchingFiles()
 
+        # I/O stage: the files of all the tilt-series are copied or linked concurrently, while the tilt-series are
+        # registered below, in the matching order, by this thread, which is the only one writing to the sqlite
+        executor = ThreadPoolExecutor(max_workers=self._getNumberOfWorkers())
+        ioFutures = {ts: executor.submit(self._copyOrLinkTsFiles, tiltSeriesList)
+                     for ts, tiltSeriesList in matchingFiles.items()}
+        executor.shutdown(wait=False)
 
         # Go through all of them
-        for ts, tiltSeriesList in matchingFiles.items():
+        for ts in matchingFiles:
             try:
                 self.info("Tilt series found: %s" % ts)
                 someNew = True
+                tiltSeriesList = ioFutures.pop(ts).result()
                 tsObj = tsClass(tsId=ts)
                 # Form value has higher priority than the mdoc values
                 samplingRate = \
@@ -311,7 +324,7 @@ class ProtImportTsBase(ProtTomoImportFiles):
                 tiltAngles =  [float(tiData[2]) for tiData in tiltSeriesList]
                 accumDoseTs = 0
                 tiltAngles = sorted(tiltAngles)
-                tsAcq = tsObj.getAcquisition().clone()
+                tsAcq = tsObj.getAcquisition()
                 maxTilt = tiltAngles[-1]
                 minTilt = tiltAngles[0]
                 step = round(mean([tiltAngles[i + 1] - tiltAngles[i] for i in range(len(tiltAngles) - 1)]))
@@ -324,26 +337,20 @@ class ProtImportTsBase(ProtTomoImportFiles):
                 tsAcq.setAngleMax(maxTilt)
                 tsAcq.setStep(step)
 
+                # The tilt images only differ in the doses, so they share a single acquisition object per TS, whose
+                # doses are set right before inserting each of them
+                tiAcq = tsAcq.clone()
+
                 # Add each tilt images to the tiltSeries
                 for f, to, ta, accDose in tiltSeriesList:
                     try:
-                        # Link/move to extra
-                        imageFile = f[1] if type(f) is tuple else f
-
-                        # Double underscore is used in EMAN to determine set type e.g. phase flipped particles. We replace
-                        # it by a single underscore to avoid possible problems if the user uses EMAN
-                        finalDestination = self._getExtraPath(os.path.basename(imageFile))
-                        finalDestination = finalDestination.replace('__', '_')
-                        self.copyOrLink(imageFile, finalDestination)
-
-                        f = (f[0], finalDestination) if type(f) is tuple else finalDestination
-
                         logger.debug(f"Adding TiltImage( tilt={ta}, aqOrder={to} to the tilt serie.")
-                        ti = tiClass(location=f,
+                        ti = tiClass(tsId=ts,
+                                     location=f,
                                      acquisitionOrder=to,
                                      tiltAngle=ta)
+                        ti.setSamplingRate(tsObj.getSamplingRate())
 
-                        tiAcq = tsAcq.clone()
                         # Calculate the dose
                         if self.MDOC_DATA_SOURCE:
                             dosePerFrame = incomingDoseList[counter]
@@ -355,14 +362,9 @@ class ProtImportTsBase(ProtTomoImportFiles):
                                 accDose = to * dosePerFrame
                             accumDoseTs = max(accumDoseTs, accDose)
                             initialDose = self.doseInitial.get() if to == 1 else accDose - dosePerFrame
-                        # Initial dose in current ti
-                        tiAcq.setDoseInitial(initialDose)
-                        # Incoming dose in current ti
-                        tiAcq.setDosePerFrame(dosePerFrame)
-                        # Accumulated dose in current ti
-                        tiAcq.setAccumDose(accDose)
                         ti.setAcquisition(tiAcq)
-                        tiltSeriesObjList.append(ti)
+                        # Initial dose, incoming dose and accumulated dose in current ti
+                        tiltSeriesObjList.append((ti, initialDose, dosePerFrame, accDose))
                         counter += 1
 
                     except OperationalError:
@@ -373,13 +375,22 @@ class ProtImportTsBase(ProtTomoImportFiles):
 
                 # Sort tilt image metadata if importing tilt series
                 if not self._isImportingTsMovies():
-                    tiltSeriesObjList.sort(key=lambda x: x.getTiltAngle(),
+                    tiltSeriesObjList.sort(key=lambda x: x[0].getTiltAngle(),
                                            reverse=False)
 
-                for ti in tiltSeriesObjList:
-                    tsObj.append(ti)
+                def iterTiltImages():
+                    for ti, initialDose, dosePerFrame, accDose in tiltSeriesObjList:
+                        tiAcq.setDoseInitial(initialDose)
+                        tiAcq.setDosePerFrame(dosePerFrame)
+                        tiAcq.setAccumDose(accDose)
+                        yield ti  # The acquisition values are read when the tilt image is yielded
+
+                # All the tilt images are inserted with a single statement
+                appendItems(tsObj, iterTiltImages())
 
-                tsObjFirstItem = tsObj.getFirstItem()
+                # The first tilt image inserted is already in memory. Selecting it from the set would also leave a
+                # pending statement in the shared connection, keeping the database locked when the set is closed
+                tsObjFirstItem = tiltSeriesObjList[0][0]
                 origin.setShifts(-tsObjFirstItem.getXDim() / 2 * samplingRate,
                                  -tsObjFirstItem.getYDim() / 2 * samplingRate,
                                  0)
@@ -623,33 +634,47 @@ class ProtImportTsBase(ProtTomoImportFiles):
         warningHeadMsg = 'The following mdoc files were skipped:\n'
         warningDetailedMsg = []
         skippedMdocs = 0
+        mdocCache = self._getMdocCache()
+
+        # Note: voltage, magnification and sampling rate values are the
+        # ones introduced by the user in the protocol's form.
+        # Otherwise, the corresponding values considered will be the ones
+        # read from the mdoc.
+        # This is because you can't trust mdoc
+        # (often dose is not calibrated in serialEM, so you get 0;
+        # pixel size might be binned as mdoc comes from a binned record
+        # not movie and there are no Cs and amp contrast fields in mdoc)
+        mdocKwargs = dict(
+            voltage=self.voltage.get() if self.voltage.get() else None,
+            magnification=(self.magnification.get()
+                           if self.magnification.get()
+                           else None),
+            samplingRate=(self.samplingRate.get()
+                          if self.samplingRate.get()
+                          else None),
+            doseProvidedByUser=(self.dosePerFrame.get()
+                                if self.dosePerFrame.get()
+                                else None),
+            tiltAngleProvidedByUser=(self.tiltAxisAngle.get()
+                                     if self.tiltAxisAngle.get()
+                                     else None),
+            cache=mdocCache)
+        isImportingTsMovies = self._isImportingTsMovies()
+
+        def _readMdoc(mdoc):
+            mdocObj = MDoc(mdoc, **mdocKwargs)
+            return mdocObj, mdocObj.read(isImportingTsMovies=isImportingTsMovies)
+
+        # The mdoc files are read and validated concurrently, as it is mostly I/O, but the results are collected
+        # in the glob order, so they are the same as in a serial read
+        workers = min(self._getNumberOfWorkers(), len(mdocList))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                mdocResults = list(executor.map(_readMdoc, mdocList))
+        else:
+            mdocResults = [_readMdoc(mdoc) for mdoc in mdocList]
 
-        for mdoc in mdocList:
-            # Note: voltage, magnification and sampling rate values are the
-            # ones introduced by the user in the protocol's form.
-            # Otherwise, the corresponding values considered will be the ones
-            # read from the mdoc.
-            # This is because you can't trust mdoc
-            # (often dose is not calibrated in serialEM, so you get 0;
-            # pixel size might be binned as mdoc comes from a binned record
-            # not movie and there are no Cs and amp contrast fields in mdoc)
-            mdocObj = MDoc(
-                mdoc,
-                voltage=self.voltage.get() if self.voltage.get() else None,
-                magnification=(self.magnification.get()
-                               if self.magnification.get()
-                               else None),
-                samplingRate=(self.samplingRate.get()
-                              if self.samplingRate.get()
-                              else None),
-                doseProvidedByUser=(self.dosePerFrame.get()
-                                    if self.dosePerFrame.get()
-                                    else None),
-                tiltAngleProvidedByUser=(self.tiltAxisAngle.get()
-                                         if self.tiltAxisAngle.get()
-                                         else None))
-            validationError = mdocObj.read(
-                isImportingTsMovies=self._isImportingTsMovies())
+        for mdoc, (mdocObj, validationError) in zip(mdocList, mdocResults):
             hasDoseList.append(mdocObj.mdocHasDose)
             if validationError:
                 warningHeadMsg += '    %s\n' % mdoc
@@ -686,6 +711,8 @@ class ProtImportTsBase(ProtTomoImportFiles):
             self.accumDoses[tsId] = accumulatedDoseList
             self.incomingDose[tsId] = incomingDoseList
 
+        if mdocCache:
+            mdocCache.close()
         if isValidation:
             if matchingFiles:
                 if warningDetailedMsg:
@@ -698,6 +725,19 @@ class ProtImportTsBase(ProtTomoImportFiles):
         else:
             return matchingFiles
 
+    def _getMdocCache(self):
+        """Returns the persistent cache of parsed mdoc files, stored in the project Tmp folder, so the mdoc files
+        are not parsed again in the validation and the import, nor in other import protocols of the same project."""
+        project = self.getProject()
+        if project is None:
+            return None
+        tmpPath = join(project.path, project.getTmpPath())
+        return MDocCache(join(tmpPath, self.MDOC_CACHE_FILE)) if exists(tmpPath) else None
+
+    def _getNumberOfWorkers(self):
+        """ Number of threads used to read the mdoc files and to list the input files. """
+        return max(self.numberOfThreads.get() or 1, 1)
+
     def _isImportingTsMovies(self):
         return True if type(self) is ProtImportTsMovies else False
 
@@ -726,10 +766,8 @@ class ProtImportTsBase(ProtTomoImportFiles):
             return self._getMatchingFilesFromRegExPattern()
 
     def _getMatchingFilesFromRegExPattern(self):
-        filePaths = glob(self._globPattern)
-        filePaths = self._excludeByWords(filePaths)
-
-        filePaths.sort(key=lambda fn: os.path.getmtime(fn))
+        # Files sorted by modification time, with their regex matches
+        fileMatches = self._scanFiles(self._globPattern, self._regex, workers=self._getNumberOfWorkers())
 
         matchingFiles = OrderedDict()
 
@@ -782,8 +820,8 @@ class ProtImportTsBase(ProtTomoImportFiles):
 
         # Handle special case of just one TiltSeries, to avoid
         # the user the need to specify {TS}
-        if len(filePaths) == 1 and not self.isInStreaming():
-            f = filePaths[0]
+        if len(fileMatches) == 1 and not self.isInStreaming():
+            f = fileMatches[0][0]
             self.info("Single match: %s" % f)
             ts = pwutils.removeBaseExt(f)  # Base name without extension
             self.info("Raw tilt series id is %s." % ts)
@@ -792,8 +830,7 @@ class ProtImportTsBase(ProtTomoImportFiles):
             matchingFiles[ts] = []
             _addMany(matchingFiles[ts], f, None)
         else:
-            for f in filePaths:
-                m = self._regex.match(f)
+            for f, m in fileMatches:
                 if m is not None:
                     ts = _getTsId(m)
                     # Only report files of new tilt-series
@@ -815,6 +852,27 @@ class ProtImportTsBase(ProtTomoImportFiles):
         else:
             return pw.utils.createAbsLink
 
+    def _copyOrLinkTsFiles(self, tiltSeriesList):
+        """ Copies or links the files of a tilt-series into the extra folder. Returns the tilt-series list with
+        the files replaced by their final destination. """
+        destinations = {}  # The same stack file is used by all the tilt images when the angles are not in the pattern
+        newTiltSeriesList = []
+        for f, to, ta, accDose in tiltSeriesList:
+            # Link/move to extra
+            imageFile = f[1] if type(f) is tuple else f
+            finalDestination = destinations.get(imageFile)
+            if finalDestination is None:
+                # Double underscore is used in EMAN to determine set type e.g. phase flipped particles. We replace
+                # it by a single underscore to avoid possible problems if the user uses EMAN
+                finalDestination = self._getExtraPath(os.path.basename(imageFile))
+                finalDestination = finalDestination.replace('__', '_')
+                self.copyOrLink(imageFile, finalDestination)
+                destinations[imageFile] = finalDestination
+
+            f = (f[0], finalDestination) if type(f) is tuple else finalDestination
+            newTiltSeriesList.append((f, to, ta, accDose))
+        return newTiltSeriesList
+
     def copyOrLink(self, source, destination):
         """ Calls the copy or link method chosen by
             the user in importAction option"""
@@ -24,12 +24,18 @@
 # *
 # **************************************************************************
 
+import os
+import tracemalloc
+from unittest.mock import patch
 
-from pyworkflow.tests import setupTestProject
-from pyworkflow.utils import magentaStr
+import mrcfile
+from pwem.objects import SetOfMicrographs, Micrograph
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import magentaStr, cleanPath
 from pwem.protocols import ProtImportMovies
 from . import DataSet, RE_STA_TUTO_MOVIES, DataSetRe4STATuto, TS_03, TS_54, DataSet_RE_STA_TUTO_MOVIES
 from .test_base_centralized_layer import TestBaseCentralizedLayer
+from .test_mdoc import MDOC_HEADER, MDOC_SLICE
 from pyworkflow.plugin import Domain
 from tomo.protocols.protocol_compose_TS import ProtComposeTS
 from motioncorr.protocols import ProtMotionCorr
@@ -149,4 +155,143 @@ class TestTestTomoComposeTS(TestBaseCentralizedLayer):
 		                     anglesCount=anglesCount)
 
 
+class TestComposeTsMatching(BaseTest):
+	""" Tests that each streaming poll of the tilt-series composition only reads the new micrographs and mdoc files,
+	with a synthetic set of micrographs and mdoc files growing in streaming."""
 
+	@classmethod
+	def setUpClass(cls):
+		setupTestProject(cls)
+
+	def test_compose_polls(self):
+		nMics, nMdocs, nPolls = 2000, 30, 10
+		nTilts = nMics // nMdocs
+		mdocsPath = self.proj.getTmpPath('composeMdocs')
+		os.makedirs(mdocsPath)
+		micsFile = self.proj.getTmpPath('composeMics.sqlite')
+		micsSet = SetOfMicrographs(filename=micsFile)
+		micsSet.setSamplingRate(1.35)
+		micsSet.write()
+		micsSet.close()
+
+		prot = self.newProtocol(ProtComposeTS, filesPath=mdocsPath, mdocPattern='*.mdoc', time4NextTilt='20s')
+		prot.inputMicrographs.set(SetOfMicrographs(filename=micsFile))
+		prot._initialize()
+		composeCalls = []
+
+		def createTS(mdocObj, mdocOrderAngleList, mdocFile):
+			composeCalls.append((mdocFile, len(mdocOrderAngleList)))
+			prot.composedMdocs.add(mdocFile)
+
+		loadedMics = []
+
+		def loadInputList(loadNewMics=prot._loadInputList):
+			loadedMics.append(loadNewMics())
+			return loadedMics[-1]
+
+		micsPerPoll, mdocsPerPoll = nMics // nPolls, nMdocs // nPolls
+		with patch.object(prot, 'createTS', side_effect=createTS), \
+				patch.object(prot, '_loadInputList', side_effect=loadInputList), \
+				patch.object(prot, 'readMdoc', wraps=prot.readMdoc) as readMdoc:
+			for poll in range(nPolls):
+				# New micrographs and mdoc files, already closed, are acquired between polls
+				micsSet = SetOfMicrographs(filename=micsFile)
+				micsSet.enableAppend()
+				for i in range(poll * micsPerPoll, (poll + 1) * micsPerPoll):
+					micName = 'TS_%03i_%03i.tif' % divmod(i, nTilts) if i < nMdocs * nTilts else 'extra_%i.tif' % i
+					mic = Micrograph(location=os.path.join(mdocsPath, micName.replace('.tif', '.mrc')))
+					mic.setMicName(micName)
+					mic.setSamplingRate(1.35)
+					micsSet.append(mic)
+				micsSet.write()
+				micsSet.close()
+				newMdocs = []
+				for tsIndex in range(poll * mdocsPerPoll, (poll + 1) * mdocsPerPoll):
+					mdocFile = os.path.join(mdocsPath, 'TS_%03i.mdoc' % tsIndex)
+					with open(mdocFile, 'w') as f:
+						f.write(MDOC_HEADER)
+						for zValue in range(nTilts):
+							f.write(MDOC_SLICE.replace('TS_01_', 'TS_%03i_' % tsIndex) %
+									(zValue, -60 + 2 * zValue, zValue, '30-Nov-21  17:42:00'))
+					os.utime(mdocFile, (0, 1000 + tsIndex))
+					newMdocs.append(mdocFile)
+
+				readMdoc.reset_mock()
+				prot.composeAvailableTS(streamOpen=True)
+
+				# Only the new micrographs and mdoc files are read
+				self.assertEqual(micsPerPoll, loadedMics[-1], "Micrographs read again.")
+				self.assertEqual(newMdocs, [call.args[0] for call in readMdoc.call_args_list],
+								 "Wrong mdoc files read.")
+				self.assertEqual([(mdocFile, nTilts) for mdocFile in newMdocs], composeCalls[-mdocsPerPoll:],
+								 "Wrong tilt-series composed.")
+
+		self.assertEqual(nMics, len(prot.micsDict), "Wrong number of micrographs indexed.")
+		self.assertEqual(nMdocs, len(composeCalls), "Wrong number of tilt-series composed.")
+
+	def test_repeated_mic_names(self):
+		micsFile = self.proj.getTmpPath('repeatedMics.sqlite')
+		micsSet = SetOfMicrographs(filename=micsFile)
+		micsSet.setSamplingRate(1.35)
+		for i in range(3):
+			mic = Micrograph(location='mic_%i.mrc' % i)
+			mic.setMicName('TS_01_000.tif' if i < 2 else 'TS_01_001.tif')
+			micsSet.append(mic)
+		micsSet.write()
+		micsSet.close()
+
+		prot = self.newProtocol(ProtComposeTS, filesPath=self.proj.getTmpPath(), mdocPattern='*.mdoc')
+		prot.inputMicrographs.set(SetOfMicrographs(filename=micsFile))
+		prot._initialize()
+		self.assertEqual(3, prot._loadInputList(), "Wrong number of micrographs read.")
+		self.assertEqual(2, len(prot.micsDict), "Wrong number of micrographs indexed.")
+		self.assertEqual('mic_1.mrc', prot.micsDict[prot._getMicKey('TS_01_000.tif')].getFileName(),
+						 "The last micrograph with a repeated name is not the one used.")
+
+
+class TestComposeTsStack(BaseTest):
+	""" Tests the stack of the composed tilt-series is written without keeping all the tilts in memory."""
+
+	@classmethod
+	def setUpClass(cls):
+		cls.setupTestOutput()
+
+	def test_write_ts_stack(self):
+		nTilts, dim, nMics = 61, 4096, 3
+		# Few different micrographs are repeated to limit the disk space used by the input
+		micFiles = []
+		for i in range(nMics):
+			micFile = self.getOutputPath('mic_%i.mrc' % i)
+			with mrcfile.new_mmap(micFile, shape=(dim, dim), mrc_mode=2, overwrite=True) as micMrc:
+				micMrc.data[:] = i
+				micMrc.data[i, :dim // 2] = -1
+			micFiles.append(micFile)
+		sliceSize = dim * dim * np.dtype(np.float32).itemsize
+		tsFile = self.getOutputPath('ts_composed.mrcs')
+		self.addCleanup(cleanPath, tsFile)
+
+		for readThreads in [0, 1]:
+			tracemalloc.start()
+			try:
+				ProtComposeTS.writeTsStack(tsFile, [micFiles[i % nMics] for i in range(nTilts)], 1.35,
+										   readThreads=readThreads)
+				_, peakMemory = tracemalloc.get_traced_memory()
+			finally:
+				tracemalloc.stop()
+			self.assertLess(peakMemory, (1 + readThreads) * sliceSize * 1.05,
+							"Too many tilts kept in memory with %d reading threads." % readThreads)
+
+			with mrcfile.mmap(tsFile, mode='r') as tsMrc:
+				self.assertTrue(tsMrc.is_image_stack(), "The output is not a stack.")
+				self.assertEqual((nTilts, dim, dim), tsMrc.data.shape, "Wrong stack shape.")
+				self.assertAlmostEqual(1.35, float(tsMrc.voxel_size.x), places=5, msg="Wrong sampling rate.")
+				for i in [0, 1, 2, nTilts - 1]:
+					expected = np.full((dim, dim), i % nMics, dtype=np.float32)
+					expected[i % nMics, :dim // 2] = -1
+					self.assertTrue(np.array_equal(expected, tsMrc.data[i]), "Wrong slice %d." % i)
+				header = tsMrc.header
+				nValues = nTilts * dim * dim
+				nNegative = nTilts * dim // 2
+				dSum = sum(i % nMics for i in range(nTilts)) * (dim * dim - dim // 2) - nNegative
+				self.assertEqual((-1, 2), (float(header.dmin), float(header.dmax)), "Wrong header range.")
+				self.assertAlmostEqual(dSum / nValues, float(header.dmean), places=5, msg="Wrong header mean.")
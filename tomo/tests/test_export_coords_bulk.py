@@ -0,0 +1,126 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import os
+
+import numpy as np
+from pwem.objects import Transform
+from pyworkflow.tests import BaseTest
+from pyworkflow.utils import cleanPath, makePath
+from tomo.constants import BOTTOM_LEFT_CORNER, SCIPION
+from tomo.objects import SetOfTomograms, Tomogram, SetOfCoordinates3D, Coordinate3D, appendItems
+from tomo.protocols import ProtExportCoordinates3D
+
+SAMPLING_RATE = 10.2
+
+
+def txtLine(coord):
+    x, y, z = map(int, coord.getPosition(BOTTOM_LEFT_CORNER))
+    return f"{x} {y} {z}\n"
+
+
+def dynamoLine(coord):
+    x, y, z = coord.getPosition(BOTTOM_LEFT_CORNER)
+    return (f"{coord.getObjId()} 1 1 0 0 0 0 0 0 0 0 0 1 0 0 0 0 0 0 0 0 1 0 "
+            f"{x} {y} {z} 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
+
+
+def loopWriteTxt(inputCoords, exportPath, ext, coordLine):
+    """ Writes the coordinates one by one, as done by the protocol before reading them in bulk """
+    f = None
+    lastTomoId = None
+    for coord in inputCoords.iterCoordinates(orderBy="_tomoId"):
+        tomoId = coord.getTomoId()
+        if tomoId != lastTomoId:
+            if f:
+                f.close()
+            f = open(os.path.join(exportPath, f"{tomoId}.{ext}"), "w")
+            lastTomoId = tomoId
+        f.write(coordLine(coord))
+    if f:
+        f.close()
+
+
+class TestExportCoordinates3DBulk(BaseTest):
+    """ Compares the files exported reading the coordinates in bulk with those exported coordinate by coordinate."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _createCoordinates(self, nTomos, nCoords):
+        """ Creates a set of coordinates spread over tomograms of different sizes, appended in random tomogram order """
+        rng = np.random.default_rng(0)
+        suffix = '%d' % nCoords
+        tomos = SetOfTomograms.create(self.outputPath, suffix=suffix)
+        tomos.setSamplingRate(SAMPLING_RATE)
+        for i in range(nTomos):
+            tomo = Tomogram(tsId='TS_%03d' % i)
+            tomo.setSamplingRate(SAMPLING_RATE)
+            origin = Transform()
+            origin.setShifts(*(-rng.integers(100, 500, 3) / 2 * SAMPLING_RATE))
+            tomo.setOrigin(origin)
+            tomos.append(tomo)
+        tomos.write()
+        coords = SetOfCoordinates3D.create(self.outputPath, suffix=suffix)
+        coords.setSamplingRate(SAMPLING_RATE)
+        coords.setBoxSize(32)
+        coords.setPrecedents(tomos)
+
+        def iterCoords():
+            coord = Coordinate3D()
+            for tomoIndex, (x, y, z), score in zip(rng.integers(0, nTomos, nCoords),
+                                                   rng.uniform(-250, 250, (nCoords, 3)), rng.random(nCoords)):
+                coord.setObjId(None)
+                coord.setTomoId('TS_%03d' % tomoIndex)
+                coord.setX(x, SCIPION)
+                coord.setY(y, SCIPION)
+                coord.setZ(z, SCIPION)
+                coord.setGroupId(int(tomoIndex) % 3)
+                coord.setScore(score)
+                yield coord
+
+        appendItems(coords, iterCoords())
+        coords.write()
+        return coords
+
+    def _compare(self, nTomos, nCoords):
+        coords = self._createCoordinates(nTomos, nCoords)
+        for ext, coordLine in [('txt', txtLine), ('tbl', dynamoLine)]:
+            loopPath = self.getOutputPath('loop_%d_%s' % (nCoords, ext))
+            makePath(loopPath)
+            loopWriteTxt(coords, loopPath, ext, coordLine)
+
+            prot = ProtExportCoordinates3D(workingDir=self.getOutputPath('bulk_%d_%s' % (nCoords, ext)))
+            makePath(prot._getExportPath())
+            prot._writeTxt(coords, ext, prot._writeTxtCoords if ext == 'txt' else prot._writeDynamoCoords)
+
+            loopFiles = sorted(glob.glob(os.path.join(loopPath, '*.' + ext)))
+            self.assertEqual(len(loopFiles), nTomos, "Unexpected number of files.")
+            for loopFile in loopFiles:
+                with open(loopFile) as expected, open(prot._getExportPath(os.path.basename(loopFile))) as result:
+                    self.assertEqual(expected.read(), result.read(), "Different %s." % os.path.basename(loopFile))
+            self.assertEqual(len(glob.glob(prot._getExportPath('*'))), nTomos, "Unexpected number of files.")
+            cleanPath(loopPath, prot.getWorkingDir())
+
+    def test_export(self):
+        self._compare(5, 2000)
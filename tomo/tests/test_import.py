@@ -24,9 +24,11 @@
 # *
 # **************************************************************************
 import os
-from os.path import join, exists, abspath
+from glob import glob
+from os.path import join, exists, abspath, basename
 from typing import List
 
+import mrcfile
 import numpy as np
 from tomo.convert import getOrderFromList
 from pyworkflow.tests import BaseTest, setupTestProject
@@ -36,11 +38,12 @@ from pwem.protocols import ProtSplitSet, ProtSetFilter, ProtSetEditor
 from tomo.protocols.protocol_ts_import import MDoc, ProtImportTs
 from . import DataSet, RE4_STA_TUTO, DataSetRe4STATuto, EMD_10439, DataSetEmd10439
 from .test_base_centralized_layer import TestBaseCentralizedLayer
+from .test_mdoc import MDOC_HEADER, MDOC_SLICE
 from ..constants import BOTTOM_LEFT_CORNER, TOP_LEFT_CORNER, ERR_COORDS_FROM_SQLITE_NO_MATCH, ERR_NO_TOMOMASKS_GEN, \
     ERR_NON_MATCHING_TOMOS, SCIPION
 import tomo.protocols
-from ..objects import SetOfCTFTomoSeries, SetOfTiltSeries
-from ..protocols import ProtImportTomograms, ProtImportTomomasks
+from ..objects import SetOfCTFTomoSeries, SetOfTiltSeries, TiltSeries
+from ..protocols import ProtImportTomograms, ProtImportTomomasks, ProtImportTsMovies
 from ..protocols.protocol_import_coordinates import IMPORT_FROM_AUTO, ProtImportCoordinates3D
 from ..protocols.protocol_import_coordinates_from_scipion import ProtImportCoordinates3DFromScipion, outputObjs
 from ..protocols.protocol_import_ctf import ImportChoice, ProtImportTsCTF
@@ -738,3 +741,133 @@ class TestImportTomoCtf(TestBaseCentralizedLayer):
         args = self._getImodInputs()
         self._runTestImportCtfEv(*args)
 
+
+class TestImportMatchingFiles(BaseTest):
+    """ Tests that the files matched by the tilt-series import are the same, and in the same order, when the mdoc
+    files are read and the input files are listed using several threads."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def _getMatchingFiles(self, protClass, filesPath, filesPattern, numberOfThreads):
+        prot = self.newProtocol(protClass,
+                                filesPath=filesPath,
+                                filesPattern=filesPattern,
+                                dosePerFrame=3.0,
+                                numberOfThreads=numberOfThreads)
+        prot._initialize()
+        return prot, prot.getMatchingFiles()
+
+    def test_mdoc_matching_files(self):
+        nMdocs = 2000
+        mdocsPath = self.proj.getTmpPath('mdocs')
+        os.makedirs(mdocsPath)
+        for i in range(nMdocs):
+            tsId = 'TS_%04i' % i
+            with open(os.path.join(mdocsPath, tsId + '.mdoc'), 'w') as f:
+                f.write(MDOC_HEADER)
+                for zValue in range(3):
+                    f.write(MDOC_SLICE % (zValue, -30 + 15 * zValue, zValue, '30-Nov-21  17:42:%02i' % zValue))
+            # Some mdoc files are skipped because their frames are missing
+            if i % 100:
+                for zValue in range(3):
+                    open(os.path.join(mdocsPath, 'TS_01_%03i.tif' % zValue), 'w').close()
+
+        protSerial, serialFiles = self._getMatchingFiles(ProtImportTsMovies, mdocsPath, '*.mdoc', 1)
+        protParallel, parallelFiles = self._getMatchingFiles(ProtImportTsMovies, mdocsPath, '*.mdoc', 8)
+
+        self.assertEqual(nMdocs, len(parallelFiles), "Wrong number of tilt-series matched.")
+        self.assertEqual(list(serialFiles.items()), list(parallelFiles.items()), "Different matching files.")
+        for attrName in ['acquisitions', 'sRates', 'accumDoses', 'incomingDose']:
+            serialValues, parallelValues = getattr(protSerial, attrName), getattr(protParallel, attrName)
+            self.assertEqual(list(serialValues.keys()), list(parallelValues.keys()), "Different tsIds order.")
+            if attrName == 'acquisitions':
+                serialValues = {tsId: acq.getTiltAxisAngle() for tsId, acq in serialValues.items()}
+                parallelValues = {tsId: acq.getTiltAxisAngle() for tsId, acq in parallelValues.items()}
+            self.assertEqual(serialValues, parallelValues, "Different %s." % attrName)
+
+    def test_pattern_matching_files(self):
+        filesPath = self.proj.getTmpPath('pattern')
+        os.makedirs(filesPath)
+        for i in range(200):
+            fileName = os.path.join(filesPath, 'ts_%s_%03i_%0.1f.mrc' % ('abcdefg'[i % 7], i, -60 + 3 * (i % 41)))
+            open(fileName, 'w').close()
+            # Several files share the same modification time
+            os.utime(fileName, (0, 1000 - i // 3))
+        open(os.path.join(filesPath, 'notMatching.mrc'), 'w').close()
+        open(os.path.join(filesPath, '.ts_a_001_0.0.mrc'), 'w').close()
+
+        filesPattern = 'ts_{TS}_{TO}_{TA}.mrc'
+        _, serialFiles = self._getMatchingFiles(ProtImportTs, filesPath, filesPattern, 1)
+        prot, parallelFiles = self._getMatchingFiles(ProtImportTs, filesPath, filesPattern, 8)
+
+        # Expected files, globbing and sorting them by modification time
+        expectedFiles = sorted(glob(prot._globPattern), key=os.path.getmtime)
+        self.assertEqual(expectedFiles, [f for f, _ in prot._scanFiles(prot._globPattern, workers=8)],
+                         "Files not listed as glob does.")
+        self.assertEqual(7, len(parallelFiles), "Wrong number of tilt-series matched.")
+        self.assertEqual(list(serialFiles.items()), list(parallelFiles.items()), "Different matching files.")
+        self.assertEqual([f for f in expectedFiles if os.path.basename(f).startswith('ts_a_')],
+                         [fileData[0] for fileData in parallelFiles['a']], "Wrong tilt images order.")
+
+
+class TestImportTsFromMdoc(BaseTest):
+    """ Imports a synthetic set of tilt-series, copying or linking their files with one and several threads."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.nTs, cls.nImgs = 100, 41
+        cls.filesPath = cls.proj.getTmpPath('tsMdocs')
+        os.makedirs(cls.filesPath)
+        data = np.zeros((cls.nImgs, 16, 16), dtype=np.float32)
+        for i in range(cls.nTs):
+            tsId = 'TS_%03i' % i
+            data[:] = i
+            with mrcfile.new(os.path.join(cls.filesPath, tsId + '.mrcs')) as mrc:
+                mrc.set_data(data)
+            with open(os.path.join(cls.filesPath, tsId + '.mdoc'), 'w') as f:
+                f.write(MDOC_HEADER.replace('TS_01.mrc', tsId + '.mrcs'))
+                # Acquired in a dose symmetric scheme
+                angles = sorted(range(-60, 63, 3), key=lambda angle: (abs(angle), angle))
+                for zValue, angle in enumerate(angles):
+                    f.write(MDOC_SLICE % (zValue, angle, zValue, '30-Nov-21  17:%02i:00' % zValue))
+
+    def _importTs(self, importAction, numberOfThreads):
+        protImport = self.newProtocol(ProtImportTs,
+                                      filesPath=self.filesPath,
+                                      filesPattern='*.mdoc',
+                                      importAction=importAction,
+                                      numberOfThreads=numberOfThreads)
+        self.launchProtocol(protImport)
+        return protImport
+
+    def _getTsData(self, protImport):
+        tsData = []
+        for ts in getattr(protImport, ProtImportTs.OUTPUT_NAME):
+            for ti in ts.iterItems():
+                acq = ti.getAcquisition()
+                tsData.append((ts.getTsId(), basename(ti.getFileName()), ti.getIndex(), ti.getTiltAngle(),
+                               ti.getAcquisitionOrder(), acq.getDoseInitial(), acq.getDosePerFrame(),
+                               acq.getAccumDose()))
+        return tsData
+
+    def test_import_ts(self):
+        protSerial = self._importTs(ProtImportTs.IMPORT_LINK_REL, 1)
+        protParallel = self._importTs(ProtImportTs.IMPORT_COPY_FILES, 4)
+
+        serialData = self._getTsData(protSerial)
+        self.assertEqual(self.nTs * self.nImgs, len(serialData), "Wrong number of tilt images.")
+        self.assertEqual(serialData, self._getTsData(protParallel), "Different tilt-series imported.")
+
+        ts = getattr(protParallel, ProtImportTs.OUTPUT_NAME).getItem(TiltSeries.TS_ID_FIELD, 'TS_007')
+        self.assertEqual(-60, ts.getFirstItem().getTiltAngle(), "Tilt images not sorted by tilt angle.")
+        self.assertEqual(3.0 * self.nImgs, ts.getAcquisition().getAccumDose(), "Wrong accumulated dose.")
+        self.assertEqual([3.0 * (i + 1) for i in range(self.nImgs)],
+                         sorted(ti.getAcquisition().getAccumDose() for ti in ts),
+                         "The tilt images do not keep their own dose.")
+        stackFile = ts.getFirstItem().getFileName()
+        self.assertFalse(os.path.islink(stackFile), "Stack file not copied.")
+        with mrcfile.mmap(stackFile, mode='r') as mrc:
+            self.assertTrue(np.all(mrc.data == 7), "Wrong stack file copied.")
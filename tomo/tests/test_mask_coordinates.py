@@ -0,0 +1,113 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import mrcfile
+import numpy as np
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Transform
+from pyworkflow.tests import BaseTest
+from tomo.constants import BOTTOM_LEFT_CORNER, SCIPION
+from tomo.objects import SetOfTomograms, Tomogram, SetOfTomoMasks, TomoMask, SetOfCoordinates3D, Coordinate3D
+from tomo.protocols.protocol_mask_coordinates import ProtMaskCoordinates
+
+SAMPLING_RATE = 10.2
+DIMS = (64, 128, 96)  # z, y, x
+
+
+def scalarKeptIds(coords, tomogram, segmentation, label):
+    """ Checks the coordinates one by one against the whole segmentation, as done by the protocol before being
+    vectorised """
+    segmentationData = ImageHandler().read(segmentation).getData()
+    mask = segmentationData > 0 if label < 0 else segmentationData == label
+    kept = set()
+    for coord in coords.iterCoordinates(tomogram):
+        x, y, z = tuple(map(round, coord.getPosition(BOTTOM_LEFT_CORNER)))
+        if mask[z, y, x] == True:
+            kept.add(coord.getObjId())
+    return kept
+
+
+class TestMaskCoordinates(BaseTest):
+    """ Compares the vectorised test of the coordinates in the segmentations with the scalar one."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _createSets(self, nTomos, nCoords):
+        """ Creates a set of tomograms, with their origins at the center, a set of segmentations with 3 labels and
+        a set of coordinates spread over the whole tomograms """
+        rng = np.random.default_rng(0)
+        tomos = SetOfTomograms.create(self.outputPath, suffix='%d' % nCoords)
+        tomos.setSamplingRate(SAMPLING_RATE)
+        masks = SetOfTomoMasks.create(self.outputPath, suffix='%d' % nCoords)
+        masks.setSamplingRate(SAMPLING_RATE)
+        coords = SetOfCoordinates3D.create(self.outputPath, suffix='%d' % nCoords)
+        coords.setSamplingRate(SAMPLING_RATE)
+        coords.setPrecedents(tomos)
+        for i in range(nTomos):
+            tsId = 'TS_%02d' % i
+            maskFn = self.getOutputPath('%s_%d.mrc' % (tsId, nCoords))
+            with mrcfile.new(maskFn, overwrite=True) as mrc:
+                mrc.set_data(rng.integers(0, 3, DIMS, dtype=np.int8))
+                mrc.voxel_size = SAMPLING_RATE
+            tomo = Tomogram(tsId=tsId)
+            tomo.setSamplingRate(SAMPLING_RATE)
+            origin = Transform()
+            origin.setShifts(*[-dim / 2. * SAMPLING_RATE for dim in reversed(DIMS)])
+            tomo.setOrigin(origin)
+            tomos.append(tomo)
+            mask = TomoMask(tsId=tsId, location=maskFn)
+            mask.setSamplingRate(SAMPLING_RATE)
+            masks.append(mask)
+            # Scipion coordinates, referred to the center of the tomogram
+            positions = rng.uniform(-0.5, np.array(DIMS[::-1]) - 0.5, (nCoords, 3)) - np.array(DIMS[::-1]) / 2.
+            for x, y, z in positions:
+                coord = Coordinate3D(tomoId=tsId)
+                coord.setX(x, SCIPION)
+                coord.setY(y, SCIPION)
+                coord.setZ(z, SCIPION)
+                coords.append(coord)
+        for setObj in tomos, masks, coords:
+            setObj.write()
+        prot = ProtMaskCoordinates()
+        prot.inputCoordinates.set(coords)
+        prot.inputSegmentations.set(masks)
+        return prot, coords
+
+    def _vectorisedKeptIds(self, prot, coords, tomograms):
+        keptIds = {}
+        for tsId in tomograms:
+            positions, ids = coords.getPositions(BOTTOM_LEFT_CORNER, tsId)
+            keptIds[tsId] = set(ids[prot._checkCoordinates(np.rint(positions).astype(int),
+                                                           prot._getInputSegmentation(tsId))].tolist())
+        return keptIds
+
+    def test_kept_coordinates(self):
+        prot, coords = self._createSets(3, 500)
+        tomograms = coords.getPrecedentsInvolved()
+        for label in [-1, 0, 2]:
+            prot.segmentationLabel.set(label)
+            keptIds = self._vectorisedKeptIds(prot, coords, tomograms)
+            for tsId, tomogram in tomograms.items():
+                kept = scalarKeptIds(coords, tomogram, prot._getInputSegmentation(tsId), label)
+                self.assertTrue(0 < len(kept) < 500, "Label %d: all the coordinates were kept or rejected." % label)
+                self.assertEqual(kept, keptIds[tsId], "Label %d: different kept coordinates for %s." % (label, tsId))
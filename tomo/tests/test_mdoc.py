@@ -0,0 +1,105 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+from unittest.mock import patch
+
+from pyworkflow.tests import BaseTest
+from tomo.convert import mdoc
+from tomo.convert.mdoc import MDoc, MDocCache
+
+MDOC_HEADER = """PixelSpacing = 1.35
+Voltage = 300
+ImageFile = TS_01.mrc
+
+[T = SerialEM: Digitized on EMBL Krios   30-Nov-21  17:42:06    ]
+
+[T =     Tilt axis angle = 85.3, binning = 1  spot = 9  camera = 0]
+"""
+
+MDOC_SLICE = """
+[ZValue = %i]
+TiltAngle = %0.2f
+Magnification = 81000
+ExposureDose = 3.0
+SubFramePath = X:\\frames\\TS_01_%03i.tif
+DateTime = %s
+"""
+
+
+class TestMDoc(BaseTest):
+    """ Tests the mdoc parser"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _writeMdoc(self, fileName, dateTimes):
+        mdocFile = self.getOutputPath(fileName)
+        with open(mdocFile, 'w') as f:
+            f.write(MDOC_HEADER)
+            for zValue, dateTime in enumerate(dateTimes):
+                f.write(MDOC_SLICE % (zValue, -30 + 15 * zValue, zValue, dateTime))
+        return mdocFile
+
+    def test_parse_mdoc(self):
+        # Acquisition order of the Z values: 0, 3, 1, 2, 4. The last one has a two digits year
+        dateTimes = ['30-Nov-2021  17:42:06', '30-Nov-2021  17:44:00', '01-Dec-2021  00:00:01',
+                     '30-Nov-2021  17:43:59', '01-Jan-22  10:00:00']
+        mdocFile = self._writeMdoc('TS_01.mdoc', dateTimes)
+        mdocObj = MDoc(mdocFile)
+        errorMsg = mdocObj.read(isImportingTsMovies=True, ignoreFilesValidation=True)
+
+        self.assertEqual('', errorMsg, "Unexpected error parsing the mdoc.")
+        self.assertEqual(85.3, mdocObj.getTiltAxisAngle(), "Wrong tilt axis angle.")
+        self.assertEqual('300', mdocObj.getVoltage(), "Wrong voltage.")
+        self.assertEqual('1.35', mdocObj.getSamplingRate(), "Wrong sampling rate.")
+        angles = [tiMd.getTiltAngle() for tiMd in mdocObj.getTiltsMetadata()]
+        self.assertEqual(['-30.00', '15.00', '-15.00', '0.00', '30.00'], angles, "Wrong acquisition order.")
+        self.assertEqual([3.0 * (i + 1) for i in range(5)],
+                         [tiMd.getAccumDose() for tiMd in mdocObj.getTiltsMetadata()], "Wrong accumulated dose.")
+        self.assertTrue(mdocObj.getTiltsMetadata()[0].getAngleMovieFile().endswith('TS_01_000.tif'),
+                        "Wrong sub-frame file.")
+
+        # The tilt axis angle introduced by the user has priority
+        mdocObj = MDoc(mdocFile, tiltAngleProvidedByUser=-90)
+        mdocObj.read(isImportingTsMovies=True, ignoreFilesValidation=True)
+        self.assertEqual(-90, mdocObj.getTiltAxisAngle(), "Tilt axis angle provided by the user not considered.")
+
+    def test_mdoc_cache(self):
+        mdocFile = self._writeMdoc('TS_02.mdoc', ['30-Nov-21  17:42:%02i' % i for i in range(3)])
+        cache = MDocCache(self.getOutputPath('mdocs_cache.sqlite'))
+        try:
+            with patch.object(mdoc, 'parseMdocFile', wraps=mdoc.parseMdocFile) as parser:
+                for _ in range(3):
+                    MDoc(mdocFile, cache=cache).read(isImportingTsMovies=True, ignoreFilesValidation=True)
+                self.assertEqual(1, parser.call_count, "A cached mdoc file is parsed again.")
+
+                # A modified file is parsed again
+                self._writeMdoc('TS_02.mdoc', ['30-Nov-21  17:42:%02i' % i for i in range(4)])
+                stat = os.stat(mdocFile)
+                os.utime(mdocFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                mdocObj = MDoc(mdocFile, cache=cache)
+                mdocObj.read(isImportingTsMovies=True, ignoreFilesValidation=True)
+                self.assertEqual(2, parser.call_count, "A modified mdoc file is not parsed again.")
+                self.assertEqual(4, len(mdocObj.getTiltsMetadata()), "Outdated cached data.")
+        finally:
+            cache.close()
@@ -22,14 +22,55 @@
 # *
 # **************************************************************************
 
+import math
+
+import numpy as np
+import skimage.morphology
+from pwem.objects import Integer, Transform
 from pyworkflow.tests import BaseTest, setupTestProject
 from . import DataSet
 
+from tomo.constants import BOTTOM_LEFT_CORNER
+from tomo.objects import SetOfMeshes, Tomogram
 from tomo.protocols.protocol_mesh_from_segmentation import ProtMeshFromSegmentation
 from tomo.protocols.protocol_import_tomograms import ProtImportTomograms, OUTPUT_NAME
 from tomo.protocols.protocol_import_tomomasks import ProtImportTomomasks
 
 
+def fullVolumeMeshesCoordinates(maskData, smoothMask, backgroundLabel, lowLimit, highLimit, dilation, skeletonize,
+                                density, labels=None):
+    """ Processes each label in the whole tomogram, as done by the protocol before cropping them to their bounding
+    boxes """
+    def processBinaryMask(mask):
+        if dilation > 0:
+            mask = skimage.morphology.binary_dilation(mask, skimage.morphology.ball(dilation))
+        if skeletonize:
+            mask = skimage.morphology.skeletonize_3d(mask)
+        coordinates = np.argwhere(mask)
+        indices = np.arange(0, len(coordinates))
+        nPoints = math.floor(density / 100.0 * len(indices))
+        return coordinates[np.random.choice(indices, size=nPoints, replace=False), :]
+
+    if smoothMask:
+        return [processBinaryMask((lowLimit <= maskData) & (maskData <= highLimit))]
+    labels = np.unique(maskData) if labels is None else labels
+    return [processBinaryMask(maskData == label) for label in labels if label != backgroundLabel]
+
+
+def createLabelMap(dim, nLabels, rng):
+    """ Label map of random ellipsoids, with the background labeled as 0 """
+    labelMap = np.zeros((dim, dim, dim), dtype=np.float32)
+    for label in range(1, nLabels + 1):
+        center = rng.integers(0, dim, 3)
+        radii = rng.uniform(0.02 * dim, 0.06 * dim, 3)
+        box = tuple(slice(max(int(c - r) - 1, 0), min(int(c + r) + 2, dim)) for c, r in zip(center, radii))
+        z, y, x = np.ogrid[box]
+        ellipsoid = ((z - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2 + \
+                    ((x - center[2]) / radii[2]) ** 2 <= 1
+        labelMap[box][ellipsoid] = label
+    return labelMap
+
+
 class TestMeshFromSegmentation(BaseTest):
 
     @classmethod
@@ -71,3 +112,64 @@ class TestMeshFromSegmentation(BaseTest):
         self.launchProtocol(protMesh)
         self.assertSetSize(getattr(protMesh, ProtMeshFromSegmentation._OUTPUT_NAME), size=3892,
                            msg='mesh from segmentation failed')
+
+
+class TestMeshFromSegmentationLabels(BaseTest):
+    """ Compares the extraction of the meshes in the bounding boxes of the labels with their extraction in the whole
+    tomogram."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    @staticmethod
+    def _getProtocol(smoothMask=False, dilation=0, skeletonize=True, density=5.0):
+        prot = ProtMeshFromSegmentation()
+        prot.smoothMask.set(smoothMask)
+        prot.backgroundLabel.set(0)
+        prot.lowLimit.set(0.5)
+        prot.highLimit.set(1)
+        prot.applyDilation.set(dilation)
+        prot.applySkeletonization.set(skeletonize)
+        prot.density.set(density)
+        prot.baseGroupId = Integer(1)
+        return prot
+
+    def _assertSameMeshes(self, expected, result, msg):
+        self.assertEqual(len(expected), len(result), "%s: different number of meshes." % msg)
+        for i, (expectedCoords, resultCoords) in enumerate(zip(expected, result)):
+            self.assertTrue(np.array_equal(expectedCoords, resultCoords), "%s: different mesh %d." % (msg, i))
+
+    def test_meshes(self):
+        labelMap = createLabelMap(96, 15, np.random.default_rng(0))
+        labelMap[:, :, :4] = 16  # A label touching the tomogram borders
+        smoothMask = labelMap / 16
+        for smooth, dilation, skeletonize, workers in [(False, 0, True, 1), (False, 2, True, 2),
+                                                       (False, 1, False, 2), (True, 0, True, 1)]:
+            msg = 'smooth = %s, dilation = %d, skeletonize = %s, workers = %d' % (smooth, dilation, skeletonize,
+                                                                                   workers)
+            prot = self._getProtocol(smooth, dilation, skeletonize)
+            maskData = smoothMask if smooth else labelMap
+            np.random.seed(0)
+            expected = fullVolumeMeshesCoordinates(maskData, smooth, 0, 0.5, 1, dilation, skeletonize, 5.0)
+            np.random.seed(0)
+            result = prot._getMeshesCoordinates(maskData, workers=workers)
+            self._assertSameMeshes(expected, result, msg)
+
+        # Meshes appended at once
+        tomo = Tomogram(tsId='TS_01')
+        tomo.setSamplingRate(10)
+        origin = Transform()
+        origin.setShifts(-480, -480, -480)
+        tomo.setOrigin(origin)
+        meshes = SetOfMeshes.create(self.outputPath)
+        prot._appendMeshes(meshes, tomo, result + result)
+        meshes.write()
+        self.assertEqual(meshes.getSize(), 2 * sum(len(coords) for coords in result), "Wrong number of points.")
+        self.assertEqual(prot.baseGroupId.get(), 3, "The group id was not increased once per mesh.")
+        expectedPoints = [(i + 1, x, y, z) for i, coords in enumerate(result + result) for z, y, x in coords]
+        readMeshes = SetOfMeshes(filename=meshes.getFileName())
+        for point, (groupId, x, y, z) in zip(readMeshes, expectedPoints):
+            point.setVolume(tomo)
+            self.assertEqual(point.getGroupId(), groupId, "Wrong group id.")
+            self.assertEqual(point.getPosition(BOTTOM_LEFT_CORNER), (x, y, z), "Wrong position.")
@@ -23,15 +23,27 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import math
+import multiprocessing
+import os
 import tempfile
-
+import tracemalloc
+from unittest.mock import patch
+
+import mrcfile
+import numpy as np
+from pwem.objects import Transform
+from pyworkflow.mapper.sqlite import SqliteFlatDb
+from pyworkflow.object import Pointer
 from pyworkflow.tests import BaseTest
-from tomo.constants import SCIPION
+from tomo.constants import SCIPION, BOTTOM_LEFT_CORNER
 from tomo.objects import (SetOfTiltSeriesCoordinates, TiltSeriesCoordinate,
                           SetOfSubTomograms, SetOfTomograms, Tomogram,
                           SetOfCoordinates3D, Coordinate3D, SubTomogram,
                           SetOfTiltSeries, TiltSeries, TiltImage, LandmarkModel,
-                          CTFTomo)
+                          CTFTomo, TomoAcquisition, ImodFileBundle, FileWatcher,
+                          SetOfTiltSeriesReader, TiltSeriesDict, SetOfCTFTomoSeries, CTFTomoSeries,
+                          appendItems)
 
 TS_1 = "TS_1"
 TS_2 = "TS_2"
@@ -47,6 +59,47 @@ Y_VALUE = 20
 X_VALUE = 10
 
 
+def countSqlStatements(setObj, func, *args, **kwargs):
+    """ Returns the number of sql statements executed in the database of setObj when calling func(*args, **kwargs)
+    and its result"""
+    statements = []
+    connection = setObj._getMapper().db.connection
+    connection.set_trace_callback(statements.append)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        connection.set_trace_callback(None)
+    return len(statements), result
+
+
+def feedTiltSeries(fileName, connection, tiPerTs):
+    """ Streaming writer of a set of tilt-series, run in another process. Each time it receives a number of
+    tilt-images through the connection, it appends them, creating a new tilt-series every tiPerTs tilt-images, and
+    commits the set. It closes the set stream when it receives 0. """
+    tiltseries = SetOfTiltSeries(filename=fileName)
+    tiltseries.setStreamState(SetOfTiltSeries.STREAM_OPEN)
+    ts, nTi = None, 0
+    while True:
+        increment = connection.recv()
+        if not increment:
+            break
+        for _ in range(increment):
+            if nTi % tiPerTs == 0:
+                ts = TiltSeries(tsId='TS_%03d' % (nTi // tiPerTs))
+                tiltseries.append(ts)
+            ti = TiltImage(tiltAngle=nTi % tiPerTs, acquisitionOrder=nTi % tiPerTs + 1)
+            ti.setTsId(ts.getTsId())
+            ts.append(ti)
+            nTi += 1
+        tiltseries.update(ts)
+        tiltseries.write()
+        connection.send(nTi)
+    tiltseries.setStreamState(SetOfTiltSeries.STREAM_CLOSED)
+    tiltseries.write()
+    tiltseries.close()
+    connection.send(nTi)
+
+
 class TestTomoModel(BaseTest):
     """ This class check if the Object model behaves as expected"""
 
@@ -210,6 +263,458 @@ class TestTomoModel(BaseTest):
         clonedTi = newTi.clone()
         self.assertFalse(clonedTi.isEnabled(), "Enabled not cloned for the tilt image")
 
+    def test_tilt_series_tsId_index(self):
+        """ Tests the lookups by tsId in a SetOfTiltSeries do not depend on the size of the set"""
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='tsIdIndex')
+
+        def addTiltSeries(first, last):
+            for i in range(first, last):
+                ts = TiltSeries()
+                ts.setTsId('TS_%05d' % i)
+                tiltseries.append(ts)
+            tiltseries.write()
+
+        def lookUp(tsId):
+            tiltseries.getTiltSeriesFromTsId(tsId)  # Build the index (if required)
+            nCmds, ts = countSqlStatements(tiltseries, tiltseries.getTiltSeriesFromTsId, tsId)
+            self.assertEqual(tsId, ts.getTsId(), "getTiltSeriesFromTsId returns a wrong tilt-series.")
+            return nCmds
+
+        addTiltSeries(0, 50)
+        smallSetCmds = lookUp('TS_00025')
+        self.assertIsNone(tiltseries.getTiltSeriesFromTsId('MISSING'), "Missing tsId does not return None.")
+
+        # The index is invalidated when the set grows
+        addTiltSeries(50, 5000)
+        bigSetCmds = lookUp('TS_04999')
+        self.assertEqual(smallSetCmds, bigSetCmds, "The lookup cost by tsId depends on the set size.")
+
+        # The tsId column is indexed in the sqlite
+        db = tiltseries._getMapper().db
+        db.executeCommand("EXPLAIN QUERY PLAN SELECT id FROM Objects WHERE %s='TS_04999'"
+                          % db._getRealCol(TiltSeries.TS_ID_FIELD))
+        queryPlan = ' '.join(row['detail'] for row in db.cursor.fetchall())
+        self.assertIn('INDEX', queryPlan, "The tsId column is not indexed.")
+
+        # A reader of the set discards the index when it is closed, so the tilt-series added meanwhile are found
+        reader = SetOfTiltSeries(filename=tiltseries.getFileName())
+        self.assertEqual(len(reader.getTsIdIndex()), 5000, "Wrong tsId index of the reader.")
+        addTiltSeries(5000, 5010)
+        reader.close()
+        reader.loadAllProperties()
+        self.assertEqual(reader.getTiltSeriesFromTsId('TS_05009').getTsId(), 'TS_05009',
+                         "The tsId index of the reader was not updated when reopened.")
+
+    def test_ctf_tomo_series_index(self):
+        """ Tests the CTF models of all the tilt-images of a tilt-series are read with a single query"""
+        nTi = 61
+        # Dose symmetric acquisition, so the acquisition order and the index do not match
+        acqOrders = sorted(range(nTi), key=lambda i: (abs(i - nTi // 2), i))
+
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='ctfIndex')
+        ts = TiltSeries(tsId=TS_1)
+        tiltseries.append(ts)
+        for i in range(nTi):
+            ti = TiltImage(tsId=TS_1, tiltAngle=-60 + 2 * i, acquisitionOrder=acqOrders[i])
+            ti.setIndex(i + 1)
+            ti.setEnabled(i != 1)
+            ts.append(ti)
+        tiltseries.update(ts)
+        tiltseries.write()
+
+        ctfSet = SetOfCTFTomoSeries.create(self.outputPath, suffix='ctfIndex')
+        ctfSet.setSetOfTiltSeries(tiltseries)
+        ctfSeries = CTFTomoSeries(tsId=TS_1)
+        ctfSeries.setTiltSeries(ts)
+        ctfSet.append(ctfSeries)
+        for i in range(nTi):
+            ctfTomo = CTFTomo()
+            ctfTomo.setIndex(i + 1)
+            ctfTomo.setAcquisitionOrder(acqOrders[i])
+            ctfTomo.setDefocusU(10000 + i)
+            ctfTomo.setEnabled(i != 2)
+            ctfSeries.append(ctfTomo)
+        ctfSet.update(ctfSeries)
+        ctfSet.write()
+
+        # A single iteration of the series for all the tilt-images
+        list(ctfSeries.iterItems())  # Load the classes of the items
+        iterCmds, _ = countSqlStatements(ctfSeries, lambda: list(ctfSeries.iterItems()))
+        nCmds, ctfTomos = countSqlStatements(ctfSeries, ctfSeries.getCtfTomosForTs, ts)
+        self.assertEqual(iterCmds, nCmds, "The CTF series is not read in a single query.")
+        nCmds, _ = countSqlStatements(ctfSeries, lambda: [ctfSeries.getCtfTomoFromTi(ti) for ti in ts])
+        self.assertEqual(0, nCmds, "The CTF series is read again for each tilt-image.")
+
+        self.assertEqual(nTi, len(ctfTomos), "The CTF models are not aligned with the tilt-images.")
+        for i, (ti, ctfTomo) in enumerate(zip(ts, ctfTomos)):
+            if i in (1, 2):
+                self.assertIsNone(ctfTomo, "CTF returned for a disabled tilt-image or CTF.")
+            else:
+                self.assertEqual(ti.getAcquisitionOrder(), ctfTomo.getAcquisitionOrder(), "Wrong matching CTF.")
+                self.assertEqual(10000 + i, ctfTomo.getDefocusU(), "Wrong matching CTF.")
+        self.assertEqual(10002, ctfSeries.getCtfTomosForTs(ts, onlyEnabled=False)[2].getDefocusU(),
+                         "Disabled CTF not returned with onlyEnabled = False.")
+
+        # The returned CTF models are copies of the ones in the index
+        ctfTomos[0].setDefocusU(0)
+        self.assertEqual(10000, ctfSeries.getCtfTomosForTs(ts)[0].getDefocusU(), "The CTF index is modified.")
+
+        # The index is invalidated when the series is modified
+        ti = TiltImage(tsId=TS_1, acquisitionOrder=nTi)
+        self.assertIsNone(ctfSeries.getCtfTomoFromTi(ti), "CTF returned for a missing acquisition order.")
+        ctfTomo = CTFTomo()
+        ctfTomo.setAcquisitionOrder(nTi)
+        ctfSeries.append(ctfTomo)
+        self.assertIsNotNone(ctfSeries.getCtfTomoFromTi(ti), "The CTF index is not updated after appending.")
+
+    def test_ctf_tomo_series_tsId_lookup(self):
+        """ Tests the tilt-series of the CTF series are resolved without loading the whole set of tilt-series"""
+        nTs = 1000
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='ctfTsId')
+        ctfSet = SetOfCTFTomoSeries.create(self.outputPath, suffix='ctfTsId')
+        ctfSet.setSetOfTiltSeries(Pointer(tiltseries))
+        for i in range(nTs):
+            ts = TiltSeries(tsId='TS_%04d' % i)
+            tiltseries.append(ts)
+            ctfSeries = CTFTomoSeries(tsId=ts.getTsId())
+            ctfSet.append(ctfSeries)
+        tiltseries.write()
+        ctfSet.write()
+
+        # Each CTF series reads only the row of its tilt-series
+        tsIds = []
+        nCmds, _ = countSqlStatements(tiltseries, lambda: tsIds.extend(
+            (ctfSeries.getTsId(), ctfSeries.getTiltSeries().getTsId()) for ctfSeries in ctfSet))
+        self.assertEqual([('TS_%04d' % i,) * 2 for i in range(nTs)], tsIds, "Wrong tilt-series of the CTF series.")
+        itemCmds, ctfSeries = countSqlStatements(tiltseries, ctfSet.__getitem__, nTs // 2)
+        self.assertEqual('TS_%04d' % (nTs // 2 - 1), ctfSeries.getTiltSeries().getTsId(),
+                         "Wrong tilt-series of the CTF series.")
+        # One query per tilt-series, plus those of the tsId index and the classes of the items
+        self.assertLessEqual(nCmds, nTs * itemCmds + 2, "The tilt-series are read more than once.")
+
+        # The tsId column of the CTF series is indexed in the sqlite
+        db = ctfSet._getMapper().db
+        db.executeCommand("EXPLAIN QUERY PLAN SELECT id FROM Objects WHERE %s='TS_0999'"
+                          % db._getRealCol(CTFTomoSeries.TS_ID_FIELD))
+        queryPlan = ' '.join(row['detail'] for row in db.cursor.fetchall())
+        self.assertIn('INDEX', queryPlan, "The tsId column is not indexed.")
+
+    def test_tilt_series_lazy_loading(self):
+        """ Tests the tilt-images tables are not opened when iterating a SetOfTiltSeries reading only the tsIds"""
+        nTs = 1000
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='lazy')
+        for i in range(nTs):
+            ts = TiltSeries()
+            ts.setTsId('TS_%04d' % i)
+            tiltseries.append(ts)
+            ti = TiltImage()
+            ti.setTiltAngle(i)
+            ts.append(ti)
+            tiltseries.update(ts)
+        tiltseries.write()
+        tiltseries.close()
+
+        def iterTsIds(**kwargs):
+            return [ts.getTsId() for ts in tiltseries.iterItems(**kwargs)]
+
+        createConnection = SqliteFlatDb._createConnection
+        with patch.object(SqliteFlatDb, '_createConnection', autospec=True,
+                          side_effect=createConnection) as mockConnection:
+            tsIds = iterTsIds()
+        self.assertEqual(nTs, len(tsIds), "Wrong number of tilt-series iterated.")
+        self.assertEqual(1, mockConnection.call_count, "Tilt-images tables opened when iterating lazily.")
+
+        with patch.object(SqliteFlatDb, '_createConnection', autospec=True,
+                          side_effect=createConnection) as mockConnection:
+            iterTsIds(lazy=False)
+        self.assertGreaterEqual(mockConnection.call_count, nTs, "Tilt-images tables not opened when not lazy.")
+
+        # The tilt-images are still accessible (and match its tilt-series) when loaded lazily
+        for ts in tiltseries.iterItems(orderBy='id', direction='DESC', limit=3):
+            self.assertEqual(1, ts.getSize(), "Wrong size of a lazily loaded tilt-series.")
+            ti = ts.getFirstItem()
+            self.assertEqual(ts.getTsId(), ti.getTsId(), "Wrong tilt-image from a lazily loaded tilt-series.")
+
+    def test_tilt_series_arrays(self):
+        """ Tests the columnar access to the tilt-images metadata of a SetOfTiltSeries"""
+        nTi = 7
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='arrays')
+        for tsId in [TS_1, TS_2]:
+            ts = TiltSeries()
+            ts.setTsId(tsId)
+            tiltseries.append(ts)
+            for i in range(nTi):
+                ti = TiltImage(location=(i + 1, '%s.mrc' % tsId))
+                ti.setTiltAngle(-30 + 10 * i)
+                ti.setAcquisitionOrder(nTi - i)
+                ti.setEnabled(i != 3)
+                ti.setAcquisition(TomoAcquisition(accumDose=2.5 * (i + 1)))
+                trMatrix = np.eye(3)
+                trMatrix[0, 2] = i
+                ti.setTransform(Transform(trMatrix))
+                ts.append(ti)
+            tiltseries.update(ts)
+        tiltseries.write()
+
+        arrays = tiltseries.toArrays()
+        self.assertEqual({TS_1, TS_2}, set(arrays.keys()), "toArrays returns wrong tsIds.")
+        for ts in tiltseries:
+            tsArrays = arrays[ts.getTsId()]
+            self.assertEqual((nTi, 3, 3), tsArrays[TiltImage.TRANSFORM_MATRIX_FIELD].shape, "Wrong matrix stack shape.")
+            for i, ti in enumerate(ts.iterItems(orderBy='id')):
+                self.assertEqual(ti.getTiltAngle(), tsArrays[TiltImage.TILT_ANGLE_FIELD][i], "Wrong tilt angle.")
+                self.assertEqual(ti.getAcquisitionOrder(), tsArrays[TiltImage.ACQ_ORDER_FIELD][i], "Wrong acq order.")
+                self.assertEqual(ti.isEnabled(), tsArrays[TiltImage.ENABLED_FIELD][i], "Wrong enabled value.")
+                self.assertTrue(np.allclose(ti.getTransform().getMatrix(),
+                                            tsArrays[TiltImage.TRANSFORM_MATRIX_FIELD][i]), "Wrong matrix.")
+
+        # Round trip through the bulk writer
+        newTiltseries = SetOfTiltSeries.create(self.outputPath, suffix='fromArrays')
+        newTiltseries.fromArrays(arrays, tiTemplate=TiltImage(location=(1, 'ts.mrc')))
+        newTiltseries.write()
+        self.assertEqual(2, newTiltseries.getSize(), "fromArrays creates a wrong number of tilt-series.")
+        newArrays = newTiltseries.toArrays()
+        for tsId, tsArrays in arrays.items():
+            self.assertEqual(nTi, newTiltseries.getTiltSeriesFromTsId(tsId).getSize(), "Wrong tilt-series size.")
+            for field, values in tsArrays.items():
+                self.assertTrue(np.allclose(values, newArrays[tsId][field]), "Round trip of %s failed." % field)
+
+    def test_tilt_series_incremental_reader(self):
+        """ Tests a set of tilt-series in streaming is read incrementally, only querying the new rows"""
+        nTi, increment, tiPerTs = 10000, 50, 1000
+        fileName = self.getOutputPath('tiltseries_streaming.sqlite')
+        connection, writerConnection = multiprocessing.Pipe()
+        writer = multiprocessing.get_context('fork').Process(target=feedTiltSeries,
+                                                             args=(fileName, writerConnection, tiPerTs))
+        writer.start()
+        try:
+            # The first rows create the set file
+            connection.send(increment)
+            connection.recv()
+            newTsIds = []
+            inputSet = SetOfTiltSeries(filename=fileName)
+            tsDict = TiltSeriesDict(inputSet, newItemsCallback=newTsIds.extend, doneItemsCallback=lambda ids: None)
+            inputSet.close()
+            tsDict.update()
+            reader = SetOfTiltSeriesReader(fileName)
+            reader.read()
+            self.assertEqual(increment + 1, reader.readCount, "Wrong number of rows read initially.")
+
+            watcher = FileWatcher(fileName)
+            self.assertTrue(watcher.usesInotify(), "inotify not used.")
+            self.assertTrue(watcher.hasChanged(), "The first check does not report a change.")
+            self.assertFalse(watcher.hasChanged(), "Change reported without modifications.")
+
+            for fed in range(2 * increment, nTi + 1, increment):
+                connection.send(increment)
+                self.assertTrue(watcher.wait(10), "The modification of the set is not notified.")
+                self.assertEqual(fed, connection.recv())
+                self.assertTrue(watcher.hasChanged(), "The modification of the set is not reported.")
+                newTsList, newTiDict = reader.read()
+                # Only the new tilt-images are read, plus the new tilt-series when one has been started
+                tsId = 'TS_%03d' % ((fed - 1) // tiPerTs)
+                firstTi = (fed - increment) % tiPerTs + 1
+                isNewTs = firstTi == 1
+                self.assertEqual(increment + isNewTs, reader.readCount, "Rows already read are read again.")
+                self.assertEqual([tsId] if isNewTs else [], [ts.getTsId() for ts in newTsList],
+                                 "Wrong tilt-series read.")
+                self.assertEqual([tsId], list(newTiDict), "Wrong tilt-series of the tilt-images read.")
+                self.assertEqual(list(range(firstTi, firstTi + increment)),
+                                 [ti.getAcquisitionOrder() for ti in newTiDict[tsId]], "Wrong tilt-images read.")
+                self.assertFalse(reader.isStreamClosed(), "Stream closed too early.")
+                tsDict.update()
+                self.assertFalse(watcher.hasChanged(), "Reading the set is reported as a modification.")
+
+            connection.send(0)
+            self.assertEqual(nTi, connection.recv())
+        finally:
+            writer.join()
+
+        tsDict.update()
+        self.assertTrue(reader.read() == ([], {}) and reader.isStreamClosed(), "Stream closing not read.")
+        self.assertEqual(['TS_%03d' % i for i in range(nTi // tiPerTs)], newTsIds, "Wrong tilt-series notified.")
+        self.assertEqual([list(range(1, tiPerTs + 1))] * (nTi // tiPerTs),
+                         [[ti.getAcquisitionOrder() for ti in tsDict.getTiList(tsId)] for tsId in newTsIds],
+                         "Wrong tilt-images in the tilt-series dict.")
+
+        # Polling fallback
+        watcher = FileWatcher(fileName, useInotify=False, pollInterval=0.01)
+        self.assertTrue(watcher.hasChanged() and not watcher.hasChanged(), "Wrong changes reported by polling.")
+        self.assertFalse(watcher.wait(0.05), "Change reported without modifications.")
+        os.utime(fileName, ns=(0, os.stat(fileName).st_mtime_ns + 10 ** 9))
+        self.assertTrue(watcher.wait(1) and watcher.hasChanged(), "Modification not detected by polling.")
+
+    def test_tilt_series_apply_transform_workers(self):
+        """ Tests that applying the transformation matrices with a pool of processes gives the same result as the
+        serial execution"""
+        nTi = 41
+        stackFile = self.getOutputPath('ts_apply_transform.mrcs')
+        with mrcfile.new(stackFile, overwrite=True) as stackMrc:
+            stackMrc.set_data(np.random.RandomState(0).rand(nTi, 64, 48).astype(np.float32))
+
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='applyTransform')
+        tiltseries.setSamplingRate(SAMPLING_RATE)
+        ts = TiltSeries()
+        ts.setTsId(TS_1)
+        tiltseries.append(ts)
+        for i in range(nTi):
+            ti = TiltImage(location=(i + 1, stackFile))
+            ti.setTsId(TS_1)
+            ti.setIndex(i + 1)
+            ti.setAcquisitionOrder(i + 1)
+            ti.setEnabled(i != 20)
+            angle = np.deg2rad(i - 20)
+            trMatrix = np.array([[np.cos(angle), -np.sin(angle), 0.3 * i],
+                                 [np.sin(angle), np.cos(angle), -0.2 * i],
+                                 [0, 0, 1]])
+            ti.setTransform(Transform(trMatrix))
+            ts.append(ti)
+        tiltseries.update(ts)
+        tiltseries.write()
+
+        for ignoreExcludedViews in [True, False]:
+            serialFile = self.getOutputPath('ts_serial_%s.mrc' % ignoreExcludedViews)
+            parallelFile = self.getOutputPath('ts_parallel_%s.mrc' % ignoreExcludedViews)
+            ts.applyTransform(serialFile, ignoreExcludedViews=ignoreExcludedViews)
+            ts.applyTransform(parallelFile, ignoreExcludedViews=ignoreExcludedViews, workers=3)
+            with mrcfile.open(serialFile) as serialMrc, mrcfile.open(parallelFile) as parallelMrc:
+                nExpected = nTi if ignoreExcludedViews else nTi - 1
+                self.assertEqual((nExpected, 64, 48), parallelMrc.data.shape, "Wrong output stack shape.")
+                self.assertTrue(np.array_equal(serialMrc.data, parallelMrc.data),
+                                "Serial and parallel transformed stacks differ.")
+
+    def test_tilt_series_apply_transform_py(self):
+        """ Tests the interpolation of a tilt-series with python"""
+        nTi = 5
+        stackFile = self.getOutputPath('ts_apply_transform_py.mrcs')
+        stackData = np.random.RandomState(0).rand(nTi, 64, 48).astype(np.float32)
+        with mrcfile.new(stackFile, overwrite=True) as stackMrc:
+            stackMrc.set_data(stackData)
+
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='applyTransformPy')
+        tiltseries.setSamplingRate(SAMPLING_RATE)
+        ts = TiltSeries()
+        ts.setTsId(TS_1)
+        tiltseries.append(ts)
+        # Integer shifts only: x = i, y = 2 * i
+        for i in range(nTi):
+            ti = TiltImage(location=(i + 1, stackFile))
+            ti.setIndex(i + 1)
+            trMatrix = np.eye(3)
+            trMatrix[0, 2] = i
+            trMatrix[1, 2] = 2 * i
+            ti.setTransform(Transform(trMatrix))
+            ts.append(ti)
+        tiltseries.update(ts)
+        tiltseries.write()
+
+        outFile = self.getOutputPath('ts_interpolated.mrc')
+        ts.applyTransformPy(outFile, 1, batchSize=2)
+        with mrcfile.open(outFile) as outMrc:
+            self.assertEqual(stackData.shape, outMrc.data.shape, "Wrong interpolated stack shape.")
+            for i in range(nTi):
+                self.assertTrue(np.allclose(stackData[i, :64 - 2 * i, :48 - i], outMrc.data[i, 2 * i:, i:], atol=1e-4),
+                                "Wrong shifts applied to tilt-image %i." % (i + 1))
+
+        ts.applyTransformPy(outFile, 2)
+        with mrcfile.open(outFile) as outMrc:
+            self.assertEqual((nTi, 32, 24), outMrc.data.shape, "Wrong binned stack shape.")
+            self.assertAlmostEqual(2 * SAMPLING_RATE, float(outMrc.voxel_size.x), places=3,
+                                   msg="Wrong binned sampling rate.")
+
+    def test_tilt_series_restack(self):
+        """ Tests that re-stacking a tilt-series copies only the present images without loading the whole stack"""
+        nTi = 41
+        stackFile = self.getOutputPath('ts_restack.mrcs')
+        stackData = np.random.RandomState(0).rand(nTi, 256, 256).astype(np.float32)
+        with mrcfile.new(stackFile, overwrite=True) as stackMrc:
+            stackMrc.set_data(stackData)
+
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='reStack')
+        tiltseries.setSamplingRate(SAMPLING_RATE)
+        ts = TiltSeries()
+        ts.setTsId(TS_1)
+        tiltseries.append(ts)
+        for i in range(nTi):
+            ti = TiltImage(location=(i + 1, stackFile))
+            ti.setIndex(i + 1)
+            ti.setAcquisitionOrder(i + 1)
+            ti.setEnabled(i % 4 != 0)
+            ts.append(ti)
+        tiltseries.update(ts)
+        tiltseries.write()
+
+        outFile = self.getOutputPath('ts_restacked.mrcs')
+        presentAcqOrders = ts.getTsPresentAcqOrders()
+        tracemalloc.start()
+        try:
+            ts.reStack(stackFile, outFile, presentAcqOrders, chunkSize=4)
+            _, peakMemory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peakMemory, stackData.nbytes / 4, "reStack loads too much data in memory.")
+        keptPositions = [i for i in range(nTi) if i % 4 != 0]
+        with mrcfile.open(outFile) as outMrc:
+            self.assertTrue(np.array_equal(stackData[keptPositions], outMrc.data), "Wrong re-stacked images.")
+            self.assertAlmostEqual(float(stackData[keptPositions].mean()), float(outMrc.header.dmean), places=5,
+                                   msg="Wrong re-stacked header mean.")
+
+        # No excluded views: the output is linked
+        linkedFile = self.getOutputPath('ts_restack_linked.mrcs')
+        ts.reStack(stackFile, linkedFile, set(range(1, nTi + 1)))
+        self.assertTrue(os.path.samefile(stackFile, linkedFile), "A re-stack without excluded views is not linked.")
+
+    def test_imod_file_bundle(self):
+        """ Tests that the IMOD files written by ImodFileBundle are the same as the ones written one by one"""
+        nTi = 9
+        tiltseries = SetOfTiltSeries.create(self.outputPath, suffix='imodFiles')
+        ts = TiltSeries()
+        ts.setTsId(TS_1)
+        tiltseries.append(ts)
+        for i in range(nTi):
+            ti = TiltImage(location=(i + 1, 'ts.mrcs'))
+            ti.setIndex(i + 1)
+            ti.setTiltAngle(-40 + 10 * i + 0.123456)
+            ti.setAcquisitionOrder(nTi - i)
+            ti.setEnabled(i not in (0, 5))
+            ti.setAcquisition(TomoAcquisition(accumDose=3.1 * (nTi - i)))
+            angle = np.deg2rad(85 + i)
+            trMatrix = np.array([[np.cos(angle), -np.sin(angle), 1.2345 * i],
+                                 [np.sin(angle), np.cos(angle), -0.5 * i],
+                                 [0, 0, 1]])
+            ti.setTransform(Transform(trMatrix))
+            ts.append(ti)
+        tiltseries.update(ts)
+        tiltseries.write()
+
+        kwargs = {'tltIgnoresExcluded': True, 'factor': 2, 'thickness': 300, 'dims': (100, 200)}
+        serialFolder = self.getOutputPath('imodSerial')
+        bundleFolder = self.getOutputPath('imodBundle')
+        os.makedirs(serialFolder, exist_ok=True)
+        os.makedirs(bundleFolder, exist_ok=True)
+        ts.writeNewstcomFile(serialFolder, **kwargs)
+        ts.writeTiltcomFile(serialFolder, **kwargs)
+        ts.writeTltFile(serialFolder, excludeViews=True)
+        ts.writeXtiltFile(serialFolder)
+        ts.writeXfFile(os.path.join(serialFolder, '%s.xf' % TS_1), factor=2)
+        with ImodFileBundle(fsync=True) as bundle:
+            fileNames = bundle.add(ts, bundleFolder, **kwargs)
+            self.assertFalse(any(os.path.exists(fn) for fn in fileNames), "Files visible before flushing.")
+        self.assertEqual(sorted(os.listdir(serialFolder)), sorted(os.listdir(bundleFolder)), "Wrong files written.")
+        for fileName in os.listdir(serialFolder):
+            with open(os.path.join(serialFolder, fileName), 'rb') as f1, \
+                    open(os.path.join(bundleFolder, fileName), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read(), "File %s differs." % fileName)
+
+        # Tlt file with doses
+        tltFile = self.getOutputPath('generated.tlt')
+        ts.generateTltFile(tltFile, reverse=True, presentAcqOrders={2, 3, 7}, includeDose=True)
+        expected = sorted([(ti.getTiltAngle(), ti.getAcquisition().getAccumDose()) for ti in ts.iterItems()
+                           if ti.getAcquisitionOrder() in {2, 3, 7}], reverse=True)
+        with open(tltFile) as f:
+            self.assertEqual(''.join(f"{angle:0.3f} {dose:0.4f}\n" for angle, dose in expected), f.read(),
+                             "Wrong tlt file generated.")
+
     def test_landmarks(self):
         """ Test the Landmark model"""
 
@@ -234,3 +739,173 @@ class TestTomoModel(BaseTest):
         self.assertEqual(2, lm.getCount(), "Count not increased when not empty.")
 
         str(lm)
+
+    def test_landmarks_bulk(self):
+        """ Test the landmarks added at once are written as if added one by one"""
+        xCoors, yCoors = np.array([1.5, 2.25, 1 / 3]), np.array([-4.0, 0.1 + 0.2, 7.0])
+        tiltIms, chainIds = np.array([1, 2, 1]), np.array([4, 4, 5])
+        oneByOne = LandmarkModel(fileName=self.getOutputPath('one_by_one.sfid'))
+        for xCoor, yCoor, tiltIm, chainId in zip(xCoors, yCoors, tiltIms, chainIds):
+            oneByOne.addLandmark(xCoor, yCoor, tiltIm, chainId, None, None)
+        bulk = LandmarkModel(fileName=self.getOutputPath('bulk.sfid'))
+        bulk.addLandmarks(xCoors[:2], yCoors[:2], tiltIms[:2], chainIds[:2], None, None)
+        self.assertEqual(1, bulk.getCount(), "Count not increased once per chain.")
+        bulk.addLandmarks(xCoors[2:], yCoors[2:], tiltIms[2:], chainIds[2:], None, None)
+        self.assertEqual(2, bulk.getCount(), "Count not increased when not empty.")
+
+        with open(oneByOne.getFileName()) as expected, open(bulk.getFileName()) as result:
+            self.assertEqual(expected.read(), result.read(), "Different landmark files.")
+
+    def test_coordinates_positions(self):
+        """ Tests the positions of a SetOfCoordinates3D read and written in bulk are the same as one by one"""
+        nTomos, nCoords = 5, 5000
+        rng = np.random.default_rng(0)
+        tomos = SetOfTomograms.create(self.outputPath, suffix='positions')
+        for i in range(nTomos):
+            tomo = Tomogram(tsId='TS_%d' % i)
+            tomo.setSamplingRate(SAMPLING_RATE)
+            origin = Transform()
+            origin.setShifts(*rng.uniform(-3000, 0, 3))
+            tomo.setOrigin(origin)
+            tomos.append(tomo)
+        tomos.write()
+        coords = SetOfCoordinates3D.create(self.outputPath, suffix='positions')
+        coords.setPrecedents(tomos)
+
+        def iterCoords():
+            coord = Coordinate3D()
+            for tomoIndex, (x, y, z) in zip(rng.integers(0, nTomos, nCoords), rng.uniform(-300, 300, (nCoords, 3))):
+                coord.setObjId(None)
+                coord.setTomoId('TS_%d' % tomoIndex)
+                coord.setX(x, SCIPION)
+                coord.setY(y, SCIPION)
+                coord.setZ(z, SCIPION)
+                yield coord
+
+        appendItems(coords, iterCoords())
+        coords.write()
+
+        def loopPositions(originFunction, volume=None):
+            objIds, positions = [], []
+            for coord in coords.iterCoordinates(volume):
+                objIds.append(coord.getObjId())
+                positions.append(coord.getPosition(originFunction))
+            return np.array(positions), np.array(objIds)
+
+        shifted = lambda dim: (1.5, -2, 3)
+        for originFunction in [SCIPION, BOTTOM_LEFT_CORNER, shifted]:
+            expected, expectedIds = loopPositions(originFunction)
+            positions, objIds = coords.getPositions(originFunction)
+            self.assertTrue(np.array_equal(expectedIds, objIds), "getPositions returns wrong objIds.")
+            self.assertTrue(np.array_equal(expected, positions), "getPositions returns wrong positions.")
+
+        # Positions of a single tomogram
+        tomo = coords.getPrecedent('TS_3')
+        expected, expectedIds = loopPositions(BOTTOM_LEFT_CORNER, tomo)
+        positions, objIds = coords.getPositions(BOTTOM_LEFT_CORNER, tsId='TS_3')
+        self.assertTrue(np.array_equal(expectedIds, objIds), "getPositions returns wrong objIds of a tomogram.")
+        self.assertTrue(np.array_equal(expected, positions), "getPositions returns wrong positions of a tomogram.")
+
+        # Bulk update, compared with setPosition
+        newPositions = positions + rng.uniform(-10, 10, positions.shape)
+        coords.setPositions(objIds, newPositions, BOTTOM_LEFT_CORNER)
+        coords.write()
+        for coord, newPosition in zip(coords.iterCoordinates(tomo), newPositions[:100]):
+            expectedCoord = coord.clone()
+            expectedCoord.setVolume(tomo)
+            expectedCoord.setPosition(*newPosition, BOTTOM_LEFT_CORNER)
+            self.assertEqual((expectedCoord._x.get(), expectedCoord._y.get(), expectedCoord._z.get()),
+                             (coord._x.get(), coord._y.get(), coord._z.get()), "Wrong position written.")
+        self.assertTrue(np.array_equal(loopPositions(BOTTOM_LEFT_CORNER, tomo)[0],
+                                       coords.getPositions(BOTTOM_LEFT_CORNER, tsId='TS_3')[0]),
+                        "setPositions and getPositions are not consistent.")
+        with self.assertRaises(Exception):
+            coords.setPositions([nCoords + 1], [[0, 0, 0]], SCIPION)
+
+    def test_coordinates_precedents(self):
+        """ Tests the tomograms of a SetOfCoordinates3D are resolved with a constant number of queries"""
+        nTomos, coordsPerTomo = 1000, 3
+        quotedTsId = "TS_'quoted'"
+        tomos = SetOfTomograms.create(self.outputPath, suffix='precedents')
+        # The last two tomograms have no coordinates
+        for tsId in ['TS_%04d' % i for i in range(nTomos + 1)] + [quotedTsId]:
+            tomo = Tomogram(tsId=tsId)
+            tomo.setSamplingRate(SAMPLING_RATE)
+            tomos.append(tomo)
+        tomos.write()
+        coords = SetOfCoordinates3D.create(self.outputPath, suffix='precedents')
+        coords.setPrecedents(tomos)
+
+        def iterCoords():
+            coord = Coordinate3D()
+            for i in reversed(range(nTomos * coordsPerTomo)):  # Appended in descending tsId order
+                coord.setObjId(None)
+                coord.setTomoId('TS_%04d' % (i % nTomos))
+                coord.setPosition(i, i, i, SCIPION)
+                yield coord
+
+        appendItems(coords, iterCoords())
+        coords.write()
+
+        def getPrecedents(tsIds):
+            return [coords.getPrecedent(tsId) for tsId in tsIds]
+
+        def countQueries(func, *args):
+            tomosCmds, (coordsCmds, result) = countSqlStatements(tomos, countSqlStatements, coords, func, *args)
+            return tomosCmds + coordsCmds, result
+
+        # All the involved tomograms are loaded at once: the tsIds, the classes of the tomograms set and, per chunk
+        # of PRECEDENTS_CHUNK tomograms, the query of their ids, the check of the tables done by the mapper and the
+        # query of the tomograms
+        nCmds, result = countQueries(getPrecedents, ['TS_0000'])
+        self.assertLessEqual(nCmds, 2 + 3 * math.ceil(nTomos / SetOfCoordinates3D.PRECEDENTS_CHUNK),
+                             "The tomograms are not loaded at once.")
+        self.assertEqual(result[0].getTsId(), 'TS_0000', "getPrecedent returns a wrong tomogram.")
+        for tsIds in [['TS_0500'], ['TS_%04d' % i for i in range(nTomos)]]:
+            nCmds, result = countQueries(getPrecedents, tsIds)
+            self.assertEqual(nCmds, 0, "getPrecedent queries the database once the tomograms are loaded.")
+            self.assertEqual([tomo.getTsId() for tomo in result], tsIds, "getPrecedent returns wrong tomograms.")
+
+        # The involved tsIds are memoised until the set is modified
+        nCmds, involved = countQueries(coords.getPrecedentsInvolved)
+        self.assertEqual(nCmds, 0, "getPrecedentsInvolved queries the database once the tomograms are loaded.")
+        self.assertEqual(sorted(involved), ['TS_%04d' % i for i in range(nTomos)], "Wrong tomograms involved.")
+        coords.append(Coordinate3D(tomoId='TS_%04d' % nTomos))
+        coords.write()
+        self.assertEqual(len(coords.getPrecedentsInvolved()), nTomos + 1, "The involved tsIds were not updated.")
+        self.assertEqual(coords.getPrecedent('TS_%04d' % nTomos).getTsId(), 'TS_%04d' % nTomos,
+                         "getPrecedent returns a wrong tomogram.")
+        with self.assertRaises(KeyError):
+            coords.getPrecedent('MISSING')
+
+        # The tomograms can be loaded while the coordinates are being iterated
+        readCoords = SetOfCoordinates3D(filename=coords.getFileName())
+        readCoords.setPrecedents(tomos)
+        self.assertEqual(len([coord.getVolume().getTsId() for coord in readCoords.iterCoordinates()]),
+                         nTomos * coordsPerTomo + 1, "The iteration was interrupted when loading the tomograms.")
+
+        # Coordinates grouped by tomogram with a single query
+        expected = {tsId: [coord.getObjId() for coord in coords.iterCoordinates(tomo)]
+                    for tsId, tomo in coords.getPrecedentsInvolved().items()}
+        result = {}
+
+        def iterByTomogram():
+            for tomo, tomoCoords in coords.iterCoordinatesByTomogram():
+                result[tomo.getTsId()] = [coord.getObjId() for coord in tomoCoords
+                                          if coord.getVolume() is tomo]
+
+        nCmds, _ = countQueries(iterByTomogram)
+        singleTomoCmds, _ = countQueries(lambda: list(coords.iterCoordinates(coords.getPrecedent('TS_0000'))))
+        self.assertEqual(nCmds, singleTomoCmds, "The coordinates grouped by tomogram are not read with a single query.")
+        self.assertEqual(list(result), sorted(expected), "The tomograms are not sorted by tsId.")
+        self.assertEqual(result, expected, "Wrong coordinates of the tomograms.")
+
+        # The memoised tsIds are discarded when the set is reloaded, as it may be modified by other processes
+        otherCoords = SetOfCoordinates3D(filename=coords.getFileName())
+        otherCoords.enableAppend()
+        otherCoords.append(Coordinate3D(tomoId=quotedTsId))
+        otherCoords.write()
+        otherCoords.close()
+        coords.loadAllProperties()
+        self.assertIn(quotedTsId, coords.getTSIds(), "The involved tsIds were not updated when reloading the set.")
+        self.assertEqual(coords.getPrecedent(quotedTsId).getTsId(), quotedTsId, "getPrecedent returns a wrong tomogram.")
@@ -0,0 +1,118 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+from pwem.objects import Transform
+from pyworkflow.tests import BaseTest
+from pyworkflow.utils import cleanPath
+from tomo.constants import SCIPION
+from tomo.objects import SetOfTiltSeries, TiltSeries, TiltImage, SetOfCoordinates3D, Coordinate3D, LandmarkModel
+from tomo.protocols.protocol_project_coordinates import ProtProjectCoordinates
+
+TS_SAMPLING_RATE = 5.1
+COORDS_SAMPLING_RATE = 10.2
+TS_ID = 'TS_01'
+
+
+def loopProjectCoordinates(landmarkModel, tiltSeries, coordinates, scale, offset):
+    """ Projects the coordinates one by one onto each tilt-image, as done by the protocol before being vectorised """
+    where = '%s="%s"' % (Coordinate3D.TOMO_ID_ATTR, tiltSeries.getTsId())
+    for coordinate3d in coordinates.iterItems(where=where):
+        position3d = np.array(coordinate3d.getPosition(SCIPION) + (1,))
+        position3d[:3] *= scale
+        for tiltImage in tiltSeries:
+            tiltAngle = np.deg2rad(tiltImage.getTiltAngle())
+            projection = np.array([[np.cos(tiltAngle), 0, np.sin(tiltAngle), 0],
+                                   [0, 1, 0, 0],
+                                   [0, 0, 0, 1]])
+            projected = projection @ position3d
+            if tiltImage.hasTransform():
+                projected = np.linalg.inv(tiltImage.getTransform().getMatrix()) @ projected
+            position2d = projected[:2] + offset
+            landmarkModel.addLandmark(xCoor=position2d[0], yCoor=position2d[1], tiltIm=tiltImage.getIndex(),
+                                      chainId=coordinate3d.getObjId(), xResid=0, yResid=0)
+
+
+class TestProjectCoordinates(BaseTest):
+    """ Compares the projection of all the coordinates of a tilt-series at once with the projection of each coordinate
+    onto each tilt-image."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _createSets(self, nCoords, nTi):
+        """ Creates a tilt-series with random alignment transformations, except for some tilt-images, and a set of
+        coordinates of it """
+        rng = np.random.default_rng(0)
+        suffix = '%d' % nCoords
+        tsSet = SetOfTiltSeries.create(self.outputPath, suffix=suffix)
+        tsSet.setSamplingRate(TS_SAMPLING_RATE)
+        ts = TiltSeries(tsId=TS_ID)
+        tsSet.append(ts)
+        for i, tiltAngle in enumerate(np.linspace(-60, 60, nTi)):
+            ti = TiltImage(tsId=TS_ID, tiltAngle=tiltAngle, acquisitionOrder=i + 1)
+            ti.setIndex(i + 1)
+            if i % 10:
+                angle = np.deg2rad(rng.uniform(-5, 5))
+                transform = Transform()
+                transform.setMatrix(np.array([[np.cos(angle), -np.sin(angle), rng.uniform(-20, 20)],
+                                              [np.sin(angle), np.cos(angle), rng.uniform(-20, 20)],
+                                              [0, 0, 1]]))
+                ti.setTransform(transform)
+            ts.append(ti)
+        tsSet.update(ts)
+        tsSet.write()
+        coords = SetOfCoordinates3D.create(self.outputPath, suffix=suffix)
+        coords.setSamplingRate(COORDS_SAMPLING_RATE)
+        for x, y, z in rng.uniform(-200, 200, (nCoords, 3)):
+            coord = Coordinate3D(tomoId=TS_ID)
+            coord.setX(x, SCIPION)
+            coord.setY(y, SCIPION)
+            coord.setZ(z, SCIPION)
+            coords.append(coord)
+        coords.write()
+        return tsSet, coords
+
+    def _compare(self, nCoords, nTi):
+        tsSet, coords = self._createSets(nCoords, nTi)
+        ts = tsSet.getFirstItem()
+        scale = COORDS_SAMPLING_RATE / TS_SAMPLING_RATE
+        offset = np.array([1024, 1440]) / 2
+        models = {}
+        for label, projectFunc in [('loop', loopProjectCoordinates),
+                                   ('batch', ProtProjectCoordinates()._projectTsCoordinates)]:
+            fileName = self.getOutputPath('%s_%d.sfid' % (label, nCoords))
+            cleanPath(fileName)
+            models[label] = LandmarkModel(tsId=TS_ID, fileName=fileName, applyTSTransformation=False)
+            projectFunc(models[label], ts, coords, scale, offset)
+            self.addCleanup(cleanPath, fileName)
+
+        self.assertEqual(models['loop'].getCount(), models['batch'].getCount(), "Different number of chains.")
+        expected = np.array(models['loop'].retrieveInfoTable(), dtype=float)
+        result = np.array(models['batch'].retrieveInfoTable(), dtype=float)
+        self.assertEqual(expected.shape, (nCoords * nTi, 6), "Unexpected number of landmarks.")
+        self.assertEqual(expected.shape, result.shape, "Different number of landmarks.")
+        self.assertTrue(np.array_equal(expected[:, 2:], result[:, 2:]), "Different tilt-images, chains or residuals.")
+        self.assertTrue(np.allclose(expected[:, :2], result[:, :2], rtol=0, atol=1e-9), "Different projections.")
+
+    def test_projection(self):
+        self._compare(100, 41)
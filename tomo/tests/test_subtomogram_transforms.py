@@ -0,0 +1,121 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+from pwem.convert.transformations import euler_matrix
+from pwem.objects import Transform
+from pyworkflow.tests import BaseTest
+import tomo.constants as const
+from tomo.objects import (SetOfSubTomograms, SubTomogram, MATRIX_CONVERSION, convertMatrix, convertMatrices,
+                          appendItems)
+
+SAMPLING_RATE = 10.2
+CONVENTIONS = [None, MATRIX_CONVERSION.RELION, MATRIX_CONVERSION.XMIPP, MATRIX_CONVERSION.EMAN,
+               MATRIX_CONVERSION.DYNAMO]
+
+
+def randomTransforms(n, rng):
+    """ Stack of n rigid transformation matrices with random rotations and shifts """
+    matrices = np.array([euler_matrix(*angles) for angles in rng.uniform(-np.pi, np.pi, (n, 3))])
+    matrices[:, :3, 3] = rng.uniform(-50, 50, (n, 3))
+    return matrices
+
+
+def loopGetTransforms(subtomos, convention):
+    """ Reads the transformation of the subtomograms one by one, as done before reading them in bulk """
+    objIds, matrices = [], []
+    for subtomo in subtomos:
+        objIds.append(subtomo.getObjId())
+        matrices.append(subtomo.getTransform(convention=convention).getMatrix())
+    return np.array(matrices), np.array(objIds)
+
+
+def loopSetTransforms(subtomos, matrices, convention, outputSubtomos):
+    """ Sets the transformation of the subtomograms one by one, appending them to outputSubtomos, as done by the
+    conversions before writing them in bulk """
+    for subtomo, matrix in zip(subtomos, matrices):
+        subtomo.setTransform(Transform(matrix), convention=convention)
+        outputSubtomos.append(subtomo)
+    outputSubtomos.write()
+
+
+class TestSubTomogramTransforms(BaseTest):
+    """ Compares the conversion, reading and writing of the transformations of the subtomograms in bulk with the
+    same operations done subtomogram by subtomogram."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _createSubtomograms(self, nSubtomos, rng):
+        subtomos = SetOfSubTomograms.create(self.outputPath, suffix='%d' % nSubtomos)
+        subtomos.setSamplingRate(SAMPLING_RATE)
+
+        def iterSubtomos():
+            subtomo = SubTomogram()
+            subtomo.setSamplingRate(SAMPLING_RATE)
+            for i, matrix in enumerate(randomTransforms(nSubtomos, rng)):
+                subtomo.setObjId(None)
+                subtomo.setLocation(i + 1, 'subtomograms.mrc')
+                subtomo.setTransform(Transform(matrix))
+                yield subtomo
+
+        appendItems(subtomos, iterSubtomos())
+        subtomos.write()
+        return subtomos
+
+    def test_convert_matrices(self):
+        rng = np.random.default_rng(0)
+        # Rigid transformations and general matrices
+        stack = np.concatenate([randomTransforms(500, rng), rng.normal(size=(500, 4, 4))])
+        for convention in CONVENTIONS:
+            for direction in [const.GET, const.SET]:
+                expected = np.array([convertMatrix(matrix, convention=convention, direction=direction)
+                                     for matrix in stack])
+                self.assertTrue(np.array_equal(expected, convertMatrices(stack, convention=convention,
+                                                                         direction=direction)),
+                                "Different matrices for convention %s, direction %s." % (convention, direction))
+        with self.assertRaises(ValueError):
+            convertMatrices(stack, convention=MATRIX_CONVERSION.RELION)
+
+    def test_transform_stack(self):
+        rng = np.random.default_rng(1)
+        subtomos = self._createSubtomograms(1000, rng)
+        for convention in CONVENTIONS:
+            expected, expectedIds = loopGetTransforms(subtomos, convention)
+            matrices, objIds = subtomos.getTransformStack(convention)
+            self.assertTrue(np.array_equal(expectedIds, objIds), "getTransformStack returns wrong objIds.")
+            self.assertTrue(np.array_equal(expected, matrices), "Different matrices for convention %s." % convention)
+
+        # Written in bulk and one by one
+        newMatrices = randomTransforms(len(objIds), rng)
+        expected = SetOfSubTomograms.create(self.outputPath, suffix='loop%d' % len(objIds))
+        expected.copyInfo(subtomos)
+        loopSetTransforms(subtomos, newMatrices, MATRIX_CONVERSION.RELION, expected)
+        subtomos.setTransformStack(objIds[::2], newMatrices[::2], MATRIX_CONVERSION.RELION)
+        subtomos.setTransformStack(objIds[1::2], newMatrices[1::2], MATRIX_CONVERSION.RELION)
+        subtomos.write()
+        for convention in CONVENTIONS:
+            self.assertTrue(np.array_equal(loopGetTransforms(expected, convention)[0],
+                                           subtomos.getTransformStack(convention)[0]),
+                            "Different matrices written for convention %s." % convention)
+        with self.assertRaises(Exception):
+            subtomos.setTransformStack([len(objIds) + 1], np.eye(4)[None])
@@ -0,0 +1,223 @@
+# **************************************************************************
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import math
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+from tomo.protocols.protocol_ts_consensus_alignment import ProtConsensusAlignmentTS
+
+
+def _scaledMatrix(matrix, samplingFactor):
+    sampledMatrix = matrix.copy()
+    sampledMatrix[0, 2] *= samplingFactor
+    sampledMatrix[1, 2] *= samplingFactor
+    return sampledMatrix
+
+
+def _angleError(pError):
+    if math.isnan(pError[1][0] / pError[0][0]):
+        return 0
+    return math.degrees(math.asin(pError[1][0]))
+
+
+def _pMatrix(Mset, j, k, samplingFactor):
+    p = np.zeros((3, 3))
+    for i in range(len(Mset[0])):
+        p += np.matmul(Mset[j][i], np.linalg.inv(_scaledMatrix(Mset[k][i], samplingFactor)))
+    return p / len(Mset[0])
+
+
+def _yCorrectedMatrix(matrix, samplingFactor, p):
+    matrixShiftYCorrected = _scaledMatrix(matrix, samplingFactor)
+    matrixShiftYCorrected[1, 2] += p[1][2]
+    return matrixShiftYCorrected
+
+
+def scalarGlobalConsensus(Mset, shiftTol, angleTol, SRset):
+    """ Tilt-image by tilt-image global consensus, as done by the protocol before being vectorised """
+    Nts = len(Mset)
+    if Nts < 2:
+        return None, None, None
+    Nti = len(Mset[0])
+
+    consensusAlignmentMatrix = np.zeros((Nts, Nts))
+    for j in range(Nts):
+        for k in range(j + 1, Nts):
+            samplingFactor = SRset[k] / SRset[j]
+            p = _pMatrix(Mset, j, k, samplingFactor)
+            for i in range(Nti):
+                pError = Mset[j][i] - _yCorrectedMatrix(Mset[k][i], samplingFactor, p)
+                if abs(pError[0][2]) > shiftTol or abs(pError[1][2]) > shiftTol or \
+                        abs(_angleError(pError)) > angleTol:
+                    consensusAlignmentMatrix[j][k] = 1
+
+    indexFailed = np.sum(consensusAlignmentMatrix, axis=0)
+    if indexFailed[np.argmax(indexFailed)] != 0:
+        # The sampling rate of the discarded alignment is discarded too
+        del Mset[np.argmax(indexFailed)]
+        SRset = list(SRset)
+        del SRset[np.argmax(indexFailed)]
+        return scalarGlobalConsensus(Mset, shiftTol, angleTol, SRset)
+
+    averageAlignmentV, angleSDV, shiftSDV = [], [], []
+    for i in range(Nti):
+        averageMatrix = np.zeros((3, 3))
+        angleV, shiftV = [], []
+        for j in range(Nts):
+            m = _scaledMatrix(Mset[j][i], SRset[j] / SRset[0])
+            averageMatrix += m
+            angleV.append(math.degrees(math.asin(m[1][0])))
+            shiftV.append((m[0][2] + m[1][2]) / 2)
+        angleSDV.append(np.std(angleV))
+        shiftSDV.append(np.std(shiftV))
+        averageAlignmentV.append(averageMatrix / Nts)
+    return averageAlignmentV, angleSDV, shiftSDV
+
+
+def scalarLocalConsensus(Mset, shiftTol, angleTol, SRset):
+    """ Tilt-image by tilt-image local consensus, as done by the protocol before being vectorised """
+    Nts = len(Mset)
+    Nti = len(Mset[0])
+
+    P_dict = {}
+    for j in range(Nts):
+        for k in range(j + 1, Nts):
+            P_dict["%d_%d" % (j, k)] = _pMatrix(Mset, j, k, SRset[k] / SRset[j])
+
+    averageAlignmentV, angleSDV, shiftSDV = [], [], []
+    for i in range(Nti):
+        consensusIndexes = []
+        for j in range(Nts):
+            for k in range(j + 1, Nts):
+                pError = Mset[j][i] - _yCorrectedMatrix(Mset[k][i], SRset[k] / SRset[j], P_dict["%d_%d" % (j, k)])
+                if abs(pError[0][2]) < shiftTol and abs(pError[1][2]) < shiftTol and \
+                        abs(_angleError(pError)) < angleTol:
+                    consensusIndexes += [j, k]
+        consensusIndexes = list(dict.fromkeys(consensusIndexes))
+
+        if not consensusIndexes:
+            averageAlignmentV.append(None)
+            angleSDV.append(None)
+            shiftSDV.append(None)
+            continue
+
+        tiConsensusAlignment = Mset[0][i].copy()
+        angleV = [_angleError(Mset[0][i])]
+        shiftV = [(Mset[0][i][0][2] + Mset[0][i][1][2]) / 2]
+        for m in consensusIndexes[1:]:
+            matrix = _yCorrectedMatrix(Mset[m][i], SRset[consensusIndexes[0]] / SRset[m],
+                                       P_dict["%d_%d" % (consensusIndexes[0], m)])
+            tiConsensusAlignment += matrix
+            angleV.append(_angleError(matrix))
+            shiftV.append((matrix[0][2] + matrix[1][2]) / 2)
+        angleSDV.append(np.std(angleV))
+        shiftSDV.append(np.std(shiftV))
+        averageAlignmentV.append(tiConsensusAlignment / len(consensusIndexes))
+
+    if all(a is None for a in averageAlignmentV):
+        return None, None, None
+    return averageAlignmentV, angleSDV, shiftSDV
+
+
+class TestConsensusAlignmentEngine(BaseTest):
+    """ Compares the vectorised consensus of the tilt-series alignments with the tilt-image by tilt-image one."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nSets, cls.nTs, cls.nTi = 5, 60, 61
+        cls.SRset = [1.35, 1.35, 2.7, 1.35, 1.35]
+        cls.shiftTol, cls.angleTol = 10, 3
+
+    def _generateAlignments(self, rng, case):
+        """ Alignments of a tilt-series in each set: noisy versions of the same rotations and shifts (Å). Depending
+        on the case, the second set, sampled differently than the next one, is misaligned in some tilt-images (1) or
+        the shifts of all the sets are unrelated (2). """
+        angles = np.radians(rng.uniform(-5, 5) + rng.normal(0, 0.5, (self.nSets, self.nTi)))
+        shifts = rng.uniform(-100, 100, (self.nTi, 2)) + rng.normal(0, 2, (self.nSets, self.nTi, 2))
+        shifts[:, :, 1] += rng.normal(0, 5, (self.nSets, 1))  # Y offset of each alignment
+        if case == 1:
+            shifts[1, rng.choice(self.nTi, 6, replace=False)] += 60
+        elif case == 2:
+            shifts = rng.uniform(-100, 100, (self.nSets, self.nTi, 2))
+        Mset = np.zeros((self.nSets, self.nTi, 3, 3))
+        Mset[..., 0, 0] = Mset[..., 1, 1] = np.cos(angles)
+        Mset[..., 1, 0] = np.sin(angles)
+        Mset[..., 0, 1] = -np.sin(angles)
+        Mset[..., :2, 2] = shifts / np.array(self.SRset)[:, None, None]
+        Mset[..., 2, 2] = 1
+        return Mset
+
+    def _assertSameConsensus(self, expected, result):
+        if expected[0] is None:
+            self.assertEqual((None, None, None), result, "Consensus achieved when there is not.")
+            return
+        tiConsensus = np.array([a is not None for a in expected[0]])
+        averageAlignments, angleSDs, shiftSDs = result
+        self.assertTrue(np.array_equal(~tiConsensus, np.isnan(angleSDs)), "Wrong tilt-images with consensus.")
+        self.assertTrue(np.array_equal(~tiConsensus, np.isnan(shiftSDs)), "Wrong tilt-images with consensus.")
+        self.assertTrue(np.isnan(averageAlignments[~tiConsensus]).all(), "Wrong tilt-images with consensus.")
+        np.testing.assert_allclose(np.array([a for a in expected[0] if a is not None]),
+                                   averageAlignments[tiConsensus], atol=1e-9, err_msg="Wrong average alignment.")
+        np.testing.assert_allclose(np.array([a for a in expected[1] if a is not None]),
+                                   angleSDs[tiConsensus], atol=1e-9, err_msg="Wrong angle deviation.")
+        np.testing.assert_allclose(np.array([a for a in expected[2] if a is not None]),
+                                   shiftSDs[tiConsensus], atol=1e-9, err_msg="Wrong shift deviation.")
+
+    def test_consensus(self):
+        rng = np.random.default_rng(0)
+        shiftTol = round(self.shiftTol / self.SRset[0])
+        nGlobalNoConsensus, nLocalPartialConsensus = 0, 0
+        for tsIndex in range(self.nTs):
+            Mset = self._generateAlignments(rng, tsIndex % 3)
+
+            for mode, scalarConsensus, vectorisedConsensus in [
+                    ('global', scalarGlobalConsensus, ProtConsensusAlignmentTS.compareTransformationMatricesGlobal),
+                    ('local', scalarLocalConsensus, ProtConsensusAlignmentTS.compareTransformationMatricesLocal)]:
+                expected = scalarConsensus(list(Mset), shiftTol, self.angleTol, self.SRset)
+                result = vectorisedConsensus(Mset, shiftTol, self.angleTol, self.SRset)
+                self._assertSameConsensus(expected, result)
+
+                if mode == 'global':
+                    nGlobalNoConsensus += expected[0] is None
+                else:
+                    nLocalPartialConsensus += expected[0] is not None and None in expected[1]
+
+        self.assertTrue(0 < nGlobalNoConsensus < self.nTs, "The global consensus cases are not covered.")
+        self.assertTrue(nLocalPartialConsensus, "The local consensus cases are not covered.")
+
+    def test_opposite_rotations(self):
+        # The sine of the angle error of rotations of +60 and -60 degrees is out of [-1, 1]
+        angles = np.radians([60, -60])
+        Mset = np.zeros((2, 5, 3, 3))
+        Mset[..., 0, 0] = Mset[..., 1, 1] = np.cos(angles)[:, None]
+        Mset[..., 1, 0] = np.sin(angles)[:, None]
+        Mset[..., 0, 1] = -np.sin(angles)[:, None]
+        Mset[..., 2, 2] = 1
+        self.assertEqual((None, None, None),
+                         ProtConsensusAlignmentTS.compareTransformationMatricesGlobal(Mset, 10, 3, [1.35, 1.35]),
+                         "Consensus achieved for opposite rotations.")
+
+    def test_invalid_rotation(self):
+        Mset = self._generateAlignments(np.random.default_rng(1), 0)
+        Mset[:, 0, 1, 0] = 1.5
+        with self.assertRaises(ValueError):
+            ProtConsensusAlignmentTS.compareTransformationMatricesGlobal(Mset, 1000, 1000, self.SRset)
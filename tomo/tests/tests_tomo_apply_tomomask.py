@@ -23,19 +23,55 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import tracemalloc
 from typing import Tuple, Union
+from unittest.mock import patch
+
+import mrcfile
+import numpy as np
+from scipy.ndimage import binary_dilation, gaussian_filter
 from imod.constants import OUTPUT_TOMOGRAMS_NAME
 from imod.protocols import ProtImodTomoNormalization
 from imod.protocols.protocol_base import IN_TOMO_SET, BINNING_FACTOR
 from imod.protocols.protocol_base_preprocess import NO_ADJUST
-from pyworkflow.tests import setupTestProject, DataSet
-from pyworkflow.utils import magentaStr, cyanStr
+from pwem.emlib.image.image_readers import MRCImageReader, ImageStack
+from pyworkflow.tests import BaseTest, setupTestProject, DataSet
+from pyworkflow.utils import magentaStr, cyanStr, cleanPath
 from tomo.objects import SetOfTomograms
 from tomo.protocols import ProtImportTomograms, ProtImportTomomasks
 from tomo.protocols.protocol_tomo_apply_tomomask import ApplyTomoMaskFormParams, ProtTomoApplyTomoMask
 from tomo.tests.test_base_centralized_layer import TestBaseCentralizedLayer
 from tomo.tests import EMD_10439, DataSetEmd10439
 
+SAMPLING_RATE = 10.2
+
+
+def fullVolumeProcessMask(maskFileName, outFileName, samplingRate, dilationPixels, sigma, invert):
+    """ Processes the whole mask at once, as done by the protocol before processing it by slabs """
+    with mrcfile.mmap(maskFileName, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        if dilationPixels > 0:
+            data = np.array(data, dtype=bool)
+            data = binary_dilation(data, iterations=dilationPixels)
+        data = np.array(data, dtype=float)
+    smoothData = gaussian_filter(data, sigma=sigma)
+    del data
+    smoothData = 1 - smoothData if invert else smoothData
+    with mrcfile.new_mmap(outFileName, overwrite=True, shape=smoothData.shape, mrc_mode=2) as mrc:
+        for i in range(len(smoothData)):
+            mrc.data[i, :, :] = smoothData[i, :, :]
+        mrc.update_header_from_data()
+        mrc.voxel_size = samplingRate
+
+
+def fullVolumeApplyMask(maskFileName, tomoFileName, outFileName, samplingRate):
+    """ Multiplies the whole mask and tomogram, as done by the protocol before processing them by slabs """
+    with mrcfile.mmap(maskFileName, mode='r', permissive=True) as maskMrc, \
+            mrcfile.mmap(tomoFileName, mode='r', permissive=True) as tomoMrc:
+        resultingImgList = [np.multiply(maskSlice, tomoSlice) for maskSlice, tomoSlice in
+                            zip(maskMrc.data, tomoMrc.data)]
+    MRCImageReader.write(ImageStack(resultingImgList), outFileName, samplingRate=samplingRate)
+
 
 class TestApplyTomoMask(TestBaseCentralizedLayer):
     ds = None
@@ -158,3 +194,86 @@ class TestApplyTomoMask(TestBaseCentralizedLayer):
         self.checkTomos(maskedTomos)
 
 
+class TestApplyTomoMaskSlabs(BaseTest):
+    """ Compares the processing of the masks and the tomograms by Z slabs with their processing as a whole."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def _writeVolumes(self, dim):
+        """ Writes, slice by slice, a binary mask with some spheres and a random tomogram """
+        maskFn, tomoFn = self.getOutputPath('mask_%d.mrc' % dim), self.getOutputPath('tomo_%d.mrc' % dim)
+        rng = np.random.default_rng(0)
+        centers = rng.uniform(0.2 * dim, 0.8 * dim, (5, 3))
+        radii = rng.uniform(0.05 * dim, 0.2 * dim, 5)
+        y, x = np.mgrid[:dim, :dim]
+        with mrcfile.new_mmap(maskFn, shape=(dim, dim, dim), mrc_mode=0, overwrite=True) as maskMrc, \
+                mrcfile.new_mmap(tomoFn, shape=(dim, dim, dim), mrc_mode=2, overwrite=True) as tomoMrc:
+            for z in range(dim):
+                maskSlice = np.zeros((dim, dim), dtype=bool)
+                for (cz, cy, cx), radius in zip(centers, radii):
+                    maskSlice |= (z - cz) ** 2 + (y - cy) ** 2 + (x - cx) ** 2 < radius ** 2
+                maskMrc.data[z] = maskSlice
+                tomoMrc.data[z] = rng.standard_normal((dim, dim), dtype=np.float32)
+            for mrc in maskMrc, tomoMrc:
+                mrc.voxel_size = SAMPLING_RATE
+        for fn in maskFn, tomoFn:
+            self.addCleanup(cleanPath, fn)
+        return maskFn, tomoFn
+
+    def _assertSameVolumes(self, expectedFn, resultFn, msg):
+        with mrcfile.mmap(expectedFn, mode='r') as expected, mrcfile.mmap(resultFn, mode='r') as result:
+            self.assertEqual(expected.data.shape, result.data.shape, "%s: different dimensions." % msg)
+            self.assertEqual(expected.data.dtype, result.data.dtype, "%s: different data type." % msg)
+            self.assertEqual(expected.header.ispg, result.header.ispg, "%s: different space group." % msg)
+            self.assertEqual(expected.voxel_size, result.voxel_size, "%s: different voxel size." % msg)
+            sums = np.zeros(2)
+            for z in range(len(expected.data)):
+                self.assertTrue(np.array_equal(expected.data[z], result.data[z]), "%s: different data." % msg)
+                sums += result.data[z].sum(dtype=np.float64), np.square(result.data[z], dtype=np.float64).sum()
+            # The statistics of the volumes written as a whole were not calculated
+            mean = sums[0] / result.data.size
+            for field, value in [('dmin', result.data.min()), ('dmax', result.data.max()), ('dmean', mean),
+                                 ('rms', np.sqrt(sums[1] / result.data.size - mean ** 2))]:
+                self.assertAlmostEqual(float(value), float(result.header[field]), places=4,
+                                       msg="%s: wrong header %s." % (msg, field))
+
+    def _compare(self, dim, dilationPixels, sigma, invert):
+        maskFn, tomoFn = self._writeVolumes(dim)
+        outFn = lambda label: self.getOutputPath('%s_%d.mrc' % (label, dim))
+        peaks = {}
+
+        tracemalloc.start()
+        fullVolumeProcessMask(maskFn, outFn('fullMask'), SAMPLING_RATE, dilationPixels, sigma, invert)
+        fullVolumeApplyMask(outFn('fullMask'), tomoFn, outFn('fullTomo'), SAMPLING_RATE)
+        peaks['full'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        for label, workers in [('slabs', 1), ('slabs_2_workers', 2)]:
+            tracemalloc.start()
+            ProtTomoApplyTomoMask.processMask(maskFn, outFn(label + 'Mask'), SAMPLING_RATE,
+                                              dilationPixels=dilationPixels, sigma=sigma, invert=invert,
+                                              workers=workers)
+            ProtTomoApplyTomoMask.applyMask(outFn(label + 'Mask'), tomoFn, outFn(label + 'Tomo'), SAMPLING_RATE,
+                                            workers=workers)
+            peaks[label] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self._assertSameVolumes(outFn('fullMask'), outFn(label + 'Mask'), 'Processed mask (%s)' % label)
+            self._assertSameVolumes(outFn('fullTomo'), outFn(label + 'Tomo'), 'Masked tomogram (%s)' % label)
+
+        for label in ['full', 'slabs', 'slabs_2_workers']:
+            for suffix in ['Mask', 'Tomo']:
+                cleanPath(outFn(label + suffix))
+        return peaks
+
+    def test_slabs(self):
+        # Slabs of 32 slices
+        with patch('tomo.protocols.protocol_tomo_apply_tomomask.SLAB_VOXELS', 256 * 256 * 32):
+            peaks = self._compare(256, dilationPixels=2, sigma=3, invert=True)
+        self.assertLess(peaks['slabs'], peaks['full'] / 3, "The slabs do not reduce the peak memory.")
+
+    def test_slabs_no_dilation(self):
+        # Slabs of 32 slices (4 times the halo)
+        with patch('tomo.protocols.protocol_tomo_apply_tomomask.SLAB_VOXELS', 100 * 100 * 10):
+            self._compare(100, dilationPixels=0, sigma=2, invert=False)
@@ -40,7 +40,7 @@ import pyworkflow.utils as pwutils
 
 import tomo.constants as const
 from tomo.objects import SetOfCoordinates3D, SetOfSubTomograms, SetOfTiltSeries, Coordinate3D, SubTomogram, TiltSeries, \
-    CTFTomoSeries, TiltImage, CTFTomo
+    CTFTomoSeries, TiltImage, CTFTomo, SetOfTiltSeriesBase
 
 
 def existsPlugin(plugin):
@@ -333,8 +333,15 @@ def generatePointCloud(v, tomoDim):
 
 
 def isMatchingByTsId(set1, set2):
-    return True if getattr(set1.getFirstItem(), _getTsIdLabel(set1), None) and \
-                   getattr(set2.getFirstItem(), _getTsIdLabel(set2), None) else False
+    return True if _hasTsId(set1) and _hasTsId(set2) else False
+
+
+def _hasTsId(setObject):
+    """Sets of tilt-series are checked using their tsId index, so the first item (and its nested tilt-images
+    table) does not need to be loaded."""
+    if isinstance(setObject, SetOfTiltSeriesBase):
+        return any(setObject.getTsIdIndex())
+    return getattr(setObject.getFirstItem(), _getTsIdLabel(setObject), None)
 
 
 def _getTsIdLabel(setObject):